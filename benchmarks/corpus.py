@@ -0,0 +1,169 @@
+import os
+import re
+import random
+from pathlib import Path
+
+from lerobert.lexicon import fold_accents
+
+
+# syllables of the made-up header words, accented ones give the pages different word_paths and words
+SYLLABLES = ['ba', 'bé', 'co', 'da', 'fi', 'ga', 'lè', 'lo', 'ma', 'mi', 'na', 'pê', 'po', 'ra', 'ri', 'sa', 'tu',
+             'va', 'vo', 'ché', 'con', 'tan', 'pin', 'gue', 'que']
+DETERMINERS = ['le', 'la', 'les', 'un', 'une', 'des', 'ce', 'cette', 'son', 'sa', 'leur']
+FILLER_WORDS = ['il', 'elle', 'ils', 'on', 'est', 'a', 'fait', 'prend', 'donne', 'voit', 'très', 'bien', 'plus',
+                'dans', 'sur', 'avec', 'pour', 'de', 'à', 'et', 'mais', 'grand', 'petit', 'vieux', 'nouvelle',
+                'jardin', 'maison', 'eau', 'temps', 'main', 'jour', 'nuit', 'ville', 'mer', 'rue', 'soir']
+CATEGORIES = ['nom masculin', 'nom féminin', 'verbe transitif', 'adjectif', 'adverbe', 'nom']
+# inline tags found inside examples (class="d_xpl") of the dictionary
+INLINE_TAGS = [('i', None), ('span', 'd_gls'), ('b', None)]
+ARTICLES = {word: 'DET:ART' for word in DETERMINERS}
+
+re_token = re.compile(r"<[^>]*>|\w+'?|[^\w\s]")
+
+
+def make_word(rng, num_syllables=(2, 4)):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(*num_syllables)))
+
+
+def make_example(rng, word, vocabulary, length=(4, 16), markup=0.3):
+    """Return the inner HTML of an example sentence using word once and random words of the vocabulary.
+    """
+    words = [rng.choice(vocabulary) if rng.random() < 0.3 else rng.choice(FILLER_WORDS)
+             for _ in range(rng.randint(*length))]
+    ind = rng.randrange(len(words) + 1)
+    words[ind:ind] = [rng.choice(DETERMINERS), word + ('s' if rng.random() < 0.2 else '')]
+    if rng.random() < markup:
+        # some words of the example are inside inline tags
+        ind = rng.randrange(len(words))
+        name, class_name = rng.choice(INLINE_TAGS)
+        class_attribute = f' class="{class_name}"' if class_name else ''
+        words[ind] = f'<{name}{class_attribute}>{words[ind]}</{name}>'
+    sentence = ' '.join(words)
+    return sentence[0].upper() + sentence[1:] + rng.choice(['.', '.', ' !', ' ?'])
+
+
+def make_definition(rng, word, category, vocabulary, num_examples):
+    senses = []
+    for sense_ind in range(rng.randint(1, 3)):
+        examples = ''.join(f'<span class="d_xpl">{make_example(rng, word, vocabulary)}</span>'
+                           for _ in range(num_examples[sense_ind] if sense_ind < len(num_examples) else 0))
+        link = rng.choice(vocabulary)
+        senses.append(f'<div class="d_dvn"><span class="d_rvh">{sense_ind+1}</span>'
+                      f'<span class="d_dfn">Sens de {word} proche de '
+                      f'<a class="d_rvh" href="/definition/{fold_accents(link)}">{link}</a>.</span>'
+                      f'{examples}</div>')
+    return (f'<div class="b"><h3>{word}<span class="d_cat">, {category}</span></h3>'
+            f'<div class="d_ptma">{"".join(senses)}</div></div>')
+
+
+def make_page_chrome(rng, vocabulary, num_scripts=12, num_links=200):
+    """Return the scripts of the head and the navigation of a page, which make up most of the pages of the dictionary.
+    """
+    scripts = ''.join(f'<script>window.dataLayer{ind}=[{",".join(str(rng.random()) for _ in range(100))}];</script>'
+                      f'<link rel="stylesheet" href="/assets/css/style{ind}.css"/>' for ind in range(num_scripts))
+    links = ''.join(f'<li><a href="/definition/{fold_accents(word)}">{word}</a></li>'
+                    for word in rng.sample(vocabulary, min(num_links, len(vocabulary))))
+    return scripts, f'<nav><ul class="menu">{links}</ul></nav>'
+
+
+def make_page(rng, word_path, words, vocabulary, num_definitions=(1, 4), num_examples=(0, 5)):
+    """Return the HTML of a page shaped like the ones of dictionnaire.lerobert.com:
+    <body><div class="ws-c"><main><section class="def"><div class="b">... with examples (class="d_xpl").
+    """
+    scripts, navigation = make_page_chrome(rng, vocabulary)
+    definitions = []
+    for _ in range(rng.randint(*num_definitions)):
+        word = rng.choice(words)
+        definitions.append(make_definition(rng, word, rng.choice(CATEGORIES), vocabulary,
+                                           [rng.randint(*num_examples) for _ in range(3)]))
+    return ('<!DOCTYPE html><html lang="fr"><head><meta charset="utf-8"/>'
+            f'<meta property="og:url" content="https://dictionnaire.lerobert.com/definition/{word_path}"/>'
+            f'<title>{words[0]} - Définitions</title>{scripts}</head><body><header>Le Robert{navigation}</header>'
+            '<div class="ws-c"><main><section class="def">'
+            + '\n'.join(definitions) +
+            '</section><section class="ws-ad">publicité</section></main></div>'
+            f'<footer>dictionnaire{navigation}</footer></body></html>')
+
+
+def generate_corpus(html_path, num_pages=200, seed=0, **page_kwargs):
+    """Write num_pages synthetic pages to html_path and return their word_paths.
+    Words sharing a word_path without diacritics are defined on the same page, as in the dictionary.
+    """
+    rng = random.Random(seed)
+    pages = {}
+    while len(pages) < num_pages:
+        word = make_word(rng)
+        pages.setdefault(fold_accents(word), set()).add(word)
+    vocabulary = sorted(word for words in pages.values() for word in words)
+    os.makedirs(html_path, exist_ok=True)
+    for word_path, words in pages.items():
+        with open(Path(html_path) / Path(f'{word_path}.html'), 'w', encoding='utf-8') as f:
+            f.write(make_page(rng, word_path, sorted(words), vocabulary, **page_kwargs))
+    return sorted(pages)
+
+
+class StubTagger:
+    """Stand-in for treetaggerwrapper.TreeTagger with the same interface (prepronly, tagonly, SGML tags)
+    that needs no TreeTagger installation: words are split with a regular expression and lemmas drop a plural 's'.
+    """
+    dummysequence = "This is a dummy sentence to ensure data is flushed."
+    removesgml = True
+
+    def __init__(self, **tagger_kwargs):
+        pass
+
+    def tag_text(self, text, prepronly=False, tagonly=False, **kwargs):
+        if tagonly:
+            lines = text.split('\n') if isinstance(text, str) else text
+        else:
+            lines = re_token.findall(text if isinstance(text, str) else '\n'.join(text))
+        if prepronly:
+            return lines
+        tags = []
+        for line in lines:
+            if (not line) or (line.startswith('<') and line.endswith('>')):
+                continue
+            word = line.lower()
+            lemma = word[:-1] if (len(word) > 3) and word.endswith('s') else word
+            pos = ARTICLES.get(word, 'NOM' if word[0].isalpha() else 'PUN')
+            tags.append(f'{line}\t{pos}\t{lemma}')
+        return tags
+
+
+def install_stub_tagger():
+    """Replace TreeTagger with StubTagger for the modules importing treetaggerwrapper afterwards.
+    """
+    import treetaggerwrapper as ttpw
+    ttpw.TreeTagger = StubTagger
+
+
+def save_tiny_model(model_path, texts, vocab_size=2000, hidden_size=64, num_layers=2, seed=0):
+    """Train a Unigram tokenizer on texts and save it with a randomly initialised XLM-RoBERTa model,
+    so that load_pretrained(model_path) loads them like the ones of the Hugging Face hub.
+    """
+    import torch
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors, trainers, decoders
+    from transformers import PreTrainedTokenizerFast, XLMRobertaConfig, XLMRobertaModel
+    tokenizer = Tokenizer(models.Unigram())
+    tokenizer.normalizer = normalizers.NFKC()
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Metaspace()
+    trainer = trainers.UnigramTrainer(vocab_size=vocab_size,
+                                      special_tokens=['<s>', '<pad>', '</s>', '<unk>'],
+                                      unk_token='<unk>')
+    tokenizer.train_from_iterator(texts, trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single='<s> $A </s>',
+                                                             pair='<s> $A </s> </s> $B </s>',
+                                                             special_tokens=[('<s>', 0), ('</s>', 2)])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token='<s>', eos_token='</s>',
+                                        pad_token='<pad>', unk_token='<unk>', model_max_length=512)
+    torch.manual_seed(seed)
+    config = XLMRobertaConfig(vocab_size=len(tokenizer),
+                              hidden_size=hidden_size,
+                              num_hidden_layers=num_layers,
+                              num_attention_heads=4,
+                              intermediate_size=4*hidden_size,
+                              max_position_embeddings=514,
+                              pad_token_id=tokenizer.pad_token_id)
+    tokenizer.save_pretrained(model_path)
+    XLMRobertaModel(config).eval().save_pretrained(model_path)
@@ -0,0 +1,390 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.corpus import generate_corpus, install_stub_tagger, save_tiny_model, StubTagger
+
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+ORIGINAL_HTML_PATH = './assets/html/original/'
+PROCESSED_HTML_PATH = './assets/html/processed/'
+SECTION_HTML_PATH = './assets/html/sections/'
+TEMPLATE_PATH = './assets/templates/'
+STORE_PATH = './assets/embedding_stores/'
+LEXICON_PATH = './assets/lexicon/'
+# pages whose examples are embedded one forward pass per example, which is slow
+PER_EXAMPLE_PAGES = 20
+PERCENTILES = (50, 95, 99)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Timings:
+    """Per-stage throughput: the number of items processed by a stage, the seconds it took and items per second.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def measure(self, name, unit, function, *args, **kwargs):
+        """Call function, which returns the number of items it has processed, and record its throughput.
+        """
+        time_start = time.perf_counter()
+        num_items = function(*args, **kwargs)
+        seconds = time.perf_counter() - time_start
+        self.stages[name] = {'items': num_items,
+                             'unit': unit,
+                             'seconds': round(seconds, 4),
+                             'items_per_sec': round(num_items/seconds, 2) if seconds > 0 else None}
+        print(f'{name}: {num_items} {unit} in {seconds:.2f}s ({num_items/max(seconds, 1e-9):.1f} {unit}/s)')
+
+
+def read_examples(word_paths, html_path):
+    # example tags (class="d_xpl") and the header words of their definitions
+    import lerobert.processing as lrp
+    examples = []
+    for word_path in word_paths:
+        for def_tag in lrp.find_definitions(lrp.read_html_file(word_path, html_path=html_path)):
+            words = lrp.get_definition_header_data(def_tag)['words']
+            for example_tag in def_tag.find_all(True, class_='d_xpl'):
+                examples.append((example_tag, words))
+    return examples
+
+
+def benchmark_read_definitions(word_paths, read_function_name, **kwargs):
+    import lerobert.processing as lrp
+    read_function = getattr(lrp, read_function_name)
+    for word_path in word_paths:
+        lrp.find_definitions(read_function(word_path, html_path=ORIGINAL_HTML_PATH, **kwargs))
+    return len(word_paths)
+
+
+def benchmark_analyze_structure(word_paths):
+    import lerobert.processing as lrp
+    counter = lrp.analyze_structure(word_paths, html_path=ORIGINAL_HTML_PATH, section_path=SECTION_HTML_PATH,
+                                    processes=False)
+    return counter.num_pages
+
+
+def benchmark_wrap_words(examples, tagger):
+    import lerobert.processing as lrp
+    for example_tag, words in examples:
+        lrp.wrap_words(str(example_tag), tagger, words, words)
+    return len(examples)
+
+
+def benchmark_process_html(word_paths, tagger):
+    import lerobert.processing as lrp
+    for word_path in word_paths:
+        lrp.process_html(word_path, tagger, orig_html_path=ORIGINAL_HTML_PATH, proc_html_path=PROCESSED_HTML_PATH)
+    return len(word_paths)
+
+
+def benchmark_map_words(word_paths):
+    import lerobert.processing as lrp
+    word_map = {}
+    for word_path in word_paths:
+        for word, page_word_paths in lrp.map_words(word_path, html_path=PROCESSED_HTML_PATH).items():
+            word_map.setdefault(word, {}).update(page_word_paths)
+    with open('./assets/word_map.json', 'w', encoding='utf-8') as f:
+        json.dump(word_map, f, indent=4)
+    return len(word_paths)
+
+
+def benchmark_build_lexicon():
+    from lerobert.lexicon import convert_word_map_to_lexicon
+    convert_word_map_to_lexicon('./assets/word_map.json', LEXICON_PATH)
+    with open(Path(LEXICON_PATH) / Path('index.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)['keys']
+
+
+def benchmark_compile_templates(word_paths):
+    import lerobert.processing as lrp
+    for word_path in word_paths:
+        lrp.compile_templates_html_file(word_path, html_path=PROCESSED_HTML_PATH, template_path=TEMPLATE_PATH)
+    return len(word_paths)
+
+
+def benchmark_embed_per_example(examples, tokenizer, model):
+    import lerobert.processing as lrp
+    for example_tag, _ in examples:
+        lrp.compute_embeddings_html_tag(example_tag, tokenizer, model)
+    return len(examples)
+
+
+def benchmark_embed_batched(word_paths, tokenizer, model, store_path, batch_size):
+    import lerobert.processing as lrp
+    num_examples = 0
+
+    def items():
+        nonlocal num_examples
+        for word_path, embeddings in lrp.compute_embeddings_batched(word_paths, tokenizer, model,
+                                                                    html_path=PROCESSED_HTML_PATH,
+                                                                    batch_size=batch_size):
+            num_examples += embeddings.shape[0]
+            yield word_path, embeddings
+
+    lrp.write_embedding_store(items(), store_path)
+    return num_examples
+
+
+def make_payloads(examples, num_payloads, model_index, seed=0, context=(1, 6)):
+    """Return /definitions payloads: a few examples joined into one text with a header word selected in one of them.
+    """
+    rng = random.Random(seed)
+    selectable = []
+    for example_tag, _ in examples:
+        text = example_tag.get_text()
+        word_tag = example_tag.find(True, class_='word')
+        if word_tag is None:
+            continue
+        # the position of the word is the length of the strings before it
+        offset = 0
+        for string in example_tag.find_all(string=True):
+            if string.parent is word_tag:
+                break
+            offset += len(string)
+        selectable.append((text, offset, offset + len(word_tag.get_text())))
+    texts = [text for text, _, _ in selectable]
+    payloads = []
+    for _ in range(num_payloads):
+        text, start, end = rng.choice(selectable)
+        before = ' '.join(rng.choice(texts) for _ in range(rng.randint(context[0], context[1]) - 1))
+        if before:
+            before += ' '
+        payloads.append({'text': before + text + ' ' + rng.choice(texts),
+                         'selection_start': len(before) + start,
+                         'selection_end': len(before) + end,
+                         'model_index': model_index})
+    return payloads
+
+
+def benchmark_definitions_response(payloads, tokenizer, model):
+    # tagging, lookups, scoring and rendering of /definitions in the process, without the HTTP layer
+    import main
+    import lerobert.processing as lrp
+    requests = [SimpleNamespace(match_mode='exact', rank=None, top_k=None, **payload) for payload in payloads]
+    embeddings = [lrp.compute_embeddings_selected_text(request, tokenizer, model) for request in requests]
+    embedding_store = main.get_embedding_store(requests[0].model_index)
+    time_start = time.perf_counter()
+    for request, selected_text_embeddings in zip(requests, embeddings):
+        main.generate_definitions_response(request, main.tagger, selected_text_embeddings, embedding_store)
+    return len(requests), time.perf_counter() - time_start
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, env, timeout=120.0):
+    """Start benchmarks.server in the current directory and wait until it answers.
+    """
+    import httpx
+    env = {**os.environ,
+           'PYTHONPATH': os.pathsep.join([str(REPO_PATH), os.environ.get('PYTHONPATH', '')]),
+           **env}
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.server', '--port', str(port)], env=env)
+    time_start = time.perf_counter()
+    while time.perf_counter() - time_start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f'the server exited with code {process.returncode}')
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/models', timeout=1.0).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('the server did not start in time')
+
+
+async def run_load(url, payloads, concurrency):
+    """Send payloads to url from concurrency clients at once and return latencies in ms and status codes.
+    """
+    import httpx
+    latencies = []
+    status_codes = {}
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+
+    async def client_loop(client):
+        while not queue.empty():
+            payload = queue.get_nowait()
+            time_start = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                status_code = response.status_code
+            except httpx.HTTPError as e:
+                status_code = type(e).__name__
+            if status_code == 200:
+                latencies.append((time.perf_counter() - time_start)*1000)
+            status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        time_start = time.perf_counter()
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+        seconds = time.perf_counter() - time_start
+    return latencies, status_codes, seconds
+
+
+def benchmark_server(payloads, concurrency_levels, model_index, warmup=10):
+    """Latency percentiles of /definitions on a local uvicorn instance for each number of concurrent clients.
+    """
+    import numpy as np
+    port = free_port()
+    process = start_server(port, {'LEROBERT_PRELOAD_MODELS': str(model_index)})
+    url = f'http://127.0.0.1:{port}/definitions'
+    results = {}
+    try:
+        asyncio.run(run_load(url, payloads[:warmup], 1))
+        for concurrency in concurrency_levels:
+            latencies, status_codes, seconds = asyncio.run(run_load(url, payloads, concurrency))
+            result = {'requests': len(payloads),
+                      'status_codes': status_codes,
+                      'seconds': round(seconds, 4),
+                      'requests_per_sec': round(len(latencies)/seconds, 2)}
+            if latencies:
+                result['mean_ms'] = round(float(np.mean(latencies)), 3)
+                for percentile in PERCENTILES:
+                    result[f'p{percentile}_ms'] = round(float(np.percentile(latencies, percentile)), 3)
+            results[str(concurrency)] = result
+            print(f'/definitions x{concurrency}: '
+                  + ', '.join(f'{key}={value}' for key, value in result.items() if key.endswith('_ms'))
+                  + f', {result["requests_per_sec"]} req/s, {status_codes}')
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def compare_results(baseline, results):
+    """Print the ratios of throughputs (higher is better) and latencies (lower is better) of two runs.
+    """
+    print(f'baseline {baseline.get("commit")} -> {results.get("commit")}')
+    for name, stage in results['stages'].items():
+        baseline_stage = baseline.get('stages', {}).get(name)
+        if baseline_stage and baseline_stage.get('items_per_sec') and stage.get('items_per_sec'):
+            print(f'  {name}: {stage["items_per_sec"]/baseline_stage["items_per_sec"]:.2f}x throughput')
+    for concurrency, result in results.get('server', {}).items():
+        baseline_result = baseline.get('server', {}).get(concurrency, {})
+        ratios = [f'{key} {result[key]/baseline_result[key]:.2f}x' for key in result
+                  if key.endswith('_ms') and baseline_result.get(key)]
+        if ratios:
+            print(f'  /definitions x{concurrency}: ' + ', '.join(ratios))
+
+
+def run(args):
+    import torch
+    from lerobert.backends import load_pretrained
+    from lerobert.build import MODEL_NAMES
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'workdir')}
+    results = {'commit': git_commit(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'torch': torch.__version__,
+               'machine': platform.machine(),
+               'cpu_count': os.cpu_count(),
+               'config': config}
+    timings = Timings()
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    # the synthetic corpus, its assets and the tiny model live in the work directory, which the server uses too
+    os.makedirs('./assets/css/', exist_ok=True)
+    with open('./assets/index.html', 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html><html><body></body></html>')
+    timings.measure('generate_corpus', 'pages', lambda: len(generate_corpus(ORIGINAL_HTML_PATH,
+                                                                             num_pages=args.pages,
+                                                                             seed=args.seed)))
+    word_paths = sorted(item[:-5] for item in os.listdir(ORIGINAL_HTML_PATH) if item.endswith('.html'))
+    # whole pages, the section with the definitions only (saved) and the saved sections
+    timings.measure('parse_pages', 'pages', benchmark_read_definitions, word_paths, 'read_html_file')
+    timings.measure('read_sections', 'pages', benchmark_read_definitions, word_paths, 'read_definitions_section',
+                    section_path=SECTION_HTML_PATH)
+    timings.measure('read_saved_sections', 'pages', benchmark_read_definitions, word_paths,
+                    'read_definitions_section', section_path=SECTION_HTML_PATH)
+    timings.measure('analyze_structure', 'pages', benchmark_analyze_structure, word_paths)
+    tagger = StubTagger()
+    original_examples = read_examples(word_paths, ORIGINAL_HTML_PATH)
+    timings.measure('wrap_words', 'examples', benchmark_wrap_words, original_examples, tagger)
+    timings.measure('process_html', 'pages', benchmark_process_html, word_paths, tagger)
+    timings.measure('map_words', 'pages', benchmark_map_words, word_paths)
+    timings.measure('build_lexicon', 'keys', benchmark_build_lexicon)
+    timings.measure('compile_templates', 'pages', benchmark_compile_templates, word_paths)
+
+    model_name = MODEL_NAMES[args.model_index]
+    examples = read_examples(word_paths, PROCESSED_HTML_PATH)
+    # a local directory named like the model is loaded instead of the one of the hub
+    save_tiny_model(model_name, [example_tag.get_text() for example_tag, _ in examples],
+                    hidden_size=args.hidden_size, num_layers=args.layers, seed=args.seed)
+    tokenizer, model = load_pretrained(model_name)
+    sample = read_examples(word_paths[:PER_EXAMPLE_PAGES], PROCESSED_HTML_PATH)
+    timings.measure('embed_per_example', 'examples', benchmark_embed_per_example, sample, tokenizer, model)
+    timings.measure('embed_batched', 'examples', benchmark_embed_batched, word_paths, tokenizer, model,
+                    Path(STORE_PATH) / Path(model_name), args.batch_size)
+
+    payloads = make_payloads(examples, args.requests, args.model_index, seed=args.seed)
+    num_requests, seconds = benchmark_definitions_response(payloads, tokenizer, model)
+    timings.stages['definitions_response'] = {'items': num_requests,
+                                              'unit': 'requests',
+                                              'seconds': round(seconds, 4),
+                                              'items_per_sec': round(num_requests/seconds, 2)}
+    print(f'definitions_response: {num_requests} requests in {seconds:.2f}s ({num_requests/seconds:.1f} requests/s)')
+    results['stages'] = timings.stages
+    if not args.no_server:
+        results['server'] = benchmark_server(payloads, args.concurrency, args.model_index)
+    return results
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.run [--pages N] [--output FILE] [--baseline FILE] [--no-server]
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run',
+                                     description='Measure the throughput of the build stages and the latency of '
+                                                 '/definitions on a synthetic dictionary with a tiny random model.')
+    parser.add_argument('--pages', type=int, default=200, help='number of synthetic pages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model-index', type=int, default=2, help='index of the model named after the tiny one')
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, help='torch threads (all cores by default)')
+    parser.add_argument('--requests', type=int, default=200, help='number of /definitions requests per level')
+    parser.add_argument('--concurrency', type=int, nargs='*', default=[1, 4, 16], help='concurrent clients')
+    parser.add_argument('--no-server', action='store_true', help='skip the uvicorn latency benchmark')
+    parser.add_argument('--workdir', help='directory of the generated assets (a temporary one by default)')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON results of another run to compare with')
+    args = parser.parse_args()
+    output = Path(args.output).resolve()
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+    # main.py creates its tagger when it is imported
+    install_stub_tagger()
+    with tempfile.TemporaryDirectory(prefix='lerobert-benchmark-') as tmp_path:
+        workdir = Path(args.workdir or tmp_path).resolve()
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        results = run(args)
+        os.chdir(REPO_PATH)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f'results written to {output}')
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), results)
@@ -0,0 +1,17 @@
+import argparse
+
+from benchmarks.corpus import install_stub_tagger
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.server --port PORT, run from the directory of the benchmark assets
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.server',
+                                     description='Serve main:app with the stub tagger on the assets of the current directory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    # main creates its tagger when it is imported
+    install_stub_tagger()
+    import uvicorn
+    import main
+    uvicorn.run(main.app, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,249 @@
+import os
+import json
+import math
+from pathlib import Path
+import numpy as np
+import torch
+
+
+# rows of an index: (name id of the word_path version, def_ind, example_ind)
+META_COLUMNS = 3
+
+
+def normalize_rows(vectors, eps=1e-8):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), eps)
+
+
+def assign_lists(vectors, centroids, batch_size=4096):
+    """Return the index of the closest centroid (highest dot product) of each vector.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start+batch_size], dtype=np.float32)
+        assignments[start:start+batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, num_lists, iterations=20, seed=0):
+    """Spherical k-means: centroids of unit length maximising the dot products with their vectors.
+    Empty lists get a random vector as their new centroid.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = normalize_rows(vectors)
+    num_lists = min(num_lists, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_lists(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=num_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+        centroids[nonempty] = normalize_rows(sums)
+        if not nonempty.all():
+            centroids[~nonempty] = vectors[rng.choice(len(vectors), int((~nonempty).sum()))]
+    return centroids
+
+
+class AnnIndex:
+    """Inverted file (IVF) index of example embeddings: vectors are assigned to the closest of num_lists centroids
+    and a query only scores the vectors of the nprobe lists whose centroids are closest to it.
+    Vectors, their lists and their (word_path, def_ind, example_ind) are memory-mapped files. Rows written by
+    the last compaction are sorted by list, so each list is one contiguous slice; rows inserted since then
+    form an unsorted tail which is filtered by list at query time.
+    A word_path is replaced by inserting it again: rows of its previous version are skipped until compaction.
+    """
+    def __init__(self, index_path):
+        index_path = Path(index_path)
+        with open(index_path / Path('index.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.dim = index['dim']
+        self.rows = index['rows']
+        self.sorted_rows = index['sorted_rows']
+        self.names = index['names']
+        self.live = index['live']
+        self.centroids = np.load(index_path / Path('centroids.npy'))
+        self.list_offsets = np.load(index_path / Path('list_offsets.npy'))
+        # name ids of replaced or removed versions of word_paths are dead
+        self.alive = np.zeros(len(self.names) + 1, dtype=bool)
+        self.alive[list(self.live.values())] = True
+        if self.rows > 0:
+            self.vectors = np.memmap(index_path / Path('vectors.bin'), dtype=np.float32, mode='r',
+                                     shape=(self.rows, self.dim))
+            self.meta = np.memmap(index_path / Path('meta.bin'), dtype=np.int32, mode='r',
+                                  shape=(self.rows, META_COLUMNS))
+            self.lists = np.memmap(index_path / Path('lists.bin'), dtype=np.int32, mode='r', shape=(self.rows,))
+        else:
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+            self.meta = np.empty((0, META_COLUMNS), dtype=np.int32)
+            self.lists = np.empty(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.live)
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def search(self, embedding, k=10, nprobe=8):
+        """Return (word_path, def_ind, example_ind, score) of the k examples closest to an embedding
+        (cosine similarity) among the vectors of the nprobe closest lists, the best first.
+        """
+        if isinstance(embedding, torch.Tensor):
+            embedding = embedding.detach().cpu().numpy()
+        query = normalize_rows(embedding.reshape(1, -1))[0]
+        nprobe = min(nprobe, self.num_lists)
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe] if nprobe < self.num_lists \
+            else np.arange(self.num_lists)
+        row_inds = [np.arange(self.list_offsets[probe], self.list_offsets[probe+1]) for probe in probes]
+        if self.rows > self.sorted_rows:
+            tail_lists = np.asarray(self.lists[self.sorted_rows:])
+            row_inds.append(self.sorted_rows + np.flatnonzero(np.isin(tail_lists, probes)))
+        row_inds = np.concatenate(row_inds) if row_inds else np.empty(0, dtype=np.int64)
+        row_inds = np.sort(row_inds)
+        meta = np.asarray(self.meta[row_inds])
+        alive = self.alive[meta[:, 0]]
+        row_inds, meta = row_inds[alive], meta[alive]
+        if len(row_inds) == 0:
+            return []
+        scores = np.asarray(self.vectors[row_inds]) @ query
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [(self.names[meta[ind, 0]], int(meta[ind, 1]), int(meta[ind, 2]), float(scores[ind]))
+                for ind in best]
+
+
+def load_ann_index(index_path):
+    """Load an index written by create_ann_index() and update_ann_index().
+    """
+    return AnnIndex(index_path)
+
+
+def default_num_lists(num_rows):
+    # about sqrt(n) lists of sqrt(n) vectors
+    return max(1, int(math.sqrt(num_rows)))
+
+
+def write_index_json(index, index_path):
+    with open(Path(index_path) / Path('index.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(Path(index_path) / Path('index.json.tmp'), Path(index_path) / Path('index.json'))
+
+
+def create_ann_index(index_path, training_vectors, num_lists=None, iterations=20, seed=0):
+    """Create an empty index whose centroids are trained on a sample of the vectors to be indexed.
+    """
+    index_path = Path(index_path)
+    os.makedirs(index_path, exist_ok=True)
+    training_vectors = np.asarray(training_vectors, dtype=np.float32)
+    centroids = train_centroids(training_vectors,
+                                num_lists or default_num_lists(len(training_vectors)),
+                                iterations=iterations,
+                                seed=seed)
+    for filename in ('vectors.bin', 'meta.bin', 'lists.bin'):
+        open(index_path / Path(filename), 'wb').close()
+    # np.save() adds .npy to filenames without it
+    with open(index_path / Path('centroids.npy'), 'wb') as f:
+        np.save(f, centroids.astype(np.float32))
+    with open(index_path / Path('list_offsets.npy'), 'wb') as f:
+        np.save(f, np.zeros(len(centroids) + 1, dtype=np.int64))
+    write_index_json({'dim': int(centroids.shape[1]), 'rows': 0, 'sorted_rows': 0, 'names': [], 'live': {}},
+                     index_path)
+
+
+def update_ann_index(items, index_path, remove=(), max_tail=0.25, max_garbage=0.25):
+    """Insert (word_path, embeddings, def_inds) items into an index, replacing previous versions of the
+    word_paths, and drop the word_paths in remove. Rows are appended to the memory-mapped files and
+    index.json is replaced last, so readers of the previous version keep working.
+    The index is compacted (rows sorted by list, dead rows dropped) when the unsorted tail
+    takes more than max_tail of the rows or dead rows take more than max_garbage.
+    """
+    index_path = Path(index_path)
+    with open(index_path / Path('index.json'), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    centroids = np.load(index_path / Path('centroids.npy'))
+    dim = index['dim']
+    num_rows = index['rows']
+    live = index['live']
+    files = {filename: open(index_path / Path(filename), 'r+b')
+             for filename in ('vectors.bin', 'meta.bin', 'lists.bin')}
+    try:
+        # rows appended by an interrupted update are not in the index
+        for filename, row_size in (('vectors.bin', 4*dim), ('meta.bin', 4*META_COLUMNS), ('lists.bin', 4)):
+            files[filename].truncate(num_rows * row_size)
+            files[filename].seek(0, os.SEEK_END)
+        for word_path, embeddings, def_inds in items:
+            if isinstance(embeddings, torch.Tensor):
+                embeddings = embeddings.detach().cpu().numpy()
+            vectors = normalize_rows(embeddings)
+            assert vectors.shape[1] == dim, f'{word_path}: expected {dim} dimensions, got {vectors.shape[1]}'
+            name_id = len(index['names'])
+            index['names'].append(word_path)
+            live[word_path] = name_id
+            meta = np.stack([np.full(len(vectors), name_id),
+                             np.asarray(def_inds, dtype=np.int64),
+                             np.arange(len(vectors))], axis=1).astype(np.int32)
+            files['vectors.bin'].write(np.ascontiguousarray(vectors).tobytes())
+            files['meta.bin'].write(meta.tobytes())
+            files['lists.bin'].write(assign_lists(vectors, centroids).tobytes())
+            num_rows += len(vectors)
+    finally:
+        for f in files.values():
+            f.close()
+    for word_path in remove:
+        live.pop(word_path, None)
+    index['rows'] = num_rows
+    write_index_json(index, index_path)
+    ann_index = AnnIndex(index_path)
+    num_dead = int((~ann_index.alive[np.asarray(ann_index.meta[:, 0])]).sum()) if num_rows else 0
+    if (num_rows - index['sorted_rows'] > max_tail * num_rows) or (num_dead > max_garbage * num_rows):
+        compact_ann_index(index_path)
+
+
+def compact_ann_index(index_path):
+    """Rewrite the live rows of an index sorted by list and renumber the word_paths.
+    """
+    index_path = Path(index_path)
+    ann_index = AnnIndex(index_path)
+    live_rows = np.flatnonzero(ann_index.alive[np.asarray(ann_index.meta[:, 0])]) if ann_index.rows else \
+        np.empty(0, dtype=np.int64)
+    lists = np.asarray(ann_index.lists[live_rows])
+    order = live_rows[np.argsort(lists, kind='stable')]
+    counts = np.bincount(lists, minlength=ann_index.num_lists)
+    names = sorted(ann_index.live)
+    name_ids = np.zeros(len(ann_index.names) + 1, dtype=np.int32)
+    for new_id, word_path in enumerate(names):
+        name_ids[ann_index.live[word_path]] = new_id
+    with open(index_path / Path('vectors.bin.tmp'), 'wb') as vectors_file, \
+            open(index_path / Path('meta.bin.tmp'), 'wb') as meta_file, \
+            open(index_path / Path('lists.bin.tmp'), 'wb') as lists_file:
+        for start in range(0, len(order), 65536):
+            rows = order[start:start+65536]
+            meta = np.asarray(ann_index.meta[rows])
+            meta[:, 0] = name_ids[meta[:, 0]]
+            vectors_file.write(np.ascontiguousarray(ann_index.vectors[rows]).tobytes())
+            meta_file.write(meta.tobytes())
+            lists_file.write(np.asarray(ann_index.lists[rows]).tobytes())
+    with open(index_path / Path('list_offsets.npy.tmp'), 'wb') as f:
+        np.save(f, np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    for filename in ('vectors.bin', 'meta.bin', 'lists.bin', 'list_offsets.npy'):
+        os.replace(index_path / Path(f'{filename}.tmp'), index_path / Path(filename))
+    write_index_json({'dim': ann_index.dim,
+                      'rows': len(order),
+                      'sorted_rows': len(order),
+                      'names': names,
+                      'live': {word_path: ind for ind, word_path in enumerate(names)}},
+                     index_path)
+
+
+def sample_store_rows(embedding_store, max_rows=65536, seed=0):
+    """Return a random sample of the live rows of an embedding store for training centroids.
+    """
+    rows = [np.arange(row_start, row_start + num_rows) for row_start, num_rows in embedding_store.offsets.values()]
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    if len(rows) > max_rows:
+        rows = np.sort(np.random.default_rng(seed).choice(rows, max_rows, replace=False))
+    return embedding_store.rows(rows)
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import inspect
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+import torch
+
+from lerobert.processing import compute_embeddings_selected_text
+
+
+BACKENDS = ('fp32', 'int8', 'onnx')
+
+# selections used to compare backends: words with several senses in different contexts
+CHECK_EXAMPLES = [
+    ('Le médecin lui a demandé de tirer la langue.', 'langue'),
+    ('Elle parle couramment la langue de Molière.', 'langue'),
+    ('Une fine langue de terre sépare les deux lacs.', 'langue'),
+    ('La pêche à la ligne est interdite dans cet étang.', 'pêche'),
+    ('Il a mangé une pêche bien mûre.', 'pêche'),
+    ('Il a la pêche ce matin !', 'pêche'),
+    ('Le train part de la gare à midi.', 'train'),
+    ('Il mène grand train depuis son héritage.', 'train'),
+    ('Elle est en train de lire.', 'train'),
+    ('Le chat dort sur le canapé.', 'chat'),
+    ('Ouvre la fenêtre de discussion du chat.', 'chat'),
+    ('Ils ont fait une partie de cartes.', 'partie'),
+]
+
+
+def load_pretrained(model_name):
+    """Load a tokenizer and a model in evaluation mode from the Hugging Face hub or a local path.
+    """
+    from transformers import AutoTokenizer, AutoModel
+    return AutoTokenizer.from_pretrained(model_name), AutoModel.from_pretrained(model_name).eval()
+
+
+def quantize_int8(model):
+    """Apply torch dynamic int8 quantization to the linear layers of a model.
+    """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class LastHiddenState(torch.nn.Module):
+    """Wrap a transformers model so that it is traced with keyword arguments and returns a single tensor.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+def export_onnx(model, onnx_file, opset_version=14):
+    """Export a model with dynamic batch and sequence axes to an ONNX graph returning the last hidden states.
+    """
+    os.makedirs(Path(onnx_file).parent, exist_ok=True)
+    input_ids = torch.ones((1, 8), dtype=torch.long)
+    attention_mask = torch.ones((1, 8), dtype=torch.long)
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # newer versions of torch export with dynamo by default
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(model).eval(),
+                          (input_ids, attention_mask),
+                          str(onnx_file),
+                          input_names=['input_ids', 'attention_mask'],
+                          output_names=['last_hidden_state'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'last_hidden_state': {0: 'batch', 1: 'sequence'}},
+                          opset_version=opset_version,
+                          **kwargs)
+
+
+class OnnxModel:
+    """Run an exported ONNX graph with ONNX Runtime. Called like a transformers model:
+    model(input_ids=..., attention_mask=...)[0] is the tensor of last hidden states.
+    """
+    def __init__(self, onnx_file, intra_op_num_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        self.session = ort.InferenceSession(str(onnx_file), options, providers=['CPUExecutionProvider'])
+        self.nbytes = os.path.getsize(onnx_file)
+
+    def __call__(self, input_ids, attention_mask=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        outputs = self.session.run(['last_hidden_state'],
+                                   {'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()})
+        return (torch.from_numpy(outputs[0]),)
+
+    def eval(self):
+        return self
+
+
+def load_backend(model_name, backend='fp32', onnx_path='./assets/onnx/'):
+    """Load a tokenizer and a model run by a backend: 'fp32' (eager PyTorch),
+    'int8' (torch dynamic quantization) or 'onnx' (ONNX Runtime, the graph is exported on first use).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown backend {backend}, expected one of {BACKENDS}')
+    tokenizer, model = load_pretrained(model_name)
+    if backend == 'int8':
+        model = quantize_int8(model)
+    elif backend == 'onnx':
+        onnx_file = Path(onnx_path) / Path(model_name) / Path('model.onnx')
+        if not os.path.isfile(onnx_file):
+            export_onnx(model, onnx_file)
+        model = OnnxModel(onnx_file)
+    return tokenizer, model
+
+
+def parse_model_backends(setting, model_names):
+    """Return the backend of each model from a setting like LEROBERT_MODEL_BACKENDS: '0=int8,1=onnx'
+    gives backends to models by their indices in model_names, the other models run in 'fp32'.
+    """
+    model_backends = {model_name: 'fp32' for model_name in model_names}
+    for item in setting.split(','):
+        if item.strip():
+            model_index, backend = item.split('=')
+            if backend.strip() not in BACKENDS:
+                raise ValueError(f'unknown backend {backend.strip()}, expected one of {BACKENDS}')
+            model_backends[model_names[int(model_index)]] = backend.strip()
+    return model_backends
+
+
+def check_backend(tokenizer, model, baseline_model, examples=CHECK_EXAMPLES):
+    """Compare a backend with the fp32 baseline on a fixed set of selections:
+    cosine scores between all pairs of selections and the latency per selection.
+    """
+    payloads = []
+    for text, word in examples:
+        selection_start = text.index(word)
+        payloads.append(SimpleNamespace(text=text, selection_start=selection_start,
+                                        selection_end=selection_start+len(word)))
+    embeddings = {}
+    latency_ms = {}
+    for name, current_model in [('baseline', baseline_model), ('backend', model)]:
+        # warm up
+        compute_embeddings_selected_text(payloads[0], tokenizer, current_model)
+        time_start = time.perf_counter()
+        embeddings[name] = torch.stack([compute_embeddings_selected_text(payload, tokenizer, current_model)
+                                        for payload in payloads])
+        latency_ms[name] = (time.perf_counter() - time_start) * 1000 / len(payloads)
+    scores = {}
+    for name, current_embeddings in embeddings.items():
+        normalized = torch.nn.functional.normalize(current_embeddings, dim=1)
+        scores[name] = (normalized @ normalized.T).numpy()
+    score_diffs = np.abs(scores['backend'] - scores['baseline'])
+    # ranking agreement: for each selection, is the closest other selection the same?
+    np.fill_diagonal(scores['baseline'], -np.inf)
+    np.fill_diagonal(scores['backend'], -np.inf)
+    top1_agreement = np.mean(scores['baseline'].argmax(1) == scores['backend'].argmax(1))
+    embedding_similarity = torch.nn.functional.cosine_similarity(embeddings['baseline'], embeddings['backend'], dim=1)
+    return {'max_score_diff': float(score_diffs.max()),
+            'mean_score_diff': float(score_diffs.mean()),
+            'min_embedding_cosine': float(embedding_similarity.min()),
+            'top1_agreement': float(top1_agreement),
+            'baseline_latency_ms': latency_ms['baseline'],
+            'backend_latency_ms': latency_ms['backend']}
+
+
+if __name__ == '__main__':
+    # python -m lerobert.backends MODEL_NAME [BACKEND ...]
+    model_name = sys.argv[1]
+    baseline_tokenizer, baseline_model = load_backend(model_name, 'fp32')
+    for backend in sys.argv[2:] or BACKENDS[1:]:
+        _, model = load_backend(model_name, backend)
+        print(backend, check_backend(baseline_tokenizer, model, baseline_model))
@@ -0,0 +1,487 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import functools
+import threading
+import concurrent.futures
+from pathlib import Path
+
+from lerobert.processing import (imap_async, TaskError, init_tagger, list_html_files, process_html, map_words,
+                                 compile_templates_html_file, compute_embeddings_batched, update_embedding_store,
+                                 load_embedding_store, convert_embedding_store, read_example_texts,
+                                 remove_definitions_section)
+from lerobert.ann import create_ann_index, update_ann_index, sample_store_rows
+from lerobert.lexicon import build_lexicon
+from lerobert.lemmas import build_lemma_table, load_page_lemmas
+from lerobert.backends import parse_model_backends
+from lerobert.formats import parse_format, parse_store_formats, get_store_format, convert_model_store
+from lerobert.static import compress_file, compress_directory, has_fresh_variants, remove_compressed_variants
+
+
+MODEL_NAMES = ["intfloat/multilingual-e5-large",
+               "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
+               "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"]
+
+ORIGINAL_HTML_PATH = './assets/html/original/'
+PROCESSED_HTML_PATH = './assets/html/processed/'
+# sections with the definitions of original pages, read instead of the pages by later passes
+SECTION_HTML_PATH = './assets/html/sections/'
+TEMPLATE_PATH = './assets/templates/'
+WORD_MAP_FILE = './assets/word_map.json'
+LEXICON_PATH = './assets/lexicon/'
+# lemmas given by TreeTagger to the forms of the examples of each page, merged into the table read by the server
+PAGE_LEMMA_PATH = './assets/lemmas/pages/'
+LEMMA_TABLE_FILE = './assets/lemmas/lemma_table.json'
+STORE_PATH = './assets/embedding_stores/'
+ANN_PATH = './assets/ann_indexes/'
+# directories of static files served with precompressed variants (besides the processed HTML)
+STATIC_PATHS = ('./assets/css/', './assets/js/')
+INDEX_FILE = './assets/index.html'
+MANIFEST_FILE = './assets/build_manifest.json'
+# inference backends of models other than 'fp32', the same setting as the server, e.g. "0=int8,1=onnx"
+MODEL_BACKENDS = os.environ.get('LEROBERT_MODEL_BACKENDS', '')
+# formats of the embedding stores of models by their indices, e.g. "0=int8,2=int8:256" (see lerobert.formats),
+# stores of the other models keep their formats, new ones are float32
+STORE_FORMATS = os.environ.get('LEROBERT_STORE_FORMATS', '')
+
+
+def hash_file(filename_path):
+    """Return the SHA-256 hex digest of the content of a file.
+    """
+    with open(filename_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def hash_html_files(word_paths, html_path):
+    """Hash saved HTML files of word_paths and return a dictionary {word_path: hash}.
+    """
+    hashes = {}
+    filename_paths = [Path(html_path) / Path(f'{word_path}.html') for word_path in word_paths]
+    for word_path, res in zip(word_paths, imap_async(hash_file, filename_paths)):
+        if not isinstance(res, TaskError):
+            hashes[word_path] = res
+    return hashes
+
+
+def remove_file(filename_path):
+    if os.path.isfile(filename_path):
+        os.remove(filename_path)
+
+
+def write_json(obj, filename_path, **kwargs):
+    """Write JSON to a temporary file and replace filename_path with it.
+    """
+    os.makedirs(Path(filename_path).parent, exist_ok=True)
+    with open(f'{filename_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(obj, f, **kwargs)
+    os.replace(f'{filename_path}.tmp', filename_path)
+
+
+class BuildManifest:
+    """Records of each stage per word_path: the hash of the stage input and stage-specific data
+    (the hash of the processed HTML, the words of the page in word_map.json, ...).
+    """
+    def __init__(self, manifest_file=MANIFEST_FILE):
+        self.manifest_file = manifest_file
+        self.stages = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                self.stages = json.load(f)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def records(self, stage):
+        """Return a copy of the records of a stage, stages running in other threads update theirs.
+        """
+        with self._lock:
+            return dict(self.stages.get(stage, {}))
+
+    def update(self, stage, removed, records):
+        with self._lock:
+            stage_records = self.stages.setdefault(stage, {})
+            for word_path in removed:
+                stage_records.pop(word_path, None)
+            stage_records.update(records)
+
+    def save(self):
+        # a snapshot of the records is written, one save at a time since saves share a temporary file
+        with self._save_lock:
+            with self._lock:
+                stages = {stage: dict(stage_records) for stage, stage_records in self.stages.items()}
+            write_json(stages, self.manifest_file)
+
+
+class Stage:
+    """A build stage: a function called with the word_paths whose input hash has changed and the word_paths
+    that have been removed. It returns {word_path: record} for the pages it has built (TaskError on failure).
+    """
+    def __init__(self, name, deps, input_function, build_function):
+        self.name = name
+        self.deps = deps
+        self.input_function = input_function
+        self.build_function = build_function
+
+
+class Build:
+    """Incremental build of the assets: download → process → (map → lemmas, templates, compress,
+    embed → ann per model).
+    Each stage only rebuilds the pages whose inputs have changed since the last build according to
+    the content hashes in the manifest, so that a change of one page rebuilds that page only.
+    Stages which don't depend on each other run in parallel.
+    """
+    def __init__(self,
+                 word_paths=None,
+                 model_names=MODEL_NAMES,
+                 download=False,
+                 force=(),
+                 tagger_kwargs=None,
+                 processes=True,
+                 manifest_file=MANIFEST_FILE,
+                 batch_size=32,
+                 model_backends=None,
+                 store_formats=None):
+        self.word_paths = set(word_paths) if word_paths else None
+        self.download_word_paths = word_paths
+        self.force = set(force)
+        self.tagger_kwargs = tagger_kwargs or {'TAGLANG': 'fr'}
+        self.processes = processes
+        self.batch_size = batch_size
+        # {model_name: backend} of the models which don't run in 'fp32', see lerobert.backends
+        self.model_backends = model_backends or {}
+        # {model_name: format} of the embedding stores, see lerobert.formats
+        self.store_formats = store_formats or {}
+        self.manifest = BuildManifest(manifest_file)
+        # forward passes use all cores, models are run one at a time
+        self._torch_lock = threading.Lock()
+        self.stages = {}
+        if download:
+            self.add_stage(Stage('download', [], None, self.download))
+        self.add_stage(Stage('process', ['download'] if download else [], self.original_hashes, self.process))
+        self.add_stage(Stage('map', ['process'], self.processed_hashes, self.map))
+        self.add_stage(Stage('lemmas', ['map'], self.processed_hashes, self.lemmas))
+        self.add_stage(Stage('templates', ['process'], self.processed_hashes, self.templates))
+        self.add_stage(Stage('compress', ['process'], self.processed_hashes, self.compress))
+        for model_name in model_names:
+            self.add_stage(Stage(f'embed:{model_name}', ['process'],
+                                 functools.partial(self.embedding_hashes, model_name),
+                                 functools.partial(self.embed, model_name)))
+            self.add_stage(Stage(f'ann:{model_name}', [f'embed:{model_name}'],
+                                 functools.partial(self.embedding_hashes, model_name),
+                                 functools.partial(self.ann, model_name)))
+
+    def add_stage(self, stage):
+        self.stages[stage.name] = stage
+
+    def select(self, word_paths):
+        return [word_path for word_path in word_paths if (self.word_paths is None) or (word_path in self.word_paths)]
+
+    # stage inputs
+    def original_hashes(self):
+        return hash_html_files(self.select(list_html_files(ORIGINAL_HTML_PATH)), ORIGINAL_HTML_PATH)
+
+    def processed_hashes(self):
+        records = self.manifest.records('process')
+        return {word_path: records[word_path]['output'] for word_path in self.select(records)}
+
+    def embedding_hashes(self, model_name):
+        # pages embedded with another backend are embedded again
+        backend = self.model_backends.get(model_name, 'fp32')
+        if backend == 'fp32':
+            return self.processed_hashes()
+        return {word_path: f'{input_hash}:{backend}' for word_path, input_hash in self.processed_hashes().items()}
+
+    # stages
+    def download(self, changed, removed):
+        from lerobert.crawler import crawl_html
+        if self.download_word_paths:
+            word_paths = self.download_word_paths
+        else:
+            with open('./assets/word_paths.txt', 'r', encoding='utf-8') as f:
+                word_paths = [line.strip() for line in f if line.strip()]
+        # pages are requested with their ETags and only rewritten if they have changed
+        crawl_html(word_paths, html_path=ORIGINAL_HTML_PATH, revalidate=True)
+        return {}
+
+    def process(self, changed, removed):
+        for word_path in removed:
+            remove_file(Path(PROCESSED_HTML_PATH) / Path(f'{word_path}.html'))
+            remove_definitions_section(word_path, section_path=SECTION_HTML_PATH)
+            remove_file(Path(PAGE_LEMMA_PATH) / Path(f'{word_path}.json'))
+        results = {}
+        for word_path, res in zip(changed, imap_async(process_html,
+                                                      changed,
+                                                      processes=self.processes,
+                                                      initializer=functools.partial(init_tagger, **self.tagger_kwargs),
+                                                      orig_html_path=ORIGINAL_HTML_PATH,
+                                                      proc_html_path=PROCESSED_HTML_PATH,
+                                                      section_path=SECTION_HTML_PATH,
+                                                      lemma_path=PAGE_LEMMA_PATH)):
+            results[word_path] = res
+        # pages processed into the same HTML don't change the stages after this one
+        output_hashes = hash_html_files([word_path for word_path, res in results.items()
+                                         if not isinstance(res, TaskError)],
+                                        PROCESSED_HTML_PATH)
+        for word_path, res in results.items():
+            if not isinstance(res, TaskError):
+                results[word_path] = {'output': output_hashes[word_path]}
+        return results
+
+    def map(self, changed, removed):
+        records = self.manifest.records('map')
+        if os.path.isfile(WORD_MAP_FILE) and (records or self.word_paths):
+            with open(WORD_MAP_FILE, 'r', encoding='utf-8') as f:
+                word_map = json.load(f)
+        else:
+            # without records, the words of a page in an existing word map are unknown
+            word_map = {}
+        page_maps = {}
+        results = {}
+        for word_path, res in zip(changed, imap_async(map_words,
+                                                      changed,
+                                                      processes=self.processes,
+                                                      html_path=PROCESSED_HTML_PATH)):
+            if isinstance(res, TaskError):
+                results[word_path] = res
+            else:
+                page_maps[word_path] = res
+                results[word_path] = {'words': sorted(res)}
+        # entries of the previous version of a page are replaced with the new ones
+        for word_path in [*removed, *page_maps]:
+            for word in records.get(word_path, {}).get('words', []):
+                if word_path in word_map.get(word, {}):
+                    del word_map[word][word_path]
+                    if not word_map[word]:
+                        del word_map[word]
+        for page_map in page_maps.values():
+            for word, word_paths in page_map.items():
+                word_map.setdefault(word, {}).update(word_paths)
+        write_json(word_map, WORD_MAP_FILE, indent=4)
+        # the server reads the memory-mapped lexicon, word_map.json is kept for patching
+        build_lexicon([word_map], LEXICON_PATH)
+        return results
+
+    def lemmas(self, changed, removed):
+        if not (changed or removed) and os.path.isfile(LEMMA_TABLE_FILE):
+            return {}
+        # the table is merged again from the lemmas of all pages, pages processed before they were saved
+        # are missing from it until they are processed again (--force process)
+        word_paths = sorted(item[:-5] for item in os.listdir(PAGE_LEMMA_PATH) if item.endswith('.json')) \
+            if os.path.isdir(PAGE_LEMMA_PATH) else []
+        page_counts = (res for res in imap_async(load_page_lemmas, word_paths, lemma_path=PAGE_LEMMA_PATH)
+                       if not isinstance(res, TaskError))
+        with open(WORD_MAP_FILE, 'r', encoding='utf-8') as f:
+            header_words = list(json.load(f))
+        num_forms = build_lemma_table(page_counts, header_words, LEMMA_TABLE_FILE)
+        print(f'lemmas: {num_forms} forms from {len(word_paths)} pages')
+        return {word_path: {} for word_path in changed}
+
+    def templates(self, changed, removed):
+        for word_path in removed:
+            remove_file(Path(TEMPLATE_PATH) / Path(f'{word_path}.json'))
+        results = {}
+        for word_path, res in zip(changed, imap_async(compile_templates_html_file,
+                                                      changed,
+                                                      processes=self.processes,
+                                                      html_path=PROCESSED_HTML_PATH,
+                                                      template_path=TEMPLATE_PATH)):
+            results[word_path] = res if isinstance(res, TaskError) else {}
+        return results
+
+    def compress(self, changed, removed):
+        for word_path in removed:
+            remove_compressed_variants(Path(PROCESSED_HTML_PATH) / Path(f'{word_path}.html'))
+        results = {}
+        for word_path, res in zip(changed, imap_async(compress_file,
+                                                      [Path(PROCESSED_HTML_PATH) / Path(f'{word_path}.html')
+                                                       for word_path in changed],
+                                                      processes=self.processes)):
+            results[word_path] = res if isinstance(res, TaskError) else {}
+        # the page, styles and scripts aren't built from word paths, their variants are refreshed when stale
+        for static_path in STATIC_PATHS:
+            if os.path.isdir(static_path):
+                compress_directory(static_path)
+        if os.path.isfile(INDEX_FILE) and not has_fresh_variants(INDEX_FILE):
+            compress_file(INDEX_FILE)
+        return results
+
+    def embed(self, model_name, changed, removed):
+        from lerobert.backends import load_backend
+        results = {}
+        store_format = self.store_formats.get(model_name)
+        if store_format is not None:
+            self.convert_store(model_name, store_format)
+        if not (changed or removed):
+            return results
+        with self._torch_lock:
+            # examples are embedded with the backend the server runs the model with
+            tokenizer, model = load_backend(model_name, self.model_backends.get(model_name, 'fp32')) \
+                if changed else (None, None)
+
+            def items():
+                for word_path, embeddings in compute_embeddings_batched(changed, tokenizer, model,
+                                                                        html_path=PROCESSED_HTML_PATH,
+                                                                        batch_size=self.batch_size):
+                    results[word_path] = {'rows': embeddings.shape[0]}
+                    yield word_path, embeddings
+
+            store_path = Path(STORE_PATH) / Path(model_name)
+            dtype, num_components = parse_format(store_format or 'float32')
+            # pages without examples are skipped by compute_embeddings_batched(), rows are appended in the format
+            # of the store, new stores to be projected are written in float32 first
+            update_embedding_store(items(), store_path, remove=removed, dtype='float32' if num_components else dtype)
+            empty = [word_path for word_path in changed if word_path not in results]
+            if empty:
+                update_embedding_store([], store_path, remove=empty)
+            embedding_store = load_embedding_store(store_path)
+            if num_components and (embedding_store.projection is None) and embedding_store.offsets:
+                # the projection is fitted on the pages of the first build
+                convert_embedding_store(store_path, store_path, dtype=dtype, num_components=num_components)
+        for word_path in changed:
+            results.setdefault(word_path, {'rows': 0})
+        return results
+
+    def convert_store(self, model_name, store_format):
+        # an existing store in another format is converted, and its nearest-neighbour index removed
+        # so that the ann stage builds it again from the converted rows
+        store_path = Path(STORE_PATH) / Path(model_name)
+        if not os.path.isfile(store_path / Path('index.json')):
+            return
+        current_format = get_store_format(load_embedding_store(store_path))
+        if current_format == store_format:
+            return
+        if ':' in current_format:
+            raise ValueError(f'{store_path} is projected ({current_format}) and can\'t be converted to '
+                             f'{store_format}, remove it to embed its pages again')
+        print(f'embed:{model_name}: converting the store from {current_format} to {store_format}')
+        convert_model_store(model_name, store_format, store_path=STORE_PATH, ann_path=ANN_PATH)
+
+    def ann(self, model_name, changed, removed):
+        store_path = Path(STORE_PATH) / Path(model_name)
+        index_path = Path(ANN_PATH) / Path(model_name)
+        if not (changed or removed) and os.path.isfile(index_path / Path('index.json')):
+            return {}
+        embedding_store = load_embedding_store(store_path)
+        inserted = changed
+        if not os.path.isfile(index_path / Path('index.json')):
+            # centroids are trained once, on the pages embedded so far, and all of them are inserted
+            create_ann_index(index_path, sample_store_rows(embedding_store))
+            inserted = sorted(set(changed) | set(embedding_store.offsets))
+        results = {}
+
+        def items():
+            for word_path in inserted:
+                embeddings = embedding_store.get(word_path)
+                if embeddings is None:
+                    results[word_path] = {'rows': 0}
+                    continue
+                def_inds = [def_ind for def_ind, _ in read_example_texts(word_path, html_path=PROCESSED_HTML_PATH)]
+                if len(def_inds) != len(embeddings):
+                    error = ValueError(f'{len(def_inds)} examples for {len(embeddings)} embeddings')
+                    results[word_path] = TaskError(word_path, error, '')
+                    continue
+                results[word_path] = {'rows': len(embeddings)}
+                yield word_path, embeddings, def_inds
+
+        update_ann_index(items(), index_path, remove=removed)
+        # pages without embeddings (or whose embeddings are out of date) are not searched
+        stale = [word_path for word_path, res in results.items() if isinstance(res, TaskError) or not res['rows']]
+        if stale:
+            update_ann_index([], index_path, remove=stale)
+        return {word_path: results[word_path] for word_path in changed}
+
+    def run_stage(self, stage):
+        time_start = time.perf_counter()
+        records = self.manifest.records(stage.name)
+        if stage.input_function is None:
+            input_hashes = {}
+        else:
+            input_hashes = stage.input_function()
+        changed = [word_path for word_path, input_hash in input_hashes.items()
+                   if (stage.name in self.force) or (records.get(word_path, {}).get('input') != input_hash)]
+        removed = [word_path for word_path in self.select(records) if word_path not in input_hashes]
+        results = stage.build_function(changed, removed)
+        errors = [res for res in results.values() if isinstance(res, TaskError)]
+        self.manifest.update(stage.name, removed, {word_path: {'input': input_hashes[word_path], **res}
+                                                   for word_path, res in results.items()
+                                                   if not isinstance(res, TaskError)})
+        self.manifest.save()
+        print(f'{stage.name}: {len(changed)-len(errors)} built, {len(removed)} removed, {len(errors)} failed '
+              f'in {time.perf_counter()-time_start:.1f}s')
+        for error in errors:
+            print(f'  {error.item}: {error.exception!r}')
+        return errors
+
+    def run(self):
+        """Run the stages of the build as soon as the stages they depend on have succeeded.
+        Return the names of the stages that failed or have been skipped.
+        """
+        failed = set()
+        done = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.stages)) as executor:
+            futures = {}
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if (name in done) or (name in futures.values()):
+                        continue
+                    if any(dep in failed for dep in stage.deps):
+                        print(f'{name}: skipped')
+                        failed.add(name)
+                        done.add(name)
+                    elif all(dep in done for dep in stage.deps):
+                        futures[executor.submit(self.run_stage, stage)] = name
+                if not futures:
+                    continue
+                finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f'{name}: failed with {e!r}')
+                        failed.add(name)
+                    done.add(name)
+        return failed
+
+
+def parse_model_names(models):
+    # models can be given by their names or their indices in MODEL_NAMES
+    if not models:
+        return MODEL_NAMES
+    return [MODEL_NAMES[int(model)] if model.isdigit() else model for model in models]
+
+
+if __name__ == '__main__':
+    # python -m lerobert.build [WORD_PATH ...] [--models NAME_OR_INDEX ...] [--download] [--force STAGE ...]
+    parser = argparse.ArgumentParser(prog='python -m lerobert.build',
+                                     description='Rebuild processed HTML, templates, the word map, the lemma '
+                                                 'table, embedding stores and nearest-neighbour indexes of '
+                                                 'the pages that have changed since the last build.')
+    parser.add_argument('word_paths', nargs='*', help='only build these pages (all saved pages by default)')
+    parser.add_argument('--models', nargs='*', help='names or indices of the models to compute embeddings with')
+    parser.add_argument('--download', action='store_true', help='revalidate and download pages first')
+    parser.add_argument('--force', nargs='*', default=[], help='rebuild all pages in these stages, e.g. process')
+    parser.add_argument('--tagdir', help='directory of TreeTagger')
+    parser.add_argument('--threads', action='store_true', help='use threads instead of processes')
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--backends', default=MODEL_BACKENDS,
+                        help='backends of models by their indices, e.g. 0=int8,1=onnx (LEROBERT_MODEL_BACKENDS)')
+    parser.add_argument('--store-formats', default=STORE_FORMATS,
+                        help='formats of the embedding stores of models by their indices, e.g. 0=int8,2=int8:256 '
+                             '(LEROBERT_STORE_FORMATS), existing stores are converted')
+    args = parser.parse_args()
+    tagger_kwargs = {'TAGLANG': 'fr'}
+    if args.tagdir:
+        tagger_kwargs['TAGDIR'] = args.tagdir
+    build = Build(word_paths=args.word_paths,
+                  model_names=parse_model_names(args.models),
+                  download=args.download,
+                  force=args.force,
+                  tagger_kwargs=tagger_kwargs,
+                  processes=not args.threads,
+                  manifest_file=args.manifest,
+                  model_backends=parse_model_backends(args.backends, MODEL_NAMES),
+                  store_formats=parse_store_formats(args.store_formats, MODEL_NAMES))
+    sys.exit(1 if build.run() else 0)
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by the total size of its values.
+    The size of a value is given by size_function (e.g. the number of bytes it holds).
+    With ttl (seconds), items expire that long after they were stored.
+    """
+    def __init__(self, max_size, size_function=len, ttl=None):
+        self.max_size = max_size
+        self.size_function = size_function
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as recently used.
+        """
+        with self._lock:
+            try:
+                value, size, expire_time = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if (expire_time is not None) and (time.monotonic() >= expire_time):
+                del self._items[key]
+                self.size -= size
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting least recently used items until the cache fits into max_size.
+        Values larger than max_size are not stored.
+        """
+        size = self.size_function(value)
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            if size > self.max_size:
+                return
+            expire_time = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._items[key] = (value, size, expire_time)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size, _) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+def file_version(filename):
+    """(inode, modification time) of a file, which changes when it is rewritten or replaced, None if it is missing.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class VersionedCache:
+    """Values of load_function(key) loaded again when version_function(key) changes, e.g. the file_version()
+    of a file replaced by a build. Versions are checked at most once every interval seconds per key,
+    on_reload() is called when a loaded value is replaced.
+    """
+    def __init__(self, load_function, version_function, interval=1.0, on_reload=None):
+        self.load_function = load_function
+        self.version_function = version_function
+        self.interval = interval
+        self.on_reload = on_reload
+        self.reloads = 0
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key=None):
+        item = self._items.get(key)
+        if (item is not None) and (time.monotonic() < item[2]):
+            return item[0]
+        with self._lock:
+            item = self._items.get(key)
+            version = self.version_function(key)
+            if (item is None) or (item[1] != version):
+                reloaded = item is not None
+                item = (self.load_function(key), version, 0.0)
+                if reloaded:
+                    self.reloads += 1
+                    if self.on_reload is not None:
+                        self.on_reload()
+            self._items[key] = (item[0], item[1], time.monotonic() + self.interval)
+            return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class HiddenStateCache:
+    """Last hidden states of windows of texts encoded by a model, keyed by (model name, text hash, window),
+    along with the tokenization of each text. A selection inside a cached window, with at least min_context tokens
+    on both sides (or the start/end of the text), can be pooled without a forward pass.
+    Least recently used items are evicted when they take more than max_size bytes.
+    """
+    def __init__(self, max_size, min_context=64):
+        self.min_context = min_context
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(max_size, size_function=self.item_size)
+
+    @staticmethod
+    def item_size(value):
+        if hasattr(value, 'element_size'):
+            return value.numel() * value.element_size()
+        # token ids, spans and word starts of a text
+        return 160 * len(value['tokens'][0])
+
+    @property
+    def size(self):
+        return self._cache.size
+
+    @property
+    def max_size(self):
+        return self._cache.max_size
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get_tokens(self, model_name, text_hash):
+        entry = self._cache.get((model_name, text_hash))
+        return entry['tokens'] if entry is not None else None
+
+    def put_tokens(self, model_name, text_hash, tokens):
+        self._cache.put((model_name, text_hash), {'tokens': tokens, 'windows': []})
+
+    def find(self, model_name, text_hash, token_start, token_end):
+        """Return (window, hidden states) of a cached window holding the selected tokens, None if there is none.
+        """
+        entry = self._cache.get((model_name, text_hash))
+        if entry is not None:
+            num_tokens = len(entry['tokens'][0])
+            for window_start, window_end in list(entry['windows']):
+                if not ((window_start <= token_start) and (token_end <= window_end)):
+                    continue
+                if (((token_start - window_start < self.min_context) and (window_start > 0))
+                        or ((window_end - token_end < self.min_context) and (window_end < num_tokens))):
+                    continue
+                hidden_states = self._cache.get((model_name, text_hash, window_start, window_end))
+                if hidden_states is not None:
+                    self.hits += 1
+                    return (window_start, window_end), hidden_states
+        self.misses += 1
+        return None
+
+    def put(self, model_name, text_hash, window, hidden_states):
+        """Store the hidden states of a window of a text whose tokens are cached.
+        """
+        entry = self._cache.get((model_name, text_hash))
+        if entry is None:
+            return
+        if tuple(window) not in entry['windows']:
+            entry['windows'].append(tuple(window))
+        self._cache.put((model_name, text_hash, *window), hidden_states)
@@ -0,0 +1,251 @@
+import os
+import json
+import random
+import asyncio
+from pathlib import Path
+from urllib.parse import urlsplit
+import httpx
+from bs4 import BeautifulSoup
+from tqdm import tqdm
+
+from lerobert.processing import read_definitions_section, find_definitions, PAGE_PARSER, DEFINITIONS_STRAINER
+
+
+BASE_URL = 'https://dictionnaire.lerobert.com'
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class Manifest:
+    """Append-only JSON lines record of crawled URLs: the last record of a key wins.
+    Records are written as soon as they are known, so an interrupted crawl can be resumed.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self.records = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of an interrupted crawl can be incomplete
+                        continue
+                    self.records[record['key']] = record
+        os.makedirs(self.manifest_path.parent, exist_ok=True)
+        self._file = open(self.manifest_path, 'a', encoding='utf-8')
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def update(self, key, **record):
+        record = {'key': key, **record}
+        self.records[key] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        return record
+
+    def close(self):
+        self._file.close()
+
+
+def write_file(filename_path, content):
+    """Write bytes to a .part file replacing filename_path once complete, an interrupted download leaves no partial
+    file behind.
+    """
+    os.makedirs(Path(filename_path).parent, exist_ok=True)
+    with open(f'{filename_path}.part', 'wb') as f:
+        f.write(content)
+    os.replace(f'{filename_path}.part', filename_path)
+
+
+class RateLimiter:
+    """Space out the starts of requests to one host by at least 1/rate seconds.
+    """
+    def __init__(self, rate):
+        self.interval = 1/rate if rate else 0
+        self._next_time = 0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Crawler:
+    """Download definition pages and media files with one pooled HTTP client, bounded concurrency,
+    per-host rate limiting, exponential backoff on 429/5xx and a persistent manifest
+    (status, final redirected word_path, ETag/Last-Modified) used to resume and revalidate crawls.
+    """
+    def __init__(self,
+                 base_url=BASE_URL,
+                 manifest_path='./assets/crawl_manifest.jsonl',
+                 concurrency=8,
+                 rate=4.0,
+                 max_retries=5,
+                 backoff=1.0,
+                 timeout=30.0,
+                 **client_kwargs):
+        self.base_url = base_url.rstrip('/')
+        self.manifest = Manifest(manifest_path)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client_kwargs = {'timeout': timeout, 'follow_redirects': True, **client_kwargs}
+        self._rate_limiters = {}
+        self._client = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self._client = httpx.AsyncClient(limits=limits, **self.client_kwargs)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
+        self.manifest.close()
+
+    async def fetch(self, url, headers=None):
+        """GET a URL, retrying with exponential backoff on 429/5xx responses and transport errors.
+        """
+        host = urlsplit(url).netloc
+        if host not in self._rate_limiters:
+            self._rate_limiters[host] = RateLimiter(self.rate)
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self._rate_limiters[host].wait()
+                try:
+                    response = await self._client.get(url, headers=headers)
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    response = None
+            if (response is not None) and ((response.status_code not in RETRY_STATUS_CODES)
+                                           or (attempt == self.max_retries)):
+                return response
+            delay = self.backoff * 2**attempt * (1 + random.random())
+            if (response is not None) and response.headers.get('retry-after', '').isdigit():
+                delay = max(delay, int(response.headers['retry-after']))
+            await asyncio.sleep(delay)
+
+    async def download_html(self, word_path, html_path='./assets/html/original/', revalidate=False):
+        """Download HTML of a definition page ending in word_path (word).
+        Pages recorded in the manifest are skipped, unless revalidate is set: then they are requested
+        with If-None-Match/If-Modified-Since and only rewritten if they have changed.
+        """
+        key = f'/definition/{word_path}'
+        record = self.manifest.get(key)
+        headers = {}
+        if record and (record['status'] == 'ok'):
+            saved = os.path.isfile(Path(html_path) / Path(f"{record['word_path']}.html"))
+        else:
+            saved = True
+        if record and saved and (record['status'] in ('ok', 'no_definitions', 'not_found')):
+            if not revalidate:
+                return record
+            if record.get('etag'):
+                headers['If-None-Match'] = record['etag']
+            if record.get('last_modified'):
+                headers['If-Modified-Since'] = record['last_modified']
+        try:
+            response = await self.fetch(self.base_url + key, headers=headers)
+        except httpx.HTTPError as e:
+            return self.manifest.update(key, status='error', error=repr(e))
+        if response.status_code == 304:
+            return record
+        if response.status_code != 200:
+            status = 'not_found' if response.status_code == 404 else 'error'
+            return self.manifest.update(key, status=status, status_code=response.status_code)
+        content = response.text
+        definitions = await asyncio.to_thread(lambda: find_definitions(BeautifulSoup(content, PAGE_PARSER,
+                                                                                      parse_only=DEFINITIONS_STRAINER)))
+        if not definitions:
+            return self.manifest.update(key, status='no_definitions', status_code=response.status_code)
+        response_word_path = response.url.path.split('/')[-1] # if redirected
+        write_file(Path(html_path) / Path(f'{response_word_path}.html'), content.encode('utf-8'))
+        return self.manifest.update(key,
+                                    status='ok',
+                                    status_code=response.status_code,
+                                    word_path=response_word_path,
+                                    etag=response.headers.get('etag'),
+                                    last_modified=response.headers.get('last-modified'))
+
+    async def download_file(self, link, filename_path):
+        """Download a media file unless the manifest records it as downloaded and it exists.
+        """
+        record = self.manifest.get(link)
+        if record and (record['status'] == 'ok') and os.path.isfile(filename_path):
+            return record
+        try:
+            response = await self.fetch(self.base_url + link)
+        except httpx.HTTPError as e:
+            return self.manifest.update(link, status='error', error=repr(e))
+        if response.status_code != 200:
+            return self.manifest.update(link, status='error', status_code=response.status_code)
+        write_file(filename_path, response.content)
+        return self.manifest.update(link, status='ok', status_code=response.status_code,
+                                    etag=response.headers.get('etag'))
+
+    async def download_media(self,
+                             html_filename,
+                             audio=True,
+                             images=True,
+                             html_path='./assets/html/original/',
+                             audio_path='./assets/audio/',
+                             image_path='./assets/images/thumbnails/',
+                             section_path=None):
+        """Download all media files of specified type found in the definition section of an HTML file concurrently.
+        """
+        media = []
+        if audio:
+            media.append((audio_path, '/medias/SOUNDS/originals/mp3/', 'source'))
+        if images:
+            media.append((image_path, '/medias/IMAGES/originals/thumbnails/', 'img'))
+        if not media:
+            return []
+        soup = await asyncio.to_thread(read_definitions_section, html_filename, html_path=html_path,
+                                       section_path=section_path)
+        definitions = find_definitions(soup)
+        downloads = []
+        for media_path, src_prefix, tag in media:
+            links = set()
+            for definition in definitions:
+                links.update([t['src'] for t in definition.find_all(tag, recursive=True) if t.has_attr('src')])
+            for link in links:
+                if link.startswith(src_prefix):
+                    filename = link[len(src_prefix):]
+                else:
+                    filename = link.replace('/', '_')
+                downloads.append(self.download_file(link, Path(media_path) / Path(filename)))
+        return await asyncio.gather(*downloads)
+
+
+async def run_crawler(method, items, crawler_kwargs, **kwargs):
+    async with Crawler(**crawler_kwargs) as crawler:
+        tasks = [asyncio.ensure_future(getattr(crawler, method)(item, **kwargs)) for item in items]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            await task
+        return [task.result() for task in tasks]
+
+
+def crawl_html(word_paths, html_path='./assets/html/original/', revalidate=False, **crawler_kwargs):
+    """Download definition pages ending in word_paths and return their manifest records.
+    crawler_kwargs are passed to Crawler (base_url, manifest_path, concurrency, rate, ...).
+    """
+    return asyncio.run(run_crawler('download_html', word_paths, crawler_kwargs,
+                                   html_path=html_path, revalidate=revalidate))
+
+
+def crawl_media(html_filenames, audio=True, images=True, html_path='./assets/html/original/',
+                audio_path='./assets/audio/', image_path='./assets/images/thumbnails/', section_path=None,
+                **crawler_kwargs):
+    """Download media files found in the definition sections of saved HTML files.
+    """
+    return asyncio.run(run_crawler('download_media', html_filenames, crawler_kwargs,
+                                   audio=audio, images=images, html_path=html_path,
+                                   audio_path=audio_path, image_path=image_path, section_path=section_path))
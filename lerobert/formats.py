@@ -0,0 +1,135 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+
+from lerobert.processing import load_embedding_store, convert_embedding_store, normalize_embeddings, STORE_DTYPES
+
+
+STORE_PATH = './assets/embedding_stores/'
+ANN_PATH = './assets/ann_indexes/'
+FORMATS = ('float16', 'int8', 'float32:256', 'int8:256')
+
+
+def parse_format(store_format):
+    """Return the dtype and the number of components (None without projection) of a format like int8:256.
+    """
+    dtype, _, num_components = store_format.partition(':')
+    if dtype not in STORE_DTYPES:
+        raise ValueError(f'unknown store dtype {dtype}, expected one of {STORE_DTYPES}')
+    return dtype, int(num_components) if num_components else None
+
+
+def get_store_format(store):
+    """Return the format of a loaded store as parse_format() reads it, e.g. float16 or int8:256.
+    """
+    if store.projection is None:
+        return store.dtype.name
+    return f'{store.dtype.name}:{store.projection[1].shape[1]}'
+
+
+def parse_store_formats(setting, model_names):
+    """Return {model_name: format} from a setting like '0=int8,2=int8:256' giving formats to models
+    by their indices in model_names.
+    """
+    store_formats = {}
+    for item in setting.split(','):
+        if item.strip():
+            model_index, store_format = item.split('=')
+            parse_format(store_format.strip())
+            store_formats[model_names[int(model_index)]] = store_format.strip()
+    return store_formats
+
+
+def store_disk_size(store_path):
+    return sum(entry.stat().st_size for entry in os.scandir(store_path)
+               if entry.is_file() and not entry.name.endswith('.tmp'))
+
+
+def check_format(baseline_store, store, num_queries=512, k=10, seed=0):
+    """Compare a converted store with its float32 baseline. Queries are rows of the baseline
+    (embeddings of examples, like the selections they are compared with), projected like those of the server.
+    Examples of the page of a query are ranked as /definitions does (the query itself excluded)
+    and its k nearest examples among the sampled pages as /nearest does.
+    """
+    rng = np.random.default_rng(seed)
+    word_paths = sorted(word_path for word_path, (_, count) in baseline_store.offsets.items() if count > 1)
+    word_paths = [word_paths[ind] for ind in rng.permutation(len(word_paths))[:num_queries]]
+    if not word_paths:
+        raise ValueError('no page with several examples to compare')
+    score_diffs = []
+    top1_agreement = []
+    queries = []
+    for word_path in word_paths:
+        baseline_rows = normalize_embeddings(np.asarray(baseline_store.get(word_path), dtype=np.float32))
+        rows = normalize_embeddings(np.asarray(store.get(word_path), dtype=np.float32))
+        query_ind = rng.integers(len(baseline_rows))
+        query = baseline_rows[query_ind]
+        queries.append(query)
+        baseline_scores = np.delete(baseline_rows @ query, query_ind)
+        scores = np.delete(rows @ normalize_embeddings(store.project(query)), query_ind)
+        score_diffs.append(np.abs(scores - baseline_scores))
+        top1_agreement.append(baseline_scores.argmax() == scores.argmax())
+    score_diffs = np.concatenate(score_diffs)
+    # nearest examples among all the rows of the sampled pages
+    baseline_matrix = normalize_embeddings(np.concatenate([np.asarray(baseline_store.get(word_path), dtype=np.float32)
+                                                           for word_path in word_paths]))
+    matrix = normalize_embeddings(np.concatenate([np.asarray(store.get(word_path), dtype=np.float32)
+                                                  for word_path in word_paths]))
+    queries = np.stack(queries)
+    k = min(k, len(matrix))
+    baseline_neighbours = np.argsort(-(queries @ baseline_matrix.T), axis=1)[:, :k]
+    neighbours = np.argsort(-(normalize_embeddings(store.project(queries)) @ matrix.T), axis=1)[:, :k]
+    recall = np.mean([len(np.intersect1d(row, baseline_row))/k
+                      for row, baseline_row in zip(neighbours, baseline_neighbours)])
+    return {'dim': store.dim,
+            'disk_bytes': store_disk_size(store.path),
+            'ram_bytes': store.nbytes,
+            'disk_ratio': store_disk_size(store.path)/store_disk_size(baseline_store.path),
+            'max_score_diff': float(score_diffs.max()) if len(score_diffs) else 0.0,
+            'mean_score_diff': float(score_diffs.mean()) if len(score_diffs) else 0.0,
+            'top1_agreement': float(np.mean(top1_agreement)),
+            f'recall_at_{k}': float(recall)}
+
+
+def convert_model_store(model_name, store_format, store_path=STORE_PATH, ann_path=ANN_PATH):
+    """Convert the store of a model in place and remove its nearest-neighbour index,
+    which python -m lerobert.build recreates from the converted store.
+    """
+    dtype, num_components = parse_format(store_format)
+    convert_embedding_store(Path(store_path) / Path(model_name),
+                            Path(store_path) / Path(model_name),
+                            dtype=dtype,
+                            num_components=num_components)
+    if os.path.isdir(Path(ann_path) / Path(model_name)):
+        shutil.rmtree(Path(ann_path) / Path(model_name))
+
+
+if __name__ == '__main__':
+    # python -m lerobert.formats MODEL_NAME [FORMAT ...] [--convert FORMAT], run from the repository root
+    parser = argparse.ArgumentParser(prog='python -m lerobert.formats',
+                                     description='Compare compressed formats of the embedding store of a model '
+                                                 'with float32: disk and memory sizes, score differences '
+                                                 'and ranking agreement.')
+    parser.add_argument('model_name')
+    parser.add_argument('formats', nargs='*', default=FORMATS,
+                        help=f'DTYPE[:COMPONENTS] with DTYPE in {STORE_DTYPES}, default: {" ".join(FORMATS)}')
+    parser.add_argument('--queries', type=int, default=512, help='number of pages sampled for queries')
+    parser.add_argument('--convert', metavar='FORMAT',
+                        help='convert the store of the model to a format (its index is rebuilt by lerobert.build)')
+    args = parser.parse_args()
+    model_store_path = Path(STORE_PATH) / Path(args.model_name)
+    baseline_store = load_embedding_store(model_store_path)
+    if (baseline_store.dtype != np.float32) or (baseline_store.projection is not None):
+        sys.exit(f'{model_store_path} is not a float32 store without projection, compute its embeddings again')
+    for store_format in args.formats:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            dtype, num_components = parse_format(store_format)
+            convert_embedding_store(model_store_path, tmp_path, dtype=dtype, num_components=num_components)
+            print(store_format, check_format(baseline_store, load_embedding_store(tmp_path), num_queries=args.queries))
+    if args.convert:
+        convert_model_store(args.model_name, args.convert)
+        print(f'{model_store_path} converted to {args.convert}')
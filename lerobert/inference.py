@@ -0,0 +1,246 @@
+import queue
+import threading
+import time
+import concurrent.futures
+from collections import OrderedDict
+import torch
+
+from lerobert.backends import load_pretrained
+from lerobert.metrics import BATCH_SECONDS, BATCH_SIZE
+
+
+class QueueFullError(Exception):
+    """Raised when an inference queue can't accept more requests.
+    """
+
+
+class SchedulerClosedError(Exception):
+    """Raised when a request is submitted to a stopped scheduler of an unloaded model.
+    """
+
+
+class InferenceScheduler:
+    """Run forward passes of one model in a dedicated worker thread.
+    Requests arriving within max_wait_ms of each other (up to max_batch_size) are run as one padded batch.
+    The futures of a batch carry the duration of its forward pass (forward_seconds) and its size (batch_size).
+    Forward passes use num_threads intra-op threads (those of the thread creating the scheduler by default),
+    or fewer when requests ask for it, so that the schedulers of several models can share the cores.
+    """
+    def __init__(self, model, pad_token_id, max_batch_size=8, max_wait_ms=5.0, max_queue_size=64, name=None,
+                 num_threads=None):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name or ''
+        self.num_threads = num_threads or torch.get_num_threads()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f'inference-{name}' if name else 'inference', daemon=True)
+        self._thread.start()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def submit(self, input_ids, trace_file=None, num_threads=None):
+        """Queue token ids of one sequence (special tokens included) and return
+        a concurrent.futures.Future resolving to its last hidden states (sequence length x dimensions).
+        With trace_file, the forward pass of its batch is profiled with torch.profiler and saved as a Chrome trace.
+        With num_threads, its batch runs on at most num_threads intra-op threads.
+        Raise QueueFullError if the queue is full and SchedulerClosedError if the worker has stopped.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._stopped:
+                raise SchedulerClosedError('the model has been unloaded')
+            try:
+                self._queue.put_nowait((input_ids, future, trace_file, num_threads))
+            except queue.Full:
+                raise QueueFullError(f'{self.max_batch_size} requests are being processed and '
+                                     f'{self._queue.maxsize} more are waiting')
+        return future
+
+    def close(self):
+        """Stop the worker thread once the queue is empty. Requests submitted meanwhile are still processed.
+        """
+        with self._lock:
+            self._closed = True
+        # wake the worker up
+        self._queue.put(None)
+
+    def _collect_batch(self):
+        item = self._queue.get()
+        batch = [item] if item is not None else []
+        deadline = time.monotonic() + self.max_wait_ms/1000
+        while batch and (len(batch) < self.max_batch_size):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def _run(self):
+        # the intra-op threads of torch are set per thread
+        torch.set_num_threads(self.num_threads)
+        while True:
+            batch = self._collect_batch()
+            if batch:
+                self._run_batch(batch)
+            with self._lock:
+                if self._closed and self._queue.empty():
+                    self._stopped = True
+                    return
+
+    def _run_batch(self, batch):
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        trace_files = [trace_file for _, _, trace_file, _ in batch if trace_file is not None]
+        num_threads = min([num_threads for _, _, _, num_threads in batch if num_threads] + [self.num_threads])
+        if num_threads != self.num_threads:
+            torch.set_num_threads(num_threads)
+        try:
+            batch_len = max(len(input_ids) for input_ids, _, _, _ in batch)
+            input_tensor = torch.full((len(batch), batch_len), self.pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(batch), batch_len), dtype=torch.long)
+            for ind, (input_ids, _, _, _) in enumerate(batch):
+                input_tensor[ind, :len(input_ids)] = torch.tensor(input_ids, dtype=torch.long)
+                attention_mask[ind, :len(input_ids)] = 1
+            time_start = time.perf_counter()
+            if trace_files:
+                from torch.profiler import profile, ProfilerActivity
+                with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], record_shapes=True) as profiler:
+                    model_output = self.model(input_ids=input_tensor, attention_mask=attention_mask)
+                for trace_file in trace_files:
+                    profiler.export_chrome_trace(str(trace_file))
+            else:
+                with torch.no_grad():
+                    model_output = self.model(input_ids=input_tensor, attention_mask=attention_mask)
+            seconds = time.perf_counter() - time_start
+        except Exception as e:
+            for _, future, _, _ in batch:
+                future.set_exception(e)
+            return
+        finally:
+            # threads created meanwhile start with the number set last
+            if num_threads != self.num_threads:
+                torch.set_num_threads(self.num_threads)
+        BATCH_SECONDS.observe(seconds, self.name)
+        BATCH_SIZE.observe(len(batch), self.name)
+        for ind, (input_ids, future, _, _) in enumerate(batch):
+            future.forward_seconds = seconds
+            future.batch_size = len(batch)
+            future.num_threads = num_threads
+            future.set_result(model_output[0][ind, :len(input_ids)])
+
+
+def model_size(model):
+    """Return the number of bytes taken by the weights of a model (packed int8 weights included).
+    """
+    if hasattr(model, 'nbytes'):
+        return model.nbytes
+    size = 0
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(tensor, torch.Tensor):
+                size += tensor.numel()*tensor.element_size()
+    return size
+
+
+class LoadedModel:
+    """A tokenizer, a model and the scheduler running its forward passes.
+    """
+    def __init__(self, name, tokenizer, model, scheduler):
+        self.name = name
+        self.tokenizer = tokenizer
+        self.model = model
+        self.scheduler = scheduler
+        self.size = model_size(model)
+
+
+class ModelRegistry:
+    """Load models on first use and keep the total size of loaded models within memory_budget (bytes).
+    When a new model doesn't fit, the least recently used models are unloaded.
+    """
+    def __init__(self, model_names, memory_budget=None, load_function=load_pretrained, scheduler_kwargs=None):
+        self.model_names = model_names
+        self.memory_budget = memory_budget
+        self.load_function = load_function
+        self.scheduler_kwargs = scheduler_kwargs or {}
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading_locks = [threading.Lock() for _ in model_names]
+
+    def is_loaded(self, model_index):
+        return model_index in self._loaded
+
+    def get(self, model_index):
+        """Return a LoadedModel, loading it (and evicting other models if needed) on first use.
+        """
+        with self._lock:
+            if model_index in self._loaded:
+                self._loaded.move_to_end(model_index)
+                return self._loaded[model_index]
+        # models are loaded outside the registry lock, so that loaded ones stay available meanwhile
+        with self._loading_locks[model_index]:
+            with self._lock:
+                if model_index in self._loaded:
+                    return self._loaded[model_index]
+            model_name = self.model_names[model_index]
+            tokenizer, model = self.load_function(model_name)
+            scheduler = InferenceScheduler(model,
+                                           tokenizer.pad_token_id,
+                                           name=model_name,
+                                           **self.scheduler_kwargs)
+            loaded_model = LoadedModel(model_name, tokenizer, model, scheduler)
+            with self._lock:
+                self._loaded[model_index] = loaded_model
+                self._evict(keep=model_index)
+            return loaded_model
+
+    def after_fork(self):
+        """Recreate the locks and the scheduler threads of loaded models in a forked worker process:
+        the threads of the parent don't run in its children, the weights of models are shared with it.
+        """
+        self._lock = threading.Lock()
+        self._loading_locks = [threading.Lock() for _ in self.model_names]
+        for loaded_model in self._loaded.values():
+            loaded_model.scheduler = InferenceScheduler(loaded_model.model,
+                                                        loaded_model.tokenizer.pad_token_id,
+                                                        name=loaded_model.name,
+                                                        **self.scheduler_kwargs)
+
+    def unload(self, model_index):
+        with self._lock:
+            loaded_model = self._loaded.pop(model_index, None)
+        if loaded_model is not None:
+            loaded_model.scheduler.close()
+
+    def status(self):
+        """Return the name, load status, size and number of queued requests of each model.
+        """
+        with self._lock:
+            loaded = dict(self._loaded)
+        return [{'index': ind,
+                 'name': model_name,
+                 'loaded': ind in loaded,
+                 'size': loaded[ind].size if ind in loaded else None,
+                 'queue_size': loaded[ind].scheduler.qsize() if ind in loaded else None}
+                for ind, model_name in enumerate(self.model_names)]
+
+    def _evict(self, keep):
+        if self.memory_budget is None:
+            return
+        while sum(item.size for item in self._loaded.values()) > self.memory_budget:
+            model_index = next((ind for ind in self._loaded if ind != keep), None)
+            if model_index is None:
+                break
+            # requests already holding the model finish, the scheduler stops once its queue is empty
+            self._loaded.pop(model_index).scheduler.close()
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import threading
+from pathlib import Path
+
+from lerobert.caching import LRUCache
+
+
+# forms as TreeTagger splits them: elided articles and pronouns (l', qu') are forms of their own
+FORM_PATTERN = re.compile(r"\w+['’]|\w+(?:-\w+)*")
+# first and last whitespace of a part of a text, words are separated by any whitespace like in
+# lerobert.processing.tokenize_text()
+FIRST_WHITESPACE_PATTERN = re.compile(r'\s')
+LAST_WHITESPACE_PATTERN = re.compile(r'\s\S*$')
+# lemma of the forms TreeTagger doesn't know
+UNKNOWN_LEMMA = '<unknown>'
+
+
+def find_forms(text):
+    """Return the (form, start, end) of the words of a text.
+    """
+    return [(match.group(), match.start(), match.end()) for match in FORM_PATTERN.finditer(text)]
+
+
+def count_lemmas(text_tags, counts):
+    """Add the lemmas TreeTagger gave to each form (lowercased) to counts {form: {lemma: count}}.
+    Punctuation and unknown lemmas are left out.
+    """
+    for tag in text_tags:
+        lemma = tag['lemma'].lower()
+        if (lemma == UNKNOWN_LEMMA) or not FORM_PATTERN.fullmatch(tag['word']):
+            continue
+        form_counts = counts.setdefault(tag['word'].lower(), {})
+        form_counts[lemma] = form_counts.get(lemma, 0) + 1
+    return counts
+
+
+def save_page_lemmas(filename, counts, lemma_path='./assets/lemmas/pages/'):
+    os.makedirs(lemma_path, exist_ok=True)
+    with open(Path(lemma_path) / Path(f'{filename}.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(counts, f, ensure_ascii=False)
+    os.replace(Path(lemma_path) / Path(f'{filename}.json.tmp'), Path(lemma_path) / Path(f'{filename}.json'))
+
+
+def load_page_lemmas(filename, lemma_path='./assets/lemmas/pages/'):
+    with open(Path(lemma_path) / Path(f'{filename}.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_lemma_table(page_counts, header_words, table_file, min_share=0.1):
+    """Merge {form: {lemma: count}} of pages into a table {form: 'lemma|lemma'} of the lemmas given
+    to at least min_share of the occurrences of each form, the most frequent first.
+    Header words of definitions are their own lemma. Return the number of forms.
+    """
+    totals = {}
+    for counts in page_counts:
+        for form, form_counts in counts.items():
+            form_totals = totals.setdefault(form, {})
+            for lemma, count in form_counts.items():
+                form_totals[lemma] = form_totals.get(lemma, 0) + count
+    table = {}
+    for form, form_totals in totals.items():
+        num_occurrences = sum(form_totals.values())
+        lemmas = sorted((lemma for lemma, count in form_totals.items() if count >= min_share*num_occurrences),
+                        key=lambda lemma: (-form_totals[lemma], lemma))
+        table[form] = '|'.join(lemmas)
+    for word in header_words:
+        table.setdefault(word.lower(), word.lower())
+    os.makedirs(Path(table_file).parent, exist_ok=True)
+    with open(f'{table_file}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(table, f, ensure_ascii=False, sort_keys=True)
+    os.replace(f'{table_file}.tmp', table_file)
+    return len(table)
+
+
+class LemmaTable:
+    """Lemmas of the forms found in the examples and headers of the dictionary, looked up in a dict.
+    """
+    def __init__(self, table_file):
+        with open(table_file, 'r', encoding='utf-8') as f:
+            self.lemmas = json.load(f)
+
+    def __contains__(self, form):
+        return form.lower() in self.lemmas
+
+    def __len__(self):
+        return len(self.lemmas)
+
+    def lookup(self, form):
+        """Return the lemmas of a form separated by '|' (None if unknown).
+        """
+        return self.lemmas.get(form.lower())
+
+
+def load_lemma_table(table_file):
+    return LemmaTable(table_file)
+
+
+class SelectionTagger:
+    """Tags (word, pos, lemma) of selected texts without TreeTagger for the forms of a LemmaTable.
+    Unknown forms are tagged by TreeTagger with up to context characters of the text around the selection,
+    which gives better lemmas than the bare selection, and their lemmas are kept in an LRU cache of cache_size forms.
+    lookups counts the forms found in the table, in the cache and tagged by TreeTagger, tagger_calls the calls
+    to the TreeTagger process.
+    """
+    def __init__(self, table=None, cache_size=65536, context=200):
+        self.table = table
+        self.context = context
+        self.cache = LRUCache(max_size=cache_size, size_function=lambda lemma: 1)
+        self.lookups = {'table': 0, 'cache': 0, 'tagger': 0}
+        self.tagger_calls = 0
+        self._lock = threading.Lock()
+
+    def count(self, source, num_forms=1):
+        with self._lock:
+            self.lookups[source] += num_forms
+
+    def tag_selection(self, text, selection_start, selection_end, tagger):
+        """Return the tags of the forms of text[selection_start:selection_end], tagging unknown forms in context.
+        """
+        tags = []
+        unknown_forms = []
+        for form, start, end in find_forms(text[selection_start:selection_end]):
+            lemma = self.table.lookup(form) if self.table is not None else None
+            if lemma is not None:
+                self.count('table')
+            else:
+                lemma = self.cache.get(form.lower())
+                if lemma is None:
+                    unknown_forms.append((form, selection_start + start, selection_start + end))
+                    continue
+                self.count('cache')
+            tags.append({'word': form, 'pos': None, 'lemma': lemma})
+        if unknown_forms:
+            tags.extend(self.tag_in_context(text, selection_start, selection_end, unknown_forms, tagger))
+        return tags
+
+    def tag_in_context(self, text, selection_start, selection_end, forms, tagger):
+        # lerobert.processing imports this module
+        from lerobert.processing import tag_text
+        # words cut at the boundaries of the context are left out
+        context_start = max(selection_start - self.context, 0)
+        context_end = min(selection_end + self.context, len(text))
+        if context_start > 0:
+            match = FIRST_WHITESPACE_PATTERN.search(text, context_start, selection_start)
+            context_start = match.end() if match is not None else selection_start
+        if context_end < len(text):
+            match = LAST_WHITESPACE_PATTERN.search(text, selection_end, context_end)
+            context_end = match.start() if match is not None else selection_end
+        text_tags = tag_text(text[context_start:context_end], tagger)
+        with self._lock:
+            self.tagger_calls += 1
+        # spans of the tags in the text
+        tag_spans = []
+        ind_start = context_start
+        for tag in text_tags:
+            tag_start = text.find(tag['word'], ind_start, context_end)
+            if tag_start == -1:
+                continue
+            ind_start = tag_start + len(tag['word'])
+            tag_spans.append((tag_start, ind_start, tag))
+        tags = []
+        for form, start, end in forms:
+            overlapping = [tag for tag_start, tag_end, tag in tag_spans if (tag_start < end) and (tag_end > start)]
+            lemmas = [tag['lemma'] for tag in overlapping if tag['lemma'] != UNKNOWN_LEMMA]
+            lemma = '|'.join(dict.fromkeys(lemmas)) or form.lower()
+            self.cache.put(form.lower(), lemma)
+            tags.append({'word': form, 'pos': overlapping[0]['pos'] if overlapping else None, 'lemma': lemma})
+        self.count('tagger', len(forms))
+        return tags
@@ -0,0 +1,178 @@
+import os
+import json
+import mmap
+import bisect
+import unicodedata
+from pathlib import Path
+import numpy as np
+
+
+MATCH_MODES = ('exact', 'unaccented', 'prefix')
+LIGATURES = {'œ': 'oe', 'Œ': 'OE', 'æ': 'ae', 'Æ': 'AE'}
+
+
+def fold_accents(word):
+    """Remove diacritics and expand ligatures: 'péché' -> 'peche', 'cœur' -> 'coeur'.
+    """
+    for ligature, letters in LIGATURES.items():
+        word = word.replace(ligature, letters)
+    return ''.join(char for char in unicodedata.normalize('NFD', word) if not unicodedata.combining(char))
+
+
+class StringTable:
+    """Sorted UTF-8 strings stored back to back in a memory-mapped blob with an array of offsets.
+    Items are bytes, so that bisect compares them without decoding (UTF-8 keeps the order of code points).
+    """
+    def __init__(self, blob_file, offsets_file):
+        # indexing a memoryview returns Python ints, which is much faster than indexing numpy arrays
+        self.offsets = memoryview(np.load(offsets_file, mmap_mode='r'))
+        if os.path.getsize(blob_file) > 0:
+            with open(blob_file, 'rb') as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.blob = b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ind):
+        return self.blob[self.offsets[ind]:self.offsets[ind+1]]
+
+    def find(self, string):
+        """Return the range of items equal to string.
+        """
+        string = string.encode('utf-8')
+        return bisect.bisect_left(self, string), bisect.bisect_right(self, string)
+
+    def find_prefix(self, prefix):
+        """Return the range of items starting with prefix.
+        """
+        prefix = prefix.encode('utf-8')
+        # 0xff never appears in UTF-8
+        return bisect.bisect_left(self, prefix), bisect.bisect_left(self, prefix + b'\xff')
+
+
+def write_string_table(strings, blob_file, offsets_file):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    with open(blob_file, 'wb') as f:
+        f.write(b''.join(encoded))
+    # np.save() adds .npy to filenames without it
+    with open(offsets_file, 'wb') as f:
+        np.save(f, offsets)
+
+
+class Lexicon:
+    """Memory-mapped replacement of word_map.json: sorted header words, their accent-folded forms and
+    packed (word_path_id, def_ind, example_ind_start, num_examples) postings.
+    Lookups are binary searches over the mapped files, so workers share the index through the page cache.
+    """
+    def __init__(self, lexicon_path):
+        lexicon_path = Path(lexicon_path)
+        self.keys = StringTable(lexicon_path / Path('keys.bin'), lexicon_path / Path('keys.npy'))
+        self.folded_keys = StringTable(lexicon_path / Path('folded_keys.bin'), lexicon_path / Path('folded_keys.npy'))
+        self.word_paths = StringTable(lexicon_path / Path('word_paths.bin'), lexicon_path / Path('word_paths.npy'))
+        # key id of each folded key
+        self.folded_key_ids = memoryview(np.load(lexicon_path / Path('folded_key_ids.npy'), mmap_mode='r'))
+        # postings of key i are postings[key_postings[i]:key_postings[i+1]]
+        self.key_postings = memoryview(np.load(lexicon_path / Path('key_postings.npy'), mmap_mode='r'))
+        self.postings = np.load(lexicon_path / Path('postings.npy'), mmap_mode='r')
+
+    def __contains__(self, word):
+        key_start, key_end = self.keys.find(word)
+        return key_end > key_start
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find_keys(self, word, mode='exact', max_keys=None):
+        """Return the ids of the keys matching a (lowercased) word.
+        'unaccented' ignores diacritics, 'prefix' finds keys starting with the word regardless of diacritics.
+        """
+        if mode == 'exact':
+            return list(range(*self.keys.find(word)))
+        if mode == 'unaccented':
+            folded_start, folded_end = self.folded_keys.find(fold_accents(word))
+        elif mode == 'prefix':
+            folded_start, folded_end = self.folded_keys.find_prefix(fold_accents(word))
+        else:
+            raise ValueError(f'unknown match mode {mode!r}, expected one of {MATCH_MODES}')
+        if max_keys is not None:
+            folded_end = min(folded_end, folded_start + max_keys)
+        return sorted(self.folded_key_ids[folded_start:folded_end].tolist())
+
+    def lookup(self, word, mode='exact', max_keys=None):
+        """Return (word_path, def_ind, example_ind_start, num_examples) of the definitions of the keys matching a word.
+        """
+        results = []
+        for key_id in self.find_keys(word, mode=mode, max_keys=max_keys):
+            for word_path_id, def_ind, example_ind_start, num_examples in \
+                    self.postings[self.key_postings[key_id]:self.key_postings[key_id+1]].tolist():
+                results.append((self.word_paths[word_path_id].decode('utf-8'), def_ind, example_ind_start, num_examples))
+        return results
+
+
+def load_lexicon(lexicon_path):
+    """Load a lexicon written by build_lexicon().
+    """
+    return Lexicon(lexicon_path)
+
+
+def build_lexicon(word_maps, lexicon_path):
+    """Build a lexicon from word maps returned by map_words() (or merged into one word map like word_map.json).
+    Files are replaced one by one with index.json last.
+    """
+    entries = set()
+    for word_map in word_maps:
+        for word, word_paths in word_map.items():
+            for word_path, def_example_inds in word_paths.items():
+                for def_ind, example_ind_start, num_examples in def_example_inds:
+                    entries.add((word.encode('utf-8'), word_path, def_ind, example_ind_start, num_examples))
+    entries = sorted(entries)
+    word_paths = sorted(set(entry[1] for entry in entries), key=lambda word_path: word_path.encode('utf-8'))
+    word_path_ids = {word_path: ind for ind, word_path in enumerate(word_paths)}
+    keys = []
+    key_postings = []
+    for ind, (word, *_) in enumerate(entries):
+        if (not keys) or (keys[-1] != word):
+            keys.append(word)
+            key_postings.append(ind)
+    key_postings.append(len(entries))
+    postings = np.array([(word_path_ids[word_path], def_ind, example_ind_start, num_examples)
+                         for _, word_path, def_ind, example_ind_start, num_examples in entries],
+                        dtype=np.int32).reshape(-1, 4)
+    keys = [key.decode('utf-8') for key in keys]
+    folded = sorted(((fold_accents(key).encode('utf-8'), key_id) for key_id, key in enumerate(keys)))
+
+    lexicon_path = Path(lexicon_path)
+    os.makedirs(lexicon_path, exist_ok=True)
+    files = []
+
+    def tmp_file(filename):
+        files.append(filename)
+        return lexicon_path / Path(f'{filename}.tmp')
+
+    write_string_table(keys, tmp_file('keys.bin'), tmp_file('keys.npy'))
+    write_string_table([folded_key.decode('utf-8') for folded_key, _ in folded],
+                       tmp_file('folded_keys.bin'),
+                       tmp_file('folded_keys.npy'))
+    write_string_table(word_paths, tmp_file('word_paths.bin'), tmp_file('word_paths.npy'))
+    with open(tmp_file('folded_key_ids.npy'), 'wb') as f:
+        np.save(f, np.array([key_id for _, key_id in folded], dtype=np.int32))
+    with open(tmp_file('key_postings.npy'), 'wb') as f:
+        np.save(f, np.array(key_postings, dtype=np.int64))
+    with open(tmp_file('postings.npy'), 'wb') as f:
+        np.save(f, postings)
+    with open(tmp_file('index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'keys': len(keys), 'postings': len(entries), 'word_paths': len(word_paths)}, f)
+    for filename in files:
+        os.replace(lexicon_path / Path(f'{filename}.tmp'), lexicon_path / Path(filename))
+
+
+def convert_word_map_to_lexicon(word_map_file, lexicon_path):
+    """Build a lexicon from word_map.json.
+    """
+    with open(word_map_file, 'r', encoding='utf-8') as f:
+        word_map = json.load(f)
+    build_lexicon([word_map], lexicon_path)
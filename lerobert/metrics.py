@@ -0,0 +1,307 @@
+import os
+import time
+import math
+import cProfile
+import pstats
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# upper bounds (seconds) of histogram buckets, from sub-millisecond lookups to slow forward passes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_MODES = ('cprofile', 'torch')
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = [*zip(labelnames, labelvalues), *extra]
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Thread-safe Prometheus histogram with one series per combination of label values.
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = (*sorted(buckets), math.inf)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            if labelvalues not in self._series:
+                self._series[labelvalues] = [[0]*len(self.buckets), 0.0, 0]
+            counts, _, _ = series = self._series[labelvalues]
+            for ind, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[ind] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labelvalues: ([*counts], total, count) for labelvalues, (counts, total, count) in self._series.items()}
+        for labelvalues, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labelnames, labelvalues, [('le', format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose values are read when metrics are collected: function returns
+    {label values: value}, e.g. the size of the inference queue of each loaded model.
+    """
+    def __init__(self, name, documentation, labelnames=(), function=dict, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.metric_type = metric_type
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for labelvalues, value in sorted(self.function().items()):
+            if value is not None:
+                lines.append(f'{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics rendered in the Prometheus text format by GET /metrics.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return ''.join(line + '\n' for metric in self.metrics.values() for line in metric.collect())
+
+
+REGISTRY = MetricsRegistry()
+REQUEST_SECONDS = REGISTRY.register(Histogram('lerobert_request_seconds',
+                                              'Duration of HTTP requests until the response starts.',
+                                              ('method', 'endpoint', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram('lerobert_stage_seconds',
+                                            'Duration of the stages of requests (tagging, tokenization, forward pass, ...).',
+                                            ('model', 'stage')))
+BATCH_SECONDS = REGISTRY.register(Histogram('lerobert_batch_seconds',
+                                            'Duration of the forward passes of batches run by the inference schedulers.',
+                                            ('model',)))
+BATCH_SIZE = REGISTRY.register(Histogram('lerobert_batch_size',
+                                         'Number of sequences in the batches run by the inference schedulers.',
+                                         ('model',), buckets=(1, 2, 4, 8, 16, 32, 64)))
+
+
+def process_memory(pid='self'):
+    """Return the resident (rss), proportional (pss) and private (uss) memory of a process in bytes (Linux only).
+    Pages shared by forked workers count once in rss of each worker, pss splits them between the workers.
+    """
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0])*1024
+    except OSError:
+        return {}
+    return {'rss': memory.get('Rss'),
+            'pss': memory.get('Pss'),
+            'uss': memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)}
+
+
+class RequestTimings:
+    """Durations of the stages of one request, reported in its Server-Timing header.
+    """
+    def __init__(self):
+        self.time_start = time.perf_counter()
+        self.spans = []
+        # 'cprofile' or 'torch' when the request is profiled
+        self.profile_mode = None
+        self.profile_path = None
+        self.profile_name = None
+        self.profiles = []
+        self.trace_files = []
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, model=''):
+        with self._lock:
+            self.spans.append((name, seconds))
+        STAGE_SECONDS.observe(seconds, model, name)
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header: the total duration of each stage in milliseconds.
+        """
+        totals = {}
+        with self._lock:
+            for name, seconds in self.spans:
+                totals[name] = totals.get(name, 0.0) + seconds
+        totals['total'] = time.perf_counter() - self.time_start
+        return ', '.join(f'{name};dur={seconds*1000:.3f}' for name, seconds in totals.items())
+
+
+# timings of the request being handled, run_in_threadpool() copies the context into worker threads
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+# the model of the stages of the current task, the tasks of /definitions/compare encode with different models
+_request_model = contextvars.ContextVar('request_model', default='')
+_profiling = threading.local()
+
+
+def current_timings():
+    return _request_timings.get()
+
+
+def set_model(model_name):
+    """Label the stages recorded afterwards by the current request (or task of a request) with the name of its model.
+    """
+    if _request_timings.get() is not None:
+        _request_model.set(model_name)
+
+
+def record(name, seconds):
+    """Add a stage measured elsewhere (e.g. by the inference scheduler) to the current request.
+    """
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(name, seconds, _request_model.get())
+
+
+@contextmanager
+def span(name):
+    """Time a stage of the current request. Outside of requests, nothing is recorded.
+    In profiled requests ('cprofile' mode), the outermost span of each thread is profiled.
+    """
+    timings = _request_timings.get()
+    if timings is None:
+        yield
+        return
+    profile = None
+    if (timings.profile_mode == 'cprofile') and not getattr(_profiling, 'active', False):
+        profile = cProfile.Profile()
+        _profiling.active = True
+        profile.enable()
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - time_start
+        if profile is not None:
+            profile.disable()
+            _profiling.active = False
+            with timings._lock:
+                timings.profiles.append(profile)
+        timings.add(name, seconds, _request_model.get())
+
+
+def trace_file():
+    """Return the file the forward pass of the current request should be traced to, if it is profiled with torch.
+    """
+    timings = _request_timings.get()
+    if (timings is None) or (timings.profile_mode != 'torch'):
+        return None
+    with timings._lock:
+        filename_path = timings.profile_path / Path(f'{timings.profile_name}-{len(timings.trace_files)}.json')
+        timings.trace_files.append(filename_path)
+    return filename_path
+
+
+class RequestProfiler:
+    """Profile one request in every_n requests to the profiled endpoints: 'cprofile' saves the Python stages
+    of the request as a .prof file (pstats), 'torch' saves a Chrome trace of its forward pass (torch.profiler).
+    """
+    def __init__(self, every_n, mode='cprofile', profile_path='./profiles/',
+                 paths=('/definitions', '/definitions/compare', '/annotate', '/nearest')):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'unknown profile mode {mode!r}, expected one of {PROFILE_MODES}')
+        self.every_n = every_n
+        self.mode = mode
+        self.profile_path = Path(profile_path)
+        self.paths = paths
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def sample(self, scope):
+        if (not self.every_n) or (scope['path'] not in self.paths):
+            return False
+        with self._lock:
+            self._count += 1
+            return self._count % self.every_n == 0
+
+    def start(self, timings, scope):
+        os.makedirs(self.profile_path, exist_ok=True)
+        timings.profile_mode = self.mode
+        timings.profile_path = self.profile_path
+        timings.profile_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['path'].strip('/')}-{self._count}"
+
+    def save(self, timings):
+        if timings.profiles:
+            stats = pstats.Stats(timings.profiles[0])
+            for profile in timings.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.profile_path / Path(f'{timings.profile_name}.prof'))
+
+
+class TimingMiddleware:
+    """ASGI middleware timing every HTTP request: the stages recorded with span() are sent in a Server-Timing
+    header and observed in the histograms, and sampled requests are profiled.
+    """
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        profiled = (self.profiler is not None) and self.profiler.sample(scope)
+        if profiled:
+            self.profiler.start(timings, scope)
+        token = _request_timings.set(timings)
+        model_token = _request_model.set('')
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                headers = [*message.get('headers', []), (b'server-timing', timings.server_timing().encode('latin-1'))]
+                message = {**message, 'headers': headers}
+                # the router has put the endpoint into the scope
+                endpoint = getattr(scope.get('endpoint'), '__name__', 'none')
+                REQUEST_SECONDS.observe(time.perf_counter() - timings.time_start, scope['method'], endpoint, str(status))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
+            _request_model.reset(model_token)
+            if profiled:
+                self.profiler.save(timings)
@@ -1,44 +1,184 @@
 import os
 from pathlib import Path
 import concurrent.futures
+import threading
+import queue
+import itertools
+import traceback
 import re
-from collections import defaultdict
+import json
+import time
+from collections import defaultdict, Counter
+from contextlib import nullcontext
 from tqdm import tqdm
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, NavigableString
+import numpy as np
 import torch
 
+from lerobert.metrics import span
+from lerobert.lemmas import count_lemmas, save_page_lemmas
+
+
+
+class TaskError:
+    """Stands for the result of an item whose task raised an exception.
+    """
+    def __init__(self, item, exception, traceback_string):
+        self.item = item
+        self.exception = exception
+        self.traceback = traceback_string
+
+    def __repr__(self):
+        return f'TaskError({self.item!r}, {self.exception!r})'
+
+
+# state created by an initializer in each worker (thread or process) of imap_async()
+_worker_state = threading.local()
+
+
+def _initialize_worker(initializer, initargs):
+    _worker_state.kwargs = initializer(*initargs) or {}
+
+
+def _run_task(function, item, args, kwargs):
+    try:
+        return function(item, *args, **getattr(_worker_state, 'kwargs', {}), **kwargs)
+    except Exception as e:
+        return TaskError(item, e, traceback.format_exc())
+
+
+def imap_async(function, sequence, *args, processes=False, max_workers=None, max_in_flight=None, ordered=True,
+               initializer=None, initargs=(), **kwargs):
+    """Execute a function that takes an argument from a sequence (and args and/or kwargs optionally)
+    in a pool of threads or processes that lives for the whole run, and yield results as they are ready.
+    At most max_in_flight items are submitted at a time, results are yielded in the order of the sequence
+    if ordered is set and as soon as they complete otherwise.
+    initializer(*initargs) is called once in each worker and returns a dict of kwargs for the function,
+    which is useful for expensive state such as a tagger or a model.
+    Exceptions don't stop the run: a TaskError is yielded for the items that failed.
+    """
+    executor_class = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    executor = executor_class(max_workers=max_workers,
+                              initializer=_initialize_worker if initializer else None,
+                              initargs=(initializer, initargs) if initializer else ())
+    if max_in_flight is None:
+        max_in_flight = 4*(max_workers or os.cpu_count() or 1)
+    total = len(sequence) if hasattr(sequence, '__len__') else None
+    items = iter(sequence)
+    # futures in the order of submission, each one mapped to its item
+    pending = {}
+
+    def submit(num_items):
+        for item in itertools.islice(items, num_items):
+            pending[executor.submit(_run_task, function, item, args, kwargs)] = item
+
+    try:
+        with tqdm(total=total) as progress:
+            submit(max_in_flight)
+            while pending:
+                if ordered:
+                    done = [next(iter(pending))]
+                else:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. the result couldn't be pickled or a worker process died
+                        result = TaskError(item, e, traceback.format_exc())
+                    progress.update(1)
+                    submit(1)
+                    yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
 
 def execute_async(function, sequence, processes=False, batch_size=64, max_workers=None, *args, **kwargs):
-    """Asynchronously execute a function that takes an argument from a sequence and args and/or kwargs optionally. 
-    """
-    results = []
-    for i in tqdm(range(0, len(sequence), batch_size)):
-        current_items = sequence[i:i+batch_size]
-        if processes:
-            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(function, item, *args, **kwargs) for item in current_items]
-        else:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(function, item, *args, **kwargs) for item in current_items]
-        for ft in futures:
-            results.append(ft.result())
-    return results
+    """Asynchronously execute a function that takes an argument from a sequence and args and/or kwargs optionally.
+    Return the list of results in the order of the sequence (TaskError for the items that failed).
+    """
+    return list(imap_async(function, sequence, *args, processes=processes, max_workers=max_workers,
+                           max_in_flight=batch_size, **kwargs))
+
+
+def init_tagger(**tagger_kwargs):
+    """Initializer for imap_async() creating a TreeTagger process in each worker.
+    """
+    import treetaggerwrapper as ttpw
+    return {'tagger': ttpw.TreeTagger(**tagger_kwargs)}
+
+
+def init_model(model_name, backend='fp32'):
+    """Initializer for imap_async() loading a tokenizer and a model in each worker.
+    """
+    from lerobert.backends import load_backend
+    tokenizer, model = load_backend(model_name, backend)
+    return {'tokenizer': tokenizer, 'model': model}
 
 
 def list_html_files(html_path='./assets/html/original/'):
     """Return a list of saved HTML files (filenames without extensions).
     """
-    return [item[:-5] for item in os.listdir(html_path)]
+    # compressed variants (.html.gz, .html.br) are saved next to processed files
+    return [item[:-5] for item in os.listdir(html_path) if item.endswith('.html')]
+
+
+# passes which only look for tags and attributes of original pages (links, URLs, whether they have definitions)
+# parse them with lxml when it is installed, which is faster. It closes unclosed tags (<p>one<p>two) where
+# html.parser nests them, so the definitions which are processed are always parsed with html.parser
+try:
+    import lxml
+    PAGE_PARSER = 'lxml'
+except ImportError:
+    PAGE_PARSER = 'html.parser'
+# first line of the sections saved by read_definitions_section(), sections saved without it
+# (by earlier builds parsing them with lxml) are parsed again from their pages
+SECTION_MARK = '<!-- html.parser -->\n'
+# parse_only strainers materialising the parts of original pages a pass needs:
+# the section with the definitions, links, or the URL of the page along with its sections
+DEFINITIONS_STRAINER = SoupStrainer('section', attrs={'class': 'def'})
+LINKS_STRAINER = SoupStrainer('a', href=True)
+CHECK_STRAINER = SoupStrainer(['meta', 'section'])
 
 
-def read_html_file(filename, html_path='./assets/html/original/'):
+def read_html_file(filename, html_path='./assets/html/original/', parser='html.parser', parse_only=None):
     """Read a saved version of HTML using filename (word_path) and return a soup object.
+    With parse_only (a SoupStrainer), only the matching tags are materialised.
     """
     filename_path = Path(html_path) / Path(f'{filename}.html')
     with open(filename_path, 'r', encoding='utf-8') as f:
-        content = ''.join(f.readlines())
-    return BeautifulSoup(content, 'html.parser')
+        content = f.read()
+    return BeautifulSoup(content, parser, parse_only=parse_only)
+
+
+def read_definitions_section(filename, html_path='./assets/html/original/', section_path=None):
+    """Return a soup of the section with the definitions of an original page, see find_definitions().
+    The section is parsed with html.parser like the whole page, only its tags are materialised.
+    With section_path, the section is saved there and read instead of the page as long as it is not older than the page.
+    """
+    filename_path = Path(html_path) / Path(f'{filename}.html')
+    if section_path is not None:
+        section_filename_path = Path(section_path) / Path(f'{filename}.html')
+        if os.path.isfile(section_filename_path) and \
+                (os.stat(section_filename_path).st_mtime_ns >= os.stat(filename_path).st_mtime_ns):
+            with open(section_filename_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            if content.startswith(SECTION_MARK):
+                return BeautifulSoup(content[len(SECTION_MARK):], 'html.parser')
+    soup = read_html_file(filename, html_path=html_path, parse_only=DEFINITIONS_STRAINER)
+    if section_path is not None:
+        os.makedirs(section_path, exist_ok=True)
+        with open(f'{section_filename_path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(SECTION_MARK + str(soup))
+        os.replace(f'{section_filename_path}.tmp', section_filename_path)
+    return soup
+
+
+def remove_definitions_section(filename, section_path='./assets/html/sections/'):
+    section_filename_path = Path(section_path) / Path(f'{filename}.html')
+    if os.path.isfile(section_filename_path):
+        os.remove(section_filename_path)
 
 
 def find_definitions(soup):
@@ -50,6 +190,10 @@ def find_definitions(soup):
         section_with_definitions = main_tag.find('section', class_='def', recursive=False)
         return section_with_definitions.find_all('div', class_='b', recursive=False)
     except AttributeError:
+        # original HTML parsed with a strainer, or saved by read_definitions_section()
+        section_with_definitions = soup.find('section', class_='def', recursive=False)
+        if section_with_definitions is not None:
+            return section_with_definitions.find_all('div', class_='b', recursive=False)
         # processed HTML
         return soup.find_all('div', class_='b', recursive=False)
 
@@ -74,7 +218,7 @@ def get_definition_header_data(definition_tag):
 def check_html_file(filename, html_path='./assets/html/original/'):
     """Check if an HTML file contains definitions and was saved using the word_path as its name.
     """
-    soup = read_html_file(filename, html_path=html_path)
+    soup = read_html_file(filename, html_path=html_path, parser=PAGE_PARSER, parse_only=CHECK_STRAINER)
     definitions_found = (len(find_definitions(soup)) > 0)
     try:
         orig_word_path = soup.find('meta', {'property': "og:url"})['content'].split('/')[-1]
@@ -94,66 +238,212 @@ def get_content(tag, indices):
     return res
 
 
+def walk_strings(tag):
+    """Yield the strings except '\n' of a tag in document order along with their parents (name, classes)
+    and content indices, in one pass which numbers the children of each tag on the way down.
+    """
+    # children left to visit of each tag of the current chain
+    stack = [(enumerate(tag.contents), (), ())]
+    while stack:
+        children, parents, indices = stack[-1]
+        for ind, child in children:
+            if isinstance(child, NavigableString):
+                if child != '\n':
+                    yield child, parents, indices + (ind,)
+                continue
+            # inside <div class="b"> all tags contain no more than one class
+            classes = child.get('class')
+            classes = ' '.join(classes) if classes is not None else None
+            stack.append((enumerate(child.contents), parents + ((child.name, classes),), indices + (ind,)))
+            break
+        else:
+            stack.pop()
+
+
 def locate_strings(tag):
     """Find all strings except '\n' in a tag and return them along with their parents and content indices.
     """
-    strings = []
-    for string in tag.find_all(string=True):
-        if string == '\n':
-            continue
-        tag_iter = string
-        parents = []
-        indices = []
-        indices.append(len(list(tag_iter.previous_siblings)))
-        while True:
-            tag_iter = tag_iter.parent
-            name = tag_iter.name
-            try:
-                # inside <div class="b"> all tags contain no more than one class
-                classes = ' '.join(tag_iter['class'])
-            except:
-                classes = None
-            if tag_iter == tag:
-                break
-            parents.append((name, classes))
-            indices.append(len(list(tag_iter.previous_siblings)))
-        strings.append({'string': string, 'parents': tuple(parents[::-1]), 'indices': tuple(indices[::-1])})
-
-    return strings
+    return [{'string': string, 'parents': parents, 'indices': indices}
+            for string, parents, indices in walk_strings(tag)]
 
 
-def index_strings_by_parents(filename, html_path='./assets/html/original/'):
+def index_strings_by_parents(filename, html_path='./assets/html/original/', section_path=None):
     """Using parents as keys, return indices needed to locate a string with such parents.
     """
-    definitions = find_definitions(read_html_file(filename, html_path=html_path))
-    parents = defaultdict(lambda: defaultdict(lambda: []))
+    definitions = find_definitions(read_definitions_section(filename, html_path=html_path, section_path=section_path))
+    parents = {}
     for def_ind, def_tag in enumerate(definitions):
-        strings = locate_strings(def_tag)
-        for string in strings:
-            parents[string['parents']][def_ind].append(string['indices'])
-    for key in parents:
-        parents[key] = dict(parents[key])
-    return filename, dict(parents)
+        for _, string_parents, indices in walk_strings(def_tag):
+            parents.setdefault(string_parents, {}).setdefault(def_ind, []).append(indices)
+    return filename, parents
+
+
+class StructureCounter:
+    """Counts of the strings of definitions by the chain of their parents (their structural signature):
+    the number of strings and of pages with each signature and up to max_samples (filename, def_ind, indices)
+    locations of its strings in different pages, and TaskErrors of the pages that couldn't be read. Counters are plain dicts,
+    so they are pickled back from worker processes and merged with merge().
+    """
+    def __init__(self, max_samples=5):
+        self.max_samples = max_samples
+        self.num_pages = 0
+        self.strings = Counter()
+        self.pages = Counter()
+        self.samples = {}
+        self.errors = []
+
+    def __len__(self):
+        return len(self.strings)
+
+    def add_page(self, filename, definitions):
+        signatures = set()
+        for def_ind, def_tag in enumerate(definitions):
+            for _, parents, indices in walk_strings(def_tag):
+                self.strings[parents] += 1
+                if parents in signatures:
+                    continue
+                signatures.add(parents)
+                # one sample per page
+                samples = self.samples.setdefault(parents, [])
+                if len(samples) < self.max_samples:
+                    samples.append((filename, def_ind, indices))
+        self.pages.update(signatures)
+        self.num_pages += 1
+
+    def merge(self, other):
+        self.num_pages += other.num_pages
+        self.errors.extend(other.errors)
+        self.strings.update(other.strings)
+        self.pages.update(other.pages)
+        for parents, other_samples in other.samples.items():
+            samples = self.samples.setdefault(parents, [])
+            samples.extend(other_samples[:self.max_samples - len(samples)])
+        return self
+
+    def report(self, top=None):
+        """Return the signatures sorted by their number of strings, the most frequent first.
+        """
+        signatures = sorted(self.strings, key=lambda parents: (-self.strings[parents], parents))[:top]
+        return [{'parents': parents,
+                 'strings': self.strings[parents],
+                 'pages': self.pages[parents],
+                 'samples': self.samples.get(parents, [])}
+                for parents in signatures]
+
+
+def count_structures(filenames, html_path='./assets/html/original/', section_path=None, max_samples=5):
+    """Count the structural signatures of the strings of the definitions of a chunk of pages.
+    """
+    counter = StructureCounter(max_samples=max_samples)
+    for filename in filenames:
+        try:
+            definitions = find_definitions(read_definitions_section(filename, html_path=html_path,
+                                                                    section_path=section_path))
+        except Exception as e:
+            counter.errors.append(TaskError(filename, e, traceback.format_exc()))
+            continue
+        counter.add_page(filename, definitions)
+    return counter
+
+
+def analyze_structure(filenames, html_path='./assets/html/original/', section_path=None, max_samples=5,
+                      chunk_size=64, processes=True, max_workers=None):
+    """Count the structural signatures of all pages in chunks of chunk_size pages run in a pool of processes
+    and merge the counters of the chunks into one StructureCounter.
+    """
+    chunks = [filenames[start:start+chunk_size] for start in range(0, len(filenames), chunk_size)]
+    counter = StructureCounter(max_samples=max_samples)
+    for res in imap_async(count_structures, chunks, html_path=html_path, section_path=section_path,
+                          max_samples=max_samples, processes=processes, max_workers=max_workers, ordered=False):
+        if isinstance(res, TaskError):
+            counter.errors.append(res)
+            continue
+        counter.merge(res)
+    return counter
 
 
 # TAGGING WORDS
-def tag_text(text, tagger):
-    """Tag text and return a list of dictionaries containing 'word', 'pos', and 'lemma'.
+# SGML tag separating texts tagged with one TreeTagger call
+TEXT_SEPARATOR = '<lerobert-text-separator />'
+
+
+def parse_tags(lines):
+    """Turn TreeTagger output lines into a list of dictionaries containing 'word', 'pos', and 'lemma'.
     """
     tags = []
-    for t in tagger.tag_text(text):
+    for t in lines:
         word, pos, lemma = t.split('\t')
         tags.append({'word': word, 'pos': pos, 'lemma': lemma})
     return tags
 
 
-def wrap_words(html_string, tagger, words=None, lemmas=None):
-    """Wrap words and/or lemmas in <span class="word"></span>.
+def tag_text(text, tagger):
+    """Tag text and return a list of dictionaries containing 'word', 'pos', and 'lemma'.
+    """
+    return parse_tags(tagger.tag_text(text))
+
+
+def tag_texts(texts, tagger):
+    """Tag several texts with a single round-trip to the TreeTagger process and return a list of tags per text.
+    Tags are the same as those of tag_text() called for each text: treetaggerwrapper follows every text
+    with an SGML mark, '.' and a dummy sentence, and TreeTagger ignores SGML tags,
+    so texts are separated by the same sequence and see the same context.
+    """
+    import treetaggerwrapper as ttpw
+    prepared_texts = [tagger.tag_text(text, prepronly=True) for text in texts]
+    separator = [TEXT_SEPARATOR, '.', *tagger.dummysequence.split('\n'), TEXT_SEPARATOR]
+    lines = []
+    for ind, text_lines in enumerate(prepared_texts):
+        if ind > 0:
+            lines.extend(separator)
+        lines.extend(text_lines)
+    if not lines:
+        return [[] for _ in texts]
+    output = tagger.tag_text(lines, tagonly=True)
+
+    def num_output_lines(input_lines):
+        # TreeTagger outputs one line per token, SGML lines are copied unless the wrapper removes them
+        if tagger.removesgml:
+            return sum(1 for line in input_lines if not ttpw.is_sgml_tag(line))
+        return len(input_lines)
+
+    num_lines = [num_output_lines(text_lines) for text_lines in prepared_texts]
+    if sum(num_lines) + (len(texts) - 1)*num_output_lines(separator) != len(output):
+        # the framing of another version of treetaggerwrapper, texts are tagged one at a time
+        return [tag_text(text, tagger) for text in texts]
+    tags = []
+    ind_start = 0
+    for ind, num_text_lines in enumerate(num_lines):
+        if ind > 0:
+            ind_start += num_output_lines(separator)
+        tags.append(parse_tags(output[ind_start:ind_start + num_text_lines]))
+        ind_start += num_text_lines
+    return tags
+
+
+class TaggerPool:
+    """Pool of independent TreeTagger processes which can be used as one tagger from several threads.
+    """
+    def __init__(self, num_taggers=None, **tagger_kwargs):
+        import treetaggerwrapper as ttpw
+        self._taggers = queue.Queue()
+        for _ in range(num_taggers or os.cpu_count() or 1):
+            self._taggers.put(ttpw.TreeTagger(**tagger_kwargs))
+        tagger = self._taggers.queue[0]
+        self.dummysequence = tagger.dummysequence
+        self.removesgml = tagger.removesgml
+
+    def tag_text(self, text, **kwargs):
+        tagger = self._taggers.get()
+        try:
+            return tagger.tag_text(text, **kwargs)
+        finally:
+            self._taggers.put(tagger)
+
+
+def split_html_string(html_string):
+    """Split an HTML string into HTML tags and the strings between them.
     """
-    word_set = set(words) if words else set()
-    lemma_set = set(lemmas) if lemmas else set()
-    if not (word_set or lemma_set):
-        return html_string
     # html_string is expected to be a tag, 
     # i.e. html_string[0] = '<' and html_string[-1] = '>'
     html_tag_inds = [0]
@@ -165,15 +455,23 @@ def wrap_words(html_string, tagger, words=None, lemmas=None):
         html_tag_inds.extend(t.span())
         html_tags.append(html_string[html_tag_inds[-3]:html_tag_inds[-2]])
     html_tags.append(html_string[html_tag_inds[-1]:])
+    return html_tags, strings
+
+
+def wrap_tagged_words(html_tags, strings, text_tags, word_set, lemma_set):
+    """Wrap tagged words found in a set of words or lemmas in <span class="word"></span>
+    and join the strings with the HTML tags.
+    """
+    if not strings:
+        # an element without text
+        return ''.join(html_tags)
     string_lens = [len(s) for s in strings]
     acc_sum = 0
     string_acc_lens = []
     for string in strings:
         acc_sum += len(string)
         string_acc_lens.append(acc_sum)
-    # we want to use the whole string for tagging
     text_string = ''.join(strings)
-    text_tags = tag_text(text_string, tagger)
     text_tag_inds = [[] for _ in range(len(strings))]
     text_ind_start = 0
     cur_string_ind = 0
@@ -225,26 +523,74 @@ def wrap_words(html_string, tagger, words=None, lemmas=None):
     return updated_html_string
 
 
+def wrap_words(html_string, tagger, words=None, lemmas=None):
+    """Wrap words and/or lemmas in <span class="word"></span>.
+    """
+    word_set = set(words) if words else set()
+    lemma_set = set(lemmas) if lemmas else set()
+    if not (word_set or lemma_set):
+        return html_string
+    html_tags, strings = split_html_string(html_string)
+    # we want to use the whole string for tagging
+    text_tags = tag_text(''.join(strings), tagger)
+    return wrap_tagged_words(html_tags, strings, text_tags, word_set, lemma_set)
+
+
+def wrap_words_batch(html_strings, tagger, words_list, lemmas_list, lemma_counts=None):
+    """Same as wrap_words() for a list of HTML strings (with their own words and lemmas)
+    tagged with a single TreeTagger call. The lemmas of the tagged forms are added to lemma_counts if given.
+    """
+    results = list(html_strings)
+    items = []
+    for ind, (html_string, words, lemmas) in enumerate(zip(html_strings, words_list, lemmas_list)):
+        word_set = set(words) if words else set()
+        lemma_set = set(lemmas) if lemmas else set()
+        if word_set or lemma_set:
+            items.append((ind, *split_html_string(html_string), word_set, lemma_set))
+    texts_tags = tag_texts([''.join(strings) for _, _, strings, _, _ in items], tagger)
+    if lemma_counts is not None:
+        for text_tags in texts_tags:
+            count_lemmas(text_tags, lemma_counts)
+    for (ind, html_tags, strings, word_set, lemma_set), text_tags in zip(items, texts_tags):
+        results[ind] = wrap_tagged_words(html_tags, strings, text_tags, word_set, lemma_set)
+    return results
+
+
 def process_html(filename,
                  tagger,
                  orig_html_path='./assets/html/original/',
-                 proc_html_path='./assets/html/processed/'):
+                 proc_html_path='./assets/html/processed/',
+                 section_path=None,
+                 lemma_path=None):
     """Process original HTML files for their use locally.
+    With lemma_path, the lemmas TreeTagger gives to the forms of the examples are counted and saved
+    for the lemma table (see lerobert.lemmas).
     """
     processed_definitions = []
-    soup = read_html_file(filename, html_path=orig_html_path)
+    soup = read_definitions_section(filename, html_path=orig_html_path, section_path=section_path)
     def_tags = find_definitions(soup)
     # we're going to treat header words as both "words" and "lemmas" when tagging text
     example_ind_start = 0
     num_examples = 0
     # filename_stripped = filename.replace('-', '_')
     filename_stripped = filename
+    def_example_tags = []
+    def_words = []
     for def_tag in def_tags:
-        words = get_definition_header_data(def_tag)['words']
-        example_tags = def_tag.find_all(True, class_='d_xpl')
+        def_example_tags.append(def_tag.find_all(True, class_='d_xpl'))
+        def_words.append(get_definition_header_data(def_tag)['words'])
+    # all examples of the file are tagged with one TreeTagger call
+    words_list = [words for example_tags, words in zip(def_example_tags, def_words) for _ in example_tags]
+    lemma_counts = {} if lemma_path is not None else None
+    updated_examples = iter(wrap_words_batch([str(t) for example_tags in def_example_tags for t in example_tags],
+                                             tagger,
+                                             words_list,
+                                             words_list,
+                                             lemma_counts=lemma_counts))
+    for def_tag, example_tags in zip(def_tags, def_example_tags):
         num_examples += len(example_tags)
         for example_ind, example_tag in enumerate(example_tags, start=example_ind_start):
-            updated_example = wrap_words(str(example_tag), tagger, words=words, lemmas=words)
+            updated_example = next(updated_examples)
             updated_example_tag = BeautifulSoup(updated_example, 'html.parser')
             updated_example_tag = updated_example_tag.find(True, class_='d_xpl')
             updated_example_tag['id'] = f'{filename_stripped}_{example_ind}'
@@ -266,6 +612,8 @@ def process_html(filename,
     processed_definitions = processed_definitions.replace('/medias/IMAGES/originals/thumbnails', '/image-thumbnails')
     with open(proc_html_path + filename + '.html', 'w', encoding='utf-8') as f:
         f.write(processed_definitions)
+    if lemma_path is not None:
+        save_page_lemmas(filename, lemma_counts, lemma_path=lemma_path)
 
         
 def map_words(word_path, html_path='./assets/html/processed/'):
@@ -284,8 +632,69 @@ def map_words(word_path, html_path='./assets/html/processed/'):
         example_ind_start += len(example_tags)
         for word in words:
             word_map[word.lower()][word_path].append(def_example_inds)
-            
-    return word_map
+    # plain dicts can be sent back from worker processes
+    return {word: dict(word_paths) for word, word_paths in word_map.items()}
+
+
+
+# DEFINITION TEMPLATES
+# slot markers are private-use characters, so they can't clash with the dictionary content
+SLOT_MARK = '\ue000'
+re_slot = re.compile(f' ([a-z]+)="{SLOT_MARK}(\\d+){SLOT_MARK}"')
+
+
+def compile_definition_template(def_tag, attribute_names=('title', 'style')):
+    """Compile a definition tag into static HTML segments and numbered slots for the attributes
+    of <span class="word"></span> tags in its examples (class='d_xpl').
+    'def_tag' gets modified, so pass a freshly parsed tag.
+    """
+    for example_ind, example_tag in enumerate(def_tag.find_all(True, class_='d_xpl')):
+        for word_tag in example_tag.find_all(True, class_='word'):
+            for name in attribute_names:
+                word_tag[name] = f'{SLOT_MARK}{example_ind}{SLOT_MARK}'
+    parts = re_slot.split(str(def_tag))
+    # parts: segment, name, example_ind, segment, name, example_ind, ..., segment
+    segments = parts[0::3]
+    slots = [[name, int(example_ind)] for name, example_ind in zip(parts[1::3], parts[2::3])]
+    return {'segments': segments, 'slots': slots}
+
+
+def render_definition_template(template, attributes=None):
+    """Render a compiled definition by joining its segments with the attributes of each example:
+    attributes[example_ind] = {'title': ..., 'style': ...}. Slots without values are left out.
+    """
+    segments = template['segments']
+    parts = [segments[0]]
+    for (name, example_ind), segment in zip(template['slots'], segments[1:]):
+        if attributes and (example_ind < len(attributes)) and (name in attributes[example_ind]):
+            parts.append(f' {name}="{attributes[example_ind][name]}"')
+        parts.append(segment)
+    return ''.join(parts)
+
+
+def compile_templates_html_file(filename, html_path='./assets/html/processed/', template_path=None):
+    """Compile all definitions of a processed HTML file and save them as JSON if template_path is given.
+    """
+    def_tags = find_definitions(read_html_file(filename, html_path=html_path))
+    templates = [compile_definition_template(def_tag) for def_tag in def_tags]
+    if template_path is not None:
+        os.makedirs(template_path, exist_ok=True)
+        with open(Path(template_path) / Path(f'{filename}.json'), 'w', encoding='utf-8') as f:
+            json.dump(templates, f, ensure_ascii=False)
+    return templates
+
+
+def load_definition_templates(filename, template_path='./assets/templates/'):
+    """Load compiled definitions of a word_path saved by compile_templates_html_file().
+    """
+    with open(Path(template_path) / Path(f'{filename}.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def template_size(template):
+    """Approximate size of a compiled template in bytes.
+    """
+    return sum(len(segment) for segment in template['segments']) + 16*len(template['slots'])
 
 
 # EMBEDDINGS
@@ -333,47 +742,651 @@ def compute_embeddings_html_file(filename, tokenizer, model, embedding_path, htm
     torch.save(torch.stack(example_embeddings, dim=0), Path(embedding_path) / Path(f'{filename}.pt'))
 
 
+
+def read_examples_html_file(filename, html_path='./assets/html/processed'):
+    """Return the lowercased strings of each example (class='d_xpl') in a processed HTML file
+    along with flags telling if a string is inside <span class='word'></span>.
+    """
+    examples = []
+    for def_tag in find_definitions(read_html_file(filename, html_path=html_path)):
+        for example_tag in def_tag.find_all(True, class_='d_xpl'):
+            assert int(example_tag['id'].split('_')[-1]) == len(examples)
+            strings = []
+            flags = []
+            for string in example_tag.find_all(string=True):
+                strings.append(string.lower())
+                flags.append('word' in string.parent.get('class', []))
+            examples.append((strings, flags))
+    return examples
+
+
+def read_example_texts(filename, html_path='./assets/html/processed'):
+    """Return (def_ind, text) of each example (class='d_xpl') in a processed HTML file, in the order of the rows
+    of the embedding store.
+    """
+    examples = []
+    for def_ind, def_tag in enumerate(find_definitions(read_html_file(filename, html_path=html_path))):
+        for example_tag in def_tag.find_all(True, class_='d_xpl'):
+            examples.append((def_ind, ' '.join(example_tag.get_text().split())))
+    return examples
+
+
+def tokenize_examples(examples, tokenizer, max_length=512):
+    """Tokenize examples returned by read_examples_html_file() with one tokenizer call
+    and return their token ids along with masks of the tokens inside <span class='word'></span> tags.
+    Each string is tokenized as a separate word, so tokens are the same as in compute_embeddings_html_tag().
+    """
+    encodings = tokenizer([strings for strings, _ in examples],
+                          is_split_into_words=True,
+                          truncation=True,
+                          max_length=max_length)
+    word_masks = []
+    for ind, (_, flags) in enumerate(examples):
+        word_masks.append([(word_id is not None) and flags[word_id] for word_id in encodings.word_ids(ind)])
+    return encodings['input_ids'], word_masks
+
+
+def compute_embeddings_batch(input_ids, word_masks, model, pad_token_id):
+    """Run one padded forward pass over a batch of token id lists and perform mean pooling of the tokens in word_masks.
+    """
+    batch_len = max(len(ids) for ids in input_ids)
+    input_tensor = torch.full((len(input_ids), batch_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), batch_len), dtype=torch.long)
+    word_mask = torch.zeros((len(input_ids), batch_len), dtype=torch.bool)
+    for ind, (ids, mask) in enumerate(zip(input_ids, word_masks)):
+        input_tensor[ind, :len(ids)] = torch.tensor(ids)
+        attention_mask[ind, :len(ids)] = 1
+        word_mask[ind, :len(mask)] = torch.tensor(mask)
+    with torch.no_grad():
+        model_output = model(input_ids=input_tensor, attention_mask=attention_mask)
+    word_mask = word_mask.unsqueeze(-1).to(model_output[0].dtype)
+    return (model_output[0] * word_mask).sum(1) / word_mask.sum(1)
+
+
+def compute_embeddings_batched(filenames, tokenizer, model, html_path='./assets/html/processed',
+                               batch_size=32, buffer_size=1024):
+    """Compute embeddings for the examples of processed HTML files and yield (filename, embeddings) per file.
+    Examples are read from the files into a buffer of about buffer_size examples, tokenized at once,
+    sorted by their length and grouped into padded batches, so that little compute is spent on padding.
+    """
+    def process_buffer(buffer):
+        examples = [example for _, file_examples in buffer for example in file_examples]
+        input_ids, word_masks = tokenize_examples(examples, tokenizer)
+        order = sorted(range(len(examples)), key=lambda ind: len(input_ids[ind]))
+        embeddings = [None]*len(examples)
+        for i in range(0, len(order), batch_size):
+            batch_inds = order[i:i+batch_size]
+            batch_embeddings = compute_embeddings_batch([input_ids[ind] for ind in batch_inds],
+                                                        [word_masks[ind] for ind in batch_inds],
+                                                        model,
+                                                        tokenizer.pad_token_id)
+            for ind, example_embeddings in zip(batch_inds, batch_embeddings):
+                embeddings[ind] = example_embeddings
+        ind_start = 0
+        for filename, file_examples in buffer:
+            yield filename, torch.stack(embeddings[ind_start:ind_start+len(file_examples)], dim=0)
+            ind_start += len(file_examples)
+
+    buffer = []
+    num_buffered = 0
+    for filename in filenames:
+        examples = read_examples_html_file(filename, html_path=html_path)
+        if not examples:
+            continue
+        buffer.append((filename, examples))
+        num_buffered += len(examples)
+        if num_buffered >= buffer_size:
+            yield from process_buffer(buffer)
+            buffer = []
+            num_buffered = 0
+    if buffer:
+        yield from process_buffer(buffer)
+
+
+def compute_embeddings_corpus(filenames, tokenizer, model, store_path, html_path='./assets/html/processed',
+                              batch_size=32, buffer_size=1024, dtype='float32', num_components=None):
+    """Compute embeddings for all examples of processed HTML files in padded batches and write them
+    to an embedding store. Return the number of sentences and sentences per second.
+    With num_components, embeddings are projected on the principal components of the corpus, so the store
+    is written in float32 first and then converted (see convert_embedding_store()).
+    """
+    num_sentences = 0
+    time_start = time.perf_counter()
+
+    def items():
+        nonlocal num_sentences
+        progress = tqdm(total=len(filenames), unit='file')
+        for filename, embeddings in compute_embeddings_batched(filenames, tokenizer, model,
+                                                               html_path=html_path,
+                                                               batch_size=batch_size,
+                                                               buffer_size=buffer_size):
+            num_sentences += embeddings.shape[0]
+            progress.update(1)
+            progress.set_postfix(sentences_per_sec=f'{num_sentences/(time.perf_counter()-time_start):.1f}')
+            yield filename, embeddings
+        progress.close()
+
+    if num_components:
+        write_embedding_store(items(), store_path)
+        convert_embedding_store(store_path, store_path, dtype=dtype, num_components=num_components)
+    else:
+        write_embedding_store(items(), store_path, dtype=dtype)
+    seconds = time.perf_counter() - time_start
+    return {'sentences': num_sentences, 'seconds': seconds, 'sentences_per_sec': num_sentences/seconds}
+
+
+def lower_text(text):
+    """Lowercase a text keeping its length, so that character offsets stay valid.
+    """
+    text_lower = text.lower()
+    if len(text_lower) == len(text):
+        return text_lower
+    return ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+
+
+def tokenize_text(text, tokenizer):
+    """Tokenize the whole (lowercased) text once and return token ids, character spans without
+    surrounding whitespace and flags telling if a token starts a new whitespace-separated word.
+    """
+    encoding = tokenizer(lower_text(text), add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    spans = []
+    word_starts = []
+    prev_end = 0
+    for start, end in encoding['offset_mapping']:
+        while (start < end) and text[start].isspace():
+            start += 1
+        # tokens made of whitespace only (e.g. '▁') belong to the word after them
+        word_starts.append((not spans) or any(char.isspace() for char in text[prev_end:start]))
+        spans.append((start, end))
+        prev_end = max(prev_end, end)
+    return encoding['input_ids'], spans, word_starts
+
+
+def find_selection_tokens(spans, selection_start, selection_end):
+    """Return the range of tokens overlapping the selected characters (selections inside words included).
+    """
+    # spans are sorted, the first candidate is found with a binary search on their ends
+    ind_low, ind_high = 0, len(spans)
+    while ind_low < ind_high:
+        ind_mid = (ind_low + ind_high) // 2
+        if spans[ind_mid][1] <= selection_start:
+            ind_low = ind_mid + 1
+        else:
+            ind_high = ind_mid
+    token_start = None
+    token_end = None
+    for ind in range(ind_low, len(spans)):
+        start, end = spans[ind]
+        if start >= selection_end:
+            break
+        if (end > selection_start) and (start < end):
+            if token_start is None:
+                token_start = ind
+            token_end = ind + 1
+    if token_start is None:
+        # nothing but whitespace is selected
+        return 0, 0
+    # a whitespace-only token right before the selection is a part of the first selected word
+    if (token_start > 0) and (spans[token_start-1][0] == spans[token_start-1][1] == spans[token_start][0]):
+        token_start -= 1
+    return token_start, token_end
+
+
+def select_context_window(word_starts, token_start, token_end, max_length=510):
+    """Choose a window of up to max_length tokens with the same number of tokens on both sides of the selection.
+    The window never cuts a word in half. Return token ranges of the window and of the selection.
+    """
+    token_end = min(token_end, token_start + max_length)
+    lim_side = int((max_length - (token_end - token_start)) / 2)
+    window_start = max(0, token_start - lim_side)
+    while (window_start < token_start) and not word_starts[window_start]:
+        window_start += 1
+    window_end = min(len(word_starts), token_end + lim_side)
+    while (window_end < len(word_starts)) and (window_end > token_end) and not word_starts[window_end]:
+        window_end -= 1
+    return (window_start, window_end), (token_start, token_end)
+
+
+def window_input_ids(input_ids, window, tokenizer):
+    """Return token ids of a window of a tokenized text with special tokens added.
+    """
+    window_start, window_end = window
+    special_tokens = tokenizer('')['input_ids']
+    return [*special_tokens[:1], *input_ids[window_start:window_end], *special_tokens[1:]]
+
+
+def selection_mask(window, selection):
+    """Return the mask of the selected tokens in the token ids of a window (special tokens included).
+    """
+    (window_start, window_end), (token_start, token_end) = window, selection
+    return [*[False]*(token_start-window_start+1),
+            *[True]*(token_end-token_start),
+            *[False]*(window_end-token_end+1)]
+
+
+def prepare_selected_text_inputs(payload, tokenizer, max_length=510):
+    """Return token ids (special tokens included) of the context window around the selected text
+    and the mask of the selected tokens.
+    """
+    input_ids, spans, word_starts = tokenize_text(payload.text, tokenizer)
+    token_start, token_end = find_selection_tokens(spans, payload.selection_start, payload.selection_end)
+    window, selection = select_context_window(word_starts, token_start, token_end, max_length=max_length)
+    return window_input_ids(input_ids, window, tokenizer), selection_mask(window, selection)
+
+
+def pool_hidden_states(hidden_states, mask):
+    """Perform mean pooling of the hidden states of the masked tokens.
+    """
+    return torch.mean(hidden_states[mask, :], 0)
+
+
 def compute_embeddings_selected_text(payload, tokenizer, model, max_length=510):
     """Compute contextual embeddings for the selected text. 
     """
-    text_before = payload.text[:payload.selection_start]
-    text_selected = payload.text[payload.selection_start:payload.selection_end]
-    text_after = payload.text[payload.selection_end:]
-    
-    tokens_selected = tokenizer(text_selected.lower(), return_tensors='pt')['input_ids'][0][1:-1]
-    len_selected = tokens_selected.shape[0]
-    lim_side = int((max_length - len_selected) / 2)
-    
-    len_before = 0
-    word_tokens_before = []
-    for word in text_before.split(' ')[::-1]:
-        word_tokens = tokenizer(word.lower(), return_tensors='pt')['input_ids'][0][1:-1]
-        if len_before + word_tokens.shape[0] > lim_side:
+    # stages are timed when called while a request is handled
+    with span('tokenize'):
+        input_ids, mask = prepare_selected_text_inputs(payload, tokenizer, max_length=max_length)
+    tokens = torch.tensor(input_ids, dtype=torch.long).reshape(1, len(mask))
+    with span('forward'), torch.no_grad():
+        model_output = model(input_ids=tokens)
+    with span('pool'):
+        return pool_hidden_states(model_output[0][0], mask)
+
+
+# ANNOTATING TEXTS
+# TreeTagger parts of speech of the words worth annotating (verbs have subcategories such as VER:pres)
+CONTENT_POS = ('NOM', 'NAM', 'VER', 'ADJ', 'ADV')
+
+
+def locate_tags(text, tags):
+    """Find the character span of each tagged word in the text (None if TreeTagger changed the word).
+    """
+    spans = []
+    ind_start = 0
+    for tag in tags:
+        tag_ind_start = text.find(tag['word'], ind_start)
+        if tag_ind_start == -1:
+            spans.append(None)
+            continue
+        ind_start = tag_ind_start + len(tag['word'])
+        spans.append((tag_ind_start, ind_start))
+    return spans
+
+
+def split_windows(word_starts, max_length=510, stride=384):
+    """Split a tokenized text into windows of up to max_length tokens starting about every stride tokens,
+    so that consecutive windows overlap. Windows never cut a word in half (unless it is longer than a window).
+    """
+    windows = []
+    window_start = 0
+    while window_start < len(word_starts):
+        window_end = min(len(word_starts), window_start + max_length)
+        while (window_end < len(word_starts)) and (window_end > window_start + 1) and not word_starts[window_end]:
+            window_end -= 1
+        windows.append((window_start, window_end))
+        if window_end == len(word_starts):
             break
-        if word_tokens.shape[0] > 0:
-            word_tokens_before.append(word_tokens)
-            len_before += word_tokens.shape[0]
-    word_tokens_before = word_tokens_before[::-1]
-    
-    len_after = 0
-    word_tokens_after = []
-    for word in text_after.split(' '):
-        word_tokens = tokenizer(word.lower(), return_tensors='pt')['input_ids'][0][1:-1]
-        if len_after + word_tokens.shape[0] > lim_side:
+        next_start = min(window_start + stride, window_end)
+        while (next_start < window_end) and not word_starts[next_start]:
+            next_start += 1
+        window_start = next_start
+    return windows
+
+
+def assign_window(windows, token_start, token_end):
+    """Return the index of the window holding the tokens with the most context on their narrowest side.
+    """
+    best_ind = None
+    best_context = None
+    for ind, (window_start, window_end) in enumerate(windows):
+        if window_start > token_start:
             break
-        if word_tokens.shape[0] > 0:
-            word_tokens_after.append(word_tokens)
-            len_after += word_tokens.shape[0]
-    
-    mask = [*[False]*(len_before+1), *[True]*len_selected, *[False]*(len_after+1)]
-    special_tokens = tokenizer('', return_tensors='pt')['input_ids'][0]
-    tokens = torch.cat([special_tokens[:1], 
-                        *word_tokens_before, 
-                        tokens_selected, 
-                        *word_tokens_after, 
-                        special_tokens[1:]])
-    tokens = tokens.reshape(1, len(mask))
-    with torch.no_grad():
-        model_output = model(input_ids=tokens)
-        
-    return torch.mean(model_output[0][0][mask, :], 0)
+        context = min(token_start - window_start, window_end - token_end)
+        if (best_context is None) or (context > best_context):
+            best_ind, best_context = ind, context
+    return best_ind
+
+
+def prepare_annotation_inputs(text, spans, tokenizer, max_length=510, stride=384):
+    """Tokenize the whole text once, split it into overlapping windows and assign character spans to them.
+    Return token ids of each window (special tokens included) and (window index, mask) for each span
+    (None for spans without tokens).
+    """
+    input_ids, token_spans, word_starts = tokenize_text(text, tokenizer)
+    windows = split_windows(word_starts, max_length=max_length, stride=stride)
+    masks = []
+    for span in spans:
+        token_start, token_end = find_selection_tokens(token_spans, *span) if span else (0, 0)
+        if token_start == token_end:
+            masks.append(None)
+            continue
+        window_ind = assign_window(windows, token_start, token_end)
+        window_end = windows[window_ind][1]
+        masks.append((window_ind, selection_mask(windows[window_ind], (token_start, min(token_end, window_end)))))
+    return [window_input_ids(input_ids, window, tokenizer) for window in windows], masks
+
+
+# EMBEDDING STORE
+# dtypes of stores: int8 rows are scaled per row, each one by its maximum absolute value
+STORE_DTYPES = ('float32', 'float16', 'int8')
+
+
+class EmbeddingStore:
+    """Read-only, memory-mapped matrix of example embeddings with an offset table keyed by word_path.
+    Rows are float32, float16 or int8 with a float32 scale per row, optionally projected on
+    the principal components of the corpus (see fit_projection()), which queries are projected on too.
+    """
+    def __init__(self, store_path):
+        self.path = Path(store_path)
+        store_path = self.path
+        with open(store_path / Path('index.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.dim = index['dim']
+        self.offsets = index['offsets']
+        # rows of stores written with normalize=True have unit length
+        self.normalized = index.get('normalized', False)
+        self.projection = load_projection(store_path) if index.get('projection') else None
+        self.scales = None
+        if index['rows'] > 0:
+            self.matrix = np.memmap(store_path / Path('embeddings.bin'), dtype=self.dtype, mode='r',
+                                    shape=(index['rows'], self.dim))
+            if self.dtype == np.int8:
+                self.scales = np.memmap(store_path / Path('scales.bin'), dtype=np.float32, mode='r',
+                                        shape=(index['rows'],))
+        else:
+            self.matrix = np.empty((0, self.dim), dtype=self.dtype)
+            if self.dtype == np.int8:
+                self.scales = np.empty(0, dtype=np.float32)
+
+    def __contains__(self, word_path):
+        return word_path in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def rows(self, row_inds):
+        """Return rows of the matrix as float32 (int8 rows are multiplied by their scales).
+        """
+        matrix = np.asarray(self.matrix[row_inds], dtype=np.float32)
+        if self.scales is not None:
+            matrix *= np.asarray(self.scales[row_inds])[..., None]
+        return matrix
+
+    def get(self, word_path):
+        """Return the embeddings of all examples of a word_path (None if missing),
+        as a zero-copy slice of float stores and as float32 rows of int8 stores.
+        """
+        if word_path not in self.offsets:
+            return None
+        row_start, num_rows = self.offsets[word_path]
+        if self.scales is not None:
+            return self.rows(slice(row_start, row_start+num_rows))
+        return self.matrix[row_start:row_start+num_rows]
+
+    def project(self, embeddings):
+        """Project query embeddings like the rows of the store.
+        """
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.projection is None:
+            return embeddings
+        mean, components = self.projection
+        return ((normalize_embeddings(embeddings) if self.normalized else embeddings) - mean) @ components
+
+
+def load_embedding_store(store_path):
+    """Load an embedding store written by write_embedding_store().
+    """
+    return EmbeddingStore(store_path)
+
+
+def normalize_embeddings(embeddings, eps=1e-8):
+    """Scale rows of a numpy matrix to unit length, so that cosine similarity becomes a dot product.
+    """
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, eps)
+
+
+def fit_projection(embeddings, num_components):
+    """Return the mean and the first num_components principal components (dim x num_components) of embeddings.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    mean = embeddings.mean(axis=0)
+    _, _, vh = np.linalg.svd(embeddings - mean, full_matrices=False)
+    return mean, np.ascontiguousarray(vh[:num_components].T)
+
+
+def load_projection(store_path):
+    with np.load(Path(store_path) / Path('projection.npz')) as projection:
+        return projection['mean'], projection['components']
+
+
+def quantize_rows_int8(embeddings):
+    """Return int8 rows and the float32 scale of each row, rows ≈ int8 rows * scales.
+    """
+    scales = np.abs(embeddings).max(axis=-1) / 127
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    return np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8), scales
+
+
+def prepare_store_rows(word_path, embeddings, dtype, dim, normalize, projection=None):
+    # rows in the format of the store and their scales (None unless dtype is int8)
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.detach().cpu().numpy()
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if projection is not None:
+        # the projection of normalized stores is fitted on normalized rows
+        mean, components = projection
+        embeddings = ((normalize_embeddings(embeddings) if normalize else embeddings) - mean) @ components
+    if normalize:
+        embeddings = normalize_embeddings(embeddings)
+    assert (dim is None) or (embeddings.shape[1] == dim), \
+        f'{word_path}: expected {dim} dimensions, got {embeddings.shape[1]}'
+    if np.dtype(dtype) == np.int8:
+        embeddings, scales = quantize_rows_int8(embeddings)
+        return np.ascontiguousarray(embeddings), scales
+    return np.ascontiguousarray(embeddings, dtype=dtype), None
+
+
+def write_embedding_store(items, store_path, dtype='float32', normalize=True, projection=None):
+    """Write (word_path, embeddings) pairs into one contiguous matrix and an offset table.
+    Embeddings are projected with projection (mean, components) if given, and normalized unless normalize is False.
+    Files are replaced atomically, so a server that has the previous store mapped keeps working.
+    """
+    if np.dtype(dtype).name not in STORE_DTYPES:
+        raise ValueError(f'unknown store dtype {dtype}, expected one of {STORE_DTYPES}')
+    store_path = Path(store_path)
+    os.makedirs(store_path, exist_ok=True)
+    offsets = {}
+    num_rows = 0
+    dim = None
+    with open(store_path / Path('embeddings.bin.tmp'), 'wb') as f, \
+            open(store_path / Path('scales.bin.tmp'), 'wb') as scales_file:
+        for word_path, embeddings in items:
+            embeddings, scales = prepare_store_rows(word_path, embeddings, dtype, dim, normalize, projection)
+            dim = embeddings.shape[1]
+            f.write(embeddings.tobytes())
+            if scales is not None:
+                scales_file.write(scales.tobytes())
+            offsets[word_path] = [num_rows, embeddings.shape[0]]
+            num_rows += embeddings.shape[0]
+    index = {'dtype': np.dtype(dtype).name, 'dim': dim or 0, 'rows': num_rows, 'normalized': normalize,
+             'projection': projection is not None, 'offsets': offsets}
+    replace_store_files(index, store_path, projection)
+
+
+def replace_store_files(index, store_path, projection=None):
+    # the files written to .tmp files replace the ones of the store, index.json last
+    if projection is not None:
+        with open(store_path / Path('projection.npz.tmp'), 'wb') as f:
+            np.savez(f, mean=projection[0], components=projection[1])
+        os.replace(store_path / Path('projection.npz.tmp'), store_path / Path('projection.npz'))
+    with open(store_path / Path('index.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(store_path / Path('embeddings.bin.tmp'), store_path / Path('embeddings.bin'))
+    if index['dtype'] == 'int8':
+        os.replace(store_path / Path('scales.bin.tmp'), store_path / Path('scales.bin'))
+    elif os.path.isfile(store_path / Path('scales.bin.tmp')):
+        os.remove(store_path / Path('scales.bin.tmp'))
+    os.replace(store_path / Path('index.json.tmp'), store_path / Path('index.json'))
+
+
+def compact_embedding_store(store_path):
+    """Rewrite the rows of the word_paths of a store contiguously, dropping the rows of replaced or removed ones.
+    Rows are copied as they are, without quantizing them again.
+    """
+    store_path = Path(store_path)
+    store = EmbeddingStore(store_path)
+    with open(store_path / Path('index.json'), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    offsets = {}
+    num_rows = 0
+    with open(store_path / Path('embeddings.bin.tmp'), 'wb') as f, \
+            open(store_path / Path('scales.bin.tmp'), 'wb') as scales_file:
+        for word_path, (row_start, count) in sorted(store.offsets.items(), key=lambda item: item[1][0]):
+            f.write(np.ascontiguousarray(store.matrix[row_start:row_start+count]).tobytes())
+            if store.scales is not None:
+                scales_file.write(np.ascontiguousarray(store.scales[row_start:row_start+count]).tobytes())
+            offsets[word_path] = [num_rows, count]
+            num_rows += count
+    index.update(rows=num_rows, offsets=offsets)
+    replace_store_files(index, store_path)
+
+
+def update_embedding_store(items, store_path, remove=(), dtype='float32', normalize=True, max_garbage=0.25):
+    """Append (word_path, embeddings) pairs to an embedding store and drop the word_paths in remove.
+    Rows of replaced or removed word_paths stay in embeddings.bin until they take more than max_garbage of it,
+    then the store is compacted with compact_embedding_store().
+    dtype and normalize only apply to new stores, existing ones keep theirs (and their projection).
+    """
+    store_path = Path(store_path)
+    if not os.path.isfile(store_path / Path('index.json')):
+        write_embedding_store(items, store_path, dtype=dtype, normalize=normalize)
+        return
+    with open(store_path / Path('index.json'), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    offsets = index['offsets']
+    num_rows = index['rows']
+    dim = index['dim'] or None
+    dtype = np.dtype(index['dtype'])
+    normalize = index.get('normalized', False)
+    projection = load_projection(store_path) if index.get('projection') else None
+    scales_mode = 'r+b' if num_rows and os.path.isfile(store_path / Path('scales.bin')) else 'wb'
+    with open(store_path / Path('embeddings.bin'), 'r+b' if num_rows else 'wb') as f, \
+            open(store_path / Path('scales.bin'), scales_mode) if dtype == np.int8 else nullcontext() as scales_file:
+        # rows appended by an interrupted update are not in the index
+        f.truncate(num_rows * (dim or 0) * dtype.itemsize)
+        f.seek(0, os.SEEK_END)
+        if scales_file is not None:
+            scales_file.truncate(num_rows * 4)
+            scales_file.seek(0, os.SEEK_END)
+        for word_path, embeddings in items:
+            embeddings, scales = prepare_store_rows(word_path, embeddings, dtype, dim, normalize, projection)
+            dim = embeddings.shape[1]
+            f.write(embeddings.tobytes())
+            if scales is not None:
+                scales_file.write(scales.tobytes())
+            offsets[word_path] = [num_rows, embeddings.shape[0]]
+            num_rows += embeddings.shape[0]
+    for word_path in remove:
+        offsets.pop(word_path, None)
+    index.update(dim=dim or 0, rows=num_rows, offsets=offsets)
+    with open(store_path / Path('index.json.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(store_path / Path('index.json.tmp'), store_path / Path('index.json'))
+    num_live_rows = sum(count for _, count in offsets.values())
+    if num_rows - num_live_rows > max_garbage * num_rows:
+        compact_embedding_store(store_path)
+
+
+def convert_embedding_store(store_path, output_path, dtype='float32', num_components=None, max_rows=65536, seed=0):
+    """Write the rows of a store into a new one with another dtype and, with num_components,
+    projected on the principal components of a sample of max_rows rows. output_path can be store_path.
+    """
+    store = EmbeddingStore(store_path)
+    if store.projection is not None:
+        raise ValueError(f'{store_path} is already projected, convert the store it was projected from')
+    projection = None
+    if num_components:
+        rows = [np.arange(row_start, row_start + count) for row_start, count in store.offsets.values()]
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        if len(rows) > max_rows:
+            rows = np.sort(np.random.default_rng(seed).choice(rows, max_rows, replace=False))
+        projection = fit_projection(store.rows(rows), num_components)
+    word_paths = sorted(store.offsets, key=lambda word_path: store.offsets[word_path][0])
+    write_embedding_store(((word_path, store.get(word_path)) for word_path in word_paths),
+                          output_path,
+                          dtype=dtype,
+                          normalize=store.normalized,
+                          projection=projection)
+    if projection is None and os.path.isfile(Path(output_path) / Path('projection.npz')):
+        os.remove(Path(output_path) / Path('projection.npz'))
+
+
+def convert_embeddings_to_store(embedding_path, store_path, dtype='float32', normalize=True, num_components=None):
+    """Convert a tree of per-word_path .pt files saved by compute_embeddings_html_file() into an embedding store.
+    The .pt files keep the float32 outputs of the model, the store is written in dtype and, with num_components,
+    projected on the principal components of the corpus like in compute_embeddings_corpus().
+    """
+    word_paths = sorted(item[:-3] for item in os.listdir(embedding_path) if item.endswith('.pt'))
+    items = ((word_path, torch.load(Path(embedding_path) / Path(f'{word_path}.pt')))
+             for word_path in tqdm(word_paths))
+    if num_components:
+        write_embedding_store(items, store_path, normalize=normalize)
+        convert_embedding_store(store_path, store_path, dtype=dtype, num_components=num_components)
+    else:
+        write_embedding_store(items, store_path, dtype=dtype, normalize=normalize)
+
+
+# SCORING
+def score_definitions(embedding, embedding_store, definitions):
+    """Compute cosine similarity between an embedding and the examples of (word_path, def_ind, example_ind_start,
+    num_examples) definitions with one matrix-vector product over the gathered rows of the store.
+    Return an array of scores per definition (NaN for the examples missing from the store).
+    """
+    rows = []
+    missing = []
+    for ind, (word_path, _, example_ind_start, num_examples) in enumerate(definitions):
+        if word_path in embedding_store:
+            row_start = embedding_store.offsets[word_path][0] + example_ind_start
+            rows.append(np.arange(row_start, row_start + num_examples))
+        else:
+            missing.append(ind)
+            rows.append(np.zeros(num_examples, dtype=np.int64))
+    if not rows:
+        return []
+    matrix = embedding_store.rows(np.concatenate(rows))
+    # rows of int8 stores are only about unit length
+    if not embedding_store.normalized or embedding_store.scales is not None:
+        matrix = normalize_embeddings(matrix)
+    # queries are projected like the rows of the store
+    embedding = embedding_store.project(embedding)
+    scores = np.split(matrix @ normalize_embeddings(embedding),
+                      np.cumsum([len(def_rows) for def_rows in rows])[:-1])
+    for ind in missing:
+        scores[ind][:] = np.nan
+    return scores
+
+
+def rank_definitions(scores, rank='best'):
+    """Return the indices of definitions sorted by the best or mean score of their examples.
+    Definitions without scored examples come last in their original order.
+    """
+    def_scores = []
+    for def_example_scores in scores:
+        def_example_scores = def_example_scores[~np.isnan(def_example_scores)]
+        if len(def_example_scores) == 0:
+            def_scores.append(-np.inf)
+        elif rank == 'best':
+            def_scores.append(def_example_scores.max())
+        elif rank == 'mean':
+            def_scores.append(def_example_scores.mean())
+        else:
+            raise ValueError(f"unknown rank {rank!r}, expected 'best' or 'mean'")
+    return sorted(range(len(scores)), key=lambda ind: -def_scores[ind])
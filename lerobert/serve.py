@@ -0,0 +1,140 @@
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import argparse
+import traceback
+
+
+# workers exiting sooner than that after they have started are restarted with a delay
+MIN_WORKER_LIFETIME = 5.0
+
+
+def bind_socket(host='127.0.0.1', port=8000, backlog=2048):
+    """Return a listening socket inherited by forked workers, which accept connections from it in turn.
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, log_level='info'):
+    import uvicorn
+    config = uvicorn.Config(app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class PreforkServer:
+    """Fork workers serving an app loaded once by the parent process. Pages the parent has loaded before forking
+    (model weights, tokenizers, memory-mapped stores) are shared copy-on-write by all workers, so that a worker
+    only costs the memory of its own requests. Workers that exit are restarted until the server is stopped.
+    init_worker() is called in each worker for the state that can't be inherited (threads, subprocesses).
+    """
+    def __init__(self, app, sock, num_workers, num_threads=1, init_worker=None, log_level='info'):
+        self.app = app
+        self.sock = sock
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.init_worker = init_worker
+        self.log_level = log_level
+        # start times of the workers by pid
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                import torch
+                # before init_worker(), whose inference schedulers run with the threads of the thread creating them
+                torch.set_num_threads(self.num_threads)
+                if self.init_worker is not None:
+                    self.init_worker()
+                run_worker(self.app, self.sock, log_level=self.log_level)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        self.workers[pid] = time.monotonic()
+        print(f'worker {pid} started', flush=True)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.num_workers):
+            self.spawn()
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            time_start = self.workers.pop(pid, None)
+            if (time_start is None) or self.stopping:
+                continue
+            print(f'worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting it', flush=True)
+            if time.monotonic() - time_start < MIN_WORKER_LIFETIME:
+                time.sleep(1.0)
+            self.spawn()
+        self.sock.close()
+
+
+def serve(host='127.0.0.1', port=8000, num_workers=2, num_threads=None, preload_models=None, log_level='info'):
+    """Load main:app, the lexicon, embedding stores and models once and serve the app with forked workers.
+    """
+    import torch
+    # the OpenMP threads of the parent don't survive fork and forward passes of the workers would wait for them:
+    # the parent runs its operations (loading and quantizing models) on one thread
+    torch.set_num_threads(1)
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    sock = bind_socket(host, port)
+    import main
+    if preload_models is None:
+        preload_models = range(len(main.model_names))
+    main.preload_shared_state(preload_models)
+    # objects loaded so far are never collected, so that collections in workers don't write to their pages
+    gc.collect()
+    gc.freeze()
+    num_threads = num_threads or max(1, (os.cpu_count() or 1)//num_workers)
+    print(f'serving on {host}:{port} with {num_workers} workers of {num_threads} threads', flush=True)
+    PreforkServer(main.app, sock, num_workers, num_threads, init_worker=main.init_worker, log_level=log_level).run()
+
+
+if __name__ == '__main__':
+    # python -m lerobert.serve [--workers N] [--threads T] [--models INDEX ...], run from the repository root
+    parser = argparse.ArgumentParser(prog='python -m lerobert.serve',
+                                     description='Serve main:app with forked workers sharing models, embedding '
+                                                 'stores and the lexicon loaded once.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, help='torch threads per worker (cores / workers by default)')
+    parser.add_argument('--models', nargs='*', type=int,
+                        help='indices of the models to load before forking (all by default)')
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+    serve(host=args.host,
+          port=args.port,
+          num_workers=args.workers,
+          num_threads=args.threads,
+          preload_models=args.models,
+          log_level=args.log_level)
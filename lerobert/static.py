@@ -0,0 +1,174 @@
+import os
+import gzip
+import stat
+import hashlib
+import mimetypes
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+
+from lerobert.caching import LRUCache
+
+try:
+    # optional: pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# precompressed variants saved next to the files, in the order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.json', '.svg', '.txt')
+# strong ETags of the most recently served files keyed by (path, modification time, size)
+ETAG_CACHE_SIZE = 4096
+_etags = LRUCache(max_size=ETAG_CACHE_SIZE, size_function=lambda etag: 1)
+
+
+def compress_file(filename_path, min_size=256):
+    """Save gzip (and brotli if installed) variants of a file next to it, if they are smaller.
+    Stale variants of files that don't compress any more are removed.
+    """
+    filename_path = Path(filename_path)
+    with open(filename_path, 'rb') as f:
+        content = f.read()
+    compressors = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    for encoding, extension in ENCODINGS:
+        variant_path = Path(f'{filename_path}{extension}')
+        compressed = compressors[encoding](content) if (encoding in compressors) and (len(content) >= min_size) else None
+        if (compressed is None) or (len(compressed) >= len(content)):
+            if os.path.isfile(variant_path):
+                os.remove(variant_path)
+            continue
+        with open(f'{variant_path}.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(f'{variant_path}.tmp', variant_path)
+
+
+def remove_compressed_variants(filename_path):
+    for _, extension in ENCODINGS:
+        if os.path.isfile(f'{filename_path}{extension}'):
+            os.remove(f'{filename_path}{extension}')
+
+
+def has_fresh_variants(filename_path):
+    """Return True if a file has a compressed variant at least as recent as the file.
+    """
+    mtime = os.stat(filename_path).st_mtime_ns
+    for _, extension in ENCODINGS:
+        variant_path = f'{filename_path}{extension}'
+        if os.path.isfile(variant_path) and (os.stat(variant_path).st_mtime_ns >= mtime):
+            return True
+    return False
+
+
+def compress_directory(path, recursive=False):
+    """Compress text files of a directory whose variants are missing or older than the files.
+    """
+    filename_paths = Path(path).rglob('*') if recursive else Path(path).glob('*')
+    for filename_path in filename_paths:
+        if (filename_path.suffix in COMPRESSIBLE_EXTENSIONS) and filename_path.is_file() \
+                and not has_fresh_variants(filename_path):
+            compress_file(filename_path)
+
+
+def content_etag(content):
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def file_content_etag(filename_path):
+    with open(filename_path, 'rb') as f:
+        return content_etag(f.read())
+
+
+async def file_etag(filename_path, stat_result):
+    """ETag of a file, hashed in a thread when it is missing from the cache, not to block the event loop.
+    """
+    key = (str(filename_path), stat_result.st_mtime_ns, stat_result.st_size)
+    etag = _etags.get(key)
+    if etag is None:
+        etag = await run_in_threadpool(file_content_etag, filename_path)
+        _etags.put(key, etag)
+    return etag
+
+
+def accepted_encodings(accept_encoding):
+    """Return the content codings accepted by a client (with a non-zero quality) from an Accept-Encoding header.
+    """
+    encodings = set()
+    for item in accept_encoding.split(','):
+        encoding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if encoding and (quality > 0):
+            encodings.add(encoding.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an ETag with the ones in an If-None-Match header.
+    """
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+async def static_file_response(request, filename_path, cache_control='no-cache'):
+    """Serve a file or its precompressed variant accepted by the client with a strong ETag,
+    answering 304 if the client has the same representation. Return None if the file doesn't exist.
+    """
+    filename_path = Path(filename_path)
+    try:
+        stat_result = os.stat(filename_path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    etag = await file_etag(filename_path, stat_result)
+    headers = {'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    path = filename_path
+    encodings = accepted_encodings(request.headers.get('accept-encoding', ''))
+    for encoding, extension in ENCODINGS:
+        variant_path = Path(f'{filename_path}{extension}')
+        if encoding not in encodings:
+            continue
+        try:
+            variant_stat_result = os.stat(variant_path)
+        except FileNotFoundError:
+            continue
+        # variants older than the file are stale
+        if variant_stat_result.st_mtime_ns >= stat_result.st_mtime_ns:
+            path = variant_path
+            etag = f'{etag}-{encoding}'
+            headers['Content-Encoding'] = encoding
+            break
+    headers['ETag'] = f'"{etag}"'
+    if etag_matches(request.headers.get('if-none-match', ''), headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    media_type = mimetypes.guess_type(filename_path.name)[0] or 'application/octet-stream'
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+class PrecomputedResponse:
+    """Body of a response computed once, served with its ETag and 304 when the client has it.
+    """
+    def __init__(self, content, media_type='text/html', cache_control='no-cache'):
+        self.content = content.encode('utf-8') if isinstance(content, str) else content
+        self.media_type = media_type
+        self.etag = f'"{content_etag(self.content)}"'
+        self.cache_control = cache_control
+
+    def response(self, request):
+        headers = {'ETag': self.etag, 'Cache-Control': self.cache_control}
+        if etag_matches(request.headers.get('if-none-match', ''), self.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.content, media_type=self.media_type, headers=headers)
@@ -0,0 +1,57 @@
+import sys
+import json
+import time
+import argparse
+
+from lerobert.processing import list_html_files, analyze_structure
+
+
+ORIGINAL_HTML_PATH = './assets/html/original/'
+SECTION_HTML_PATH = './assets/html/sections/'
+REPORT_FILE = './structure_report.json'
+
+
+def format_parents(parents):
+    """Write a chain of (name, classes) parents like a CSS selector: div.d_ptma > span.d_xpl
+    """
+    return ' > '.join(name + ''.join(f'.{cls}' for cls in (classes or '').split()) for name, classes in parents)
+
+
+def write_structure_report(counter, report_file, seconds=None):
+    """Save the signatures of a StructureCounter, the most frequent first, with the pages that failed.
+    """
+    report = {'pages': counter.num_pages,
+              'signatures': len(counter),
+              'seconds': seconds,
+              'errors': [{'word_path': error.item, 'error': repr(error.exception)} for error in counter.errors],
+              'structures': [{'selector': format_parents(row['parents']), **row} for row in counter.report()]}
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == '__main__':
+    # python -m lerobert.structure [WORD_PATH ...], run from the repository root
+    parser = argparse.ArgumentParser(prog='python -m lerobert.structure',
+                                     description='Count the chains of parents of the strings of the definitions '
+                                                 'of all saved pages and where to find them.')
+    parser.add_argument('word_paths', nargs='*', help='pages to analyse (all by default)')
+    parser.add_argument('--output', default=REPORT_FILE)
+    parser.add_argument('--top', type=int, default=20, help='number of signatures printed')
+    parser.add_argument('--samples', type=int, default=5, help='locations saved per signature')
+    parser.add_argument('--workers', type=int, help='number of worker processes (one per core by default)')
+    args = parser.parse_args()
+    word_paths = args.word_paths or list_html_files(ORIGINAL_HTML_PATH)
+    time_start = time.perf_counter()
+    counter = analyze_structure(word_paths,
+                                html_path=ORIGINAL_HTML_PATH,
+                                section_path=SECTION_HTML_PATH,
+                                max_samples=args.samples,
+                                max_workers=args.workers)
+    seconds = time.perf_counter() - time_start
+    write_structure_report(counter, args.output, seconds=round(seconds, 2))
+    for row in counter.report(top=args.top):
+        print(f'{row["strings"]:>9} {row["pages"]:>7}  {format_parents(row["parents"])}')
+    print(f'{counter.num_pages} pages, {len(counter)} signatures, {len(counter.errors)} failed '
+          f'in {seconds:.1f}s, report written to {args.output}')
+    if counter.errors:
+        sys.exit(1)
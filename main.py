@@ -3,48 +3,289 @@ warnings.filterwarnings('ignore')
 
 import os
 import json
+import time
+import hashlib
+import asyncio
+import functools
+from collections import deque
+from typing import List, Literal, Optional
 
-import matplotlib.pyplot as plt
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import HTMLResponse
-from starlette.responses import FileResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 
 import treetaggerwrapper as ttpw
-from transformers import AutoTokenizer, AutoModel
+import numpy as np
 import torch
 
 import lerobert.processing as lrp
+import lerobert.lexicon as lrl
+import lerobert.metrics as lrm
+from lerobert.caching import LRUCache, HiddenStateCache, VersionedCache, file_version
+from lerobert.inference import ModelRegistry, QueueFullError, SchedulerClosedError
+from lerobert.backends import load_backend, parse_model_backends
+from lerobert.static import static_file_response, PrecomputedResponse
+import lerobert.ann as lra
+from lerobert.lemmas import load_lemma_table, SelectionTagger
 
 
-html_files = set(lrp.list_html_files(html_path='./assets/html/processed'))
+# limits of the inference queue of each model
+MAX_BATCH_SIZE = int(os.environ.get('LEROBERT_MAX_BATCH_SIZE', 8))
+MAX_WAIT_MS = float(os.environ.get('LEROBERT_MAX_WAIT_MS', 5))
+MAX_QUEUE_SIZE = int(os.environ.get('LEROBERT_MAX_QUEUE_SIZE', 64))
+# models are loaded on first use, the least recently used ones are unloaded
+# when the loaded models take more than MODEL_MEMORY_BUDGET_MB
+MODEL_MEMORY_BUDGET_MB = os.environ.get('LEROBERT_MODEL_MEMORY_BUDGET_MB')
+# comma-separated indices of models to load at startup, e.g. "2"
+PRELOAD_MODELS = os.environ.get('LEROBERT_PRELOAD_MODELS', '')
+# backends of models other than 'fp32', e.g. "0=int8,1=onnx"
+MODEL_BACKENDS = os.environ.get('LEROBERT_MODEL_BACKENDS', '')
+# hidden states of encoded windows of texts kept for other selections in the same texts
+HIDDEN_STATE_CACHE_MB = float(os.environ.get('LEROBERT_HIDDEN_STATE_CACHE_MB', 256))
+# responses of /definitions kept for the same selection in the same context (0 disables the cache)
+DEFINITIONS_CACHE_MB = float(os.environ.get('LEROBERT_DEFINITIONS_CACHE_MB', 0))
+# seconds after which a cached response expires
+DEFINITIONS_CACHE_TTL = float(os.environ.get('LEROBERT_DEFINITIONS_CACHE_TTL', 600))
+# profile one request to /definitions, /annotate or /nearest in every LEROBERT_PROFILE_EVERY (0 disables profiling):
+# 'cprofile' saves the Python stages as .prof files, 'torch' saves Chrome traces of the forward passes
+PROFILE_EVERY = int(os.environ.get('LEROBERT_PROFILE_EVERY', 0))
+PROFILE_MODE = os.environ.get('LEROBERT_PROFILE_MODE', 'cprofile')
+PROFILE_PATH = os.environ.get('LEROBERT_PROFILE_PATH', './profiles/')
+# lists of the nearest-neighbour indexes scored by /nearest, more lists find more of the exact nearest examples
+ANN_NPROBE = int(os.environ.get('LEROBERT_ANN_NPROBE', 8))
+# forms of selections missing from the lemma table whose lemmas (tagged by TreeTagger in context) are cached
+LEMMA_CACHE_SIZE = int(os.environ.get('LEROBERT_LEMMA_CACHE_SIZE', 65536))
+# seconds between checks of the files replaced by python -m lerobert.build (lexicon, stores, indexes, pages)
+RELOAD_INTERVAL = float(os.environ.get('LEROBERT_RELOAD_INTERVAL', 1))
+# number of header words matched by a selected word in 'unaccented' and 'prefix' modes
+MAX_MATCHED_KEYS = 32
+
+
+# directories served by read_file() and the Cache-Control of their files:
+# pages, styles and scripts are revalidated with their ETags, media files don't change
+STATIC_PATHS = {'html': ('./assets/html/processed/', 'no-cache'),
+                'css': ('./assets/css/', 'no-cache'),
+                'js': ('./assets/js/', 'no-cache'),
+                'image-thumbnails': ('./assets/images/thumbnails/', 'public, max-age=604800'),
+                'audio': ('./assets/audio/', 'public, max-age=604800')}
+
+# the lexicon, lemma table, stores and indexes are loaded again when python -m lerobert.build replaces them,
+# the processed pages when it rewrites its manifest, see RELOAD_INTERVAL
+BUILD_MANIFEST_FILE = './assets/build_manifest.json'
+
+
+def clear_responses():
+    # responses built from the replaced lexicon, stores or pages
+    if definitions_cache is not None:
+        definitions_cache.clear()
+
+
+def clear_pages():
+    # pages processed again by a build: their compiled definitions and examples are dropped too
+    template_cache.clear()
+    example_cache.clear()
+    clear_responses()
+
+
+def load_html_files(key):
+    return set(lrp.list_html_files(html_path='./assets/html/processed'))
+
+
+def load_lexicon(key):
+    # the memory-mapped lexicon replaces word_map.json, it is built once from an existing word map
+    if not os.path.isfile('./assets/lexicon/index.json'):
+        lrl.convert_word_map_to_lexicon('./assets/word_map.json', './assets/lexicon/')
+    return lrl.load_lexicon('./assets/lexicon/')
+
+
+def load_selection_lemma_table(key):
+    table_file = './assets/lemmas/lemma_table.json'
+    return load_lemma_table(table_file) if os.path.isfile(table_file) else None
+
+
+html_file_sets = VersionedCache(load_html_files, lambda key: file_version(BUILD_MANIFEST_FILE),
+                                interval=RELOAD_INTERVAL, on_reload=clear_pages)
+lexicons = VersionedCache(load_lexicon, lambda key: file_version('./assets/lexicon/index.json'),
+                          interval=RELOAD_INTERVAL, on_reload=clear_responses)
+lemma_tables = VersionedCache(load_selection_lemma_table,
+                              lambda key: file_version('./assets/lemmas/lemma_table.json'),
+                              interval=RELOAD_INTERVAL)
+selection_tagger = SelectionTagger(cache_size=LEMMA_CACHE_SIZE)
+
+
+def get_html_files():
+    return html_file_sets.get()
+
+
+def get_lexicon():
+    return lexicons.get()
+
+
+def get_selection_tagger():
+    # forms of the lemma table built by python -m lerobert.build are lemmatized without calling TreeTagger
+    selection_tagger.table = lemma_tables.get()
+    return selection_tagger
 
-with open('./assets/word_map.json', 'r', encoding='utf-8') as f:
-    word_map = json.load(f)
 
 tagger = ttpw.TreeTagger(TAGLANG='fr')
 
 model_names = ["intfloat/multilingual-e5-large",
                "sentence-transformers/paraphrase-multilingual-mpnet-base-v2",
                "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"]
-tokenizers = []
-models = []
-for model_name in model_names:
-    tokenizers.append(AutoTokenizer.from_pretrained(model_name))
-    models.append(AutoModel.from_pretrained(model_name))
+# inference backend of each model: 'fp32' (eager PyTorch), 'int8' (torch dynamic quantization)
+# or 'onnx' (ONNX Runtime), python -m lerobert.build embeds the examples with the same backends
+model_backends = parse_model_backends(MODEL_BACKENDS, model_names)
+model_registry = ModelRegistry(model_names,
+                               load_function=lambda model_name: load_backend(model_name, model_backends[model_name]),
+                               memory_budget=int(float(MODEL_MEMORY_BUDGET_MB)*2**20) if MODEL_MEMORY_BUDGET_MB else None,
+                               scheduler_kwargs={'max_batch_size': MAX_BATCH_SIZE,
+                                                 'max_wait_ms': MAX_WAIT_MS,
+                                                 'max_queue_size': MAX_QUEUE_SIZE})
+for model_index in PRELOAD_MODELS.split(','):
+    if model_index.strip():
+        model_registry.get(int(model_index))
+
+
+def load_embedding_store(model_index):
+    with lrm.span('store_load'):
+        return lrp.load_embedding_store(f'./assets/embedding_stores/{model_names[model_index]}')
+
+
+def load_ann_index(model_index):
+    # indexes are built by python -m lerobert.build
+    index_path = f'./assets/ann_indexes/{model_names[model_index]}'
+    if not os.path.isfile(f'{index_path}/index.json'):
+        return None
+    with lrm.span('index_load'):
+        return lra.load_ann_index(index_path)
+
+
+# stores and indexes are updated in place by appending rows beyond the memory maps of the loaded ones,
+# and their index.json is replaced last
+embedding_stores = VersionedCache(
+    load_embedding_store,
+    lambda model_index: file_version(f'./assets/embedding_stores/{model_names[model_index]}/index.json'),
+    interval=RELOAD_INTERVAL, on_reload=clear_responses)
+ann_indexes = VersionedCache(
+    load_ann_index,
+    lambda model_index: file_version(f'./assets/ann_indexes/{model_names[model_index]}/index.json'),
+    interval=RELOAD_INTERVAL)
+
+
+def get_embedding_store(model_index):
+    return embedding_stores.get(model_index)
+
+
+def get_ann_index(model_index):
+    return ann_indexes.get(model_index)
+
+
+def preload_shared_state(model_indices):
+    # loaded once by python -m lerobert.serve before it forks its workers, which share the pages of the memory-mapped
+    # lexicon, stores and indexes and of the weights of models; ONNX Runtime sessions aren't fork-safe,
+    # so models with the 'onnx' backend are loaded by each worker; workers load their own copies of the files
+    # replaced by a later build
+    get_lexicon()
+    get_selection_tagger()
+    for model_index in model_indices:
+        if os.path.isfile(f'./assets/embedding_stores/{model_names[model_index]}/index.json'):
+            get_embedding_store(model_index)
+        get_ann_index(model_index)
+        if model_backends[model_names[model_index]] != 'onnx':
+            model_registry.get(model_index)
+
+
+def init_worker():
+    # state which can't be shared with the parent of a forked worker: the TreeTagger process and the threads
+    # running forward passes
+    global tagger
+    tagger = ttpw.TreeTagger(TAGLANG='fr')
+    model_registry.after_fork()
+
+
+@functools.lru_cache(maxsize=None)
+def get_color_strings(name='cool'):
+    # matplotlib is only imported when colors are needed for the first time
+    from matplotlib import colormaps
+    colors = colormaps[name](np.arange(colormaps[name].N))
+    return [f'rgba({color[0]*255:.3f}, {color[1]*255:.3f}, {color[2]*255:.3f}, {0.50})' for color in colors]
+
+
+def color_indices(values):
+    # indices of the same colors as colormap(value*0.9) for positive values and colormap(0.0) otherwise
+    num_colors = len(get_color_strings('cool'))
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(values > 0.0, values*0.9, 0.0)
+    return np.clip(values*num_colors, 0, num_colors-1).astype(int).tolist()
 
 
 def css_color_string(value):
-    colormap = 'cool'
-    color = plt.get_cmap(colormap)(value*0.9 if (value > 0.0) else 0.0)
-    color_str = f'rgba({color[0]*255:.3f}, {color[1]*255:.3f}, {color[2]*255:.3f}, {0.50})'
-    return color_str
+    return get_color_strings('cool')[color_indices([value])[0]]
+
+
+if not os.path.isfile('./assets/css/textbox.css'):
+    with open('./assets/css/textbox.css', 'w', encoding='utf-8') as f:
+        f.write(f'@charset "UTF-8";\n\n#textbox::selection {{color:#000000; background-color:{css_color_string(1.0)};}}\n')
+
+# compiled definitions keyed by (word_path, def_ind), the limit is in bytes
+template_cache = LRUCache(max_size=64*2**20, size_function=lrp.template_size)
+hidden_state_cache = HiddenStateCache(max_size=int(HIDDEN_STATE_CACHE_MB*2**20))
+# bodies of /definitions responses keyed by a hash of the request, see definitions_cache_key()
+definitions_cache = LRUCache(max_size=int(DEFINITIONS_CACHE_MB*2**20), ttl=DEFINITIONS_CACHE_TTL) \
+    if DEFINITIONS_CACHE_MB > 0 else None
+# (def_ind, text) of the examples of pages keyed by word_path, the limit is in examples
+example_cache = LRUCache(max_size=65536)
 
 
-with open('./assets/css/textbox.css', 'w', encoding='utf-8') as f:
-    f.write(f'@charset "UTF-8";\n\n#textbox::selection {{color:#000000; background-color:{css_color_string(1.0)};}}\n')
+def get_caches():
+    caches = {'templates': template_cache,
+              'hidden_states': hidden_state_cache,
+              'examples': example_cache,
+              'lemmas': get_selection_tagger().cache}
+    if definitions_cache is not None:
+        caches['definitions'] = definitions_cache
+    return caches
 
-cos = torch.nn.CosineSimilarity(dim=0, eps=1e-8)
+
+# gauges and counters read by GET /metrics
+for name, documentation, labelname, function, metric_type in [
+        ('lerobert_queue_size', 'Requests waiting in the inference queue of each loaded model.', 'model',
+         lambda: {(item['name'],): item['queue_size'] for item in model_registry.status()}, 'gauge'),
+        ('lerobert_model_loaded', 'Whether each model is loaded.', 'model',
+         lambda: {(item['name'],): int(item['loaded']) for item in model_registry.status()}, 'gauge'),
+        ('lerobert_cache_hits_total', 'Hits of each cache.', 'cache',
+         lambda: {(name,): cache.hits for name, cache in get_caches().items()}, 'counter'),
+        ('lerobert_cache_misses_total', 'Misses of each cache.', 'cache',
+         lambda: {(name,): cache.misses for name, cache in get_caches().items()}, 'counter'),
+        ('lerobert_cache_hit_ratio', 'Hits of each cache divided by its lookups.', 'cache',
+         lambda: {(name,): cache.hits/max(cache.hits + cache.misses, 1) for name, cache in get_caches().items()},
+         'gauge'),
+        ('lerobert_cache_items', 'Number of items in each cache.', 'cache',
+         lambda: {(name,): len(cache) for name, cache in get_caches().items()}, 'gauge'),
+        ('lerobert_cache_bytes', 'Size of the items in each cache.', 'cache',
+         lambda: {(name,): cache.size for name, cache in get_caches().items()}, 'gauge'),
+        ('lerobert_lemma_lookups_total', 'Forms of selections lemmatized with the lemma table, the cache or TreeTagger.',
+         'source', lambda: {(source,): count for source, count in get_selection_tagger().lookups.items()}, 'counter'),
+        ('lerobert_process_memory_bytes', 'Resident (rss), proportional (pss) and private (uss) memory of the process.',
+         'kind', lambda: {(kind,): value for kind, value in lrm.process_memory().items()}, 'gauge')]:
+    lrm.REGISTRY.register(lrm.CallbackMetric(name, documentation, (labelname,), function, metric_type))
+
+
+def get_definition_template(word_path, def_ind):
+    get_html_files()
+    template = template_cache.get((word_path, def_ind))
+    if template is not None:
+        return template
+    if os.path.isfile(f'./assets/templates/{word_path}.json'):
+        templates = lrp.load_definition_templates(word_path, template_path='./assets/templates/')
+    else:
+        # pages without compiled templates are parsed with BeautifulSoup
+        with lrm.span('parse'):
+            templates = lrp.compile_templates_html_file(word_path, html_path='./assets/html/processed/')
+    for ind, template in enumerate(templates):
+        template_cache.put((word_path, ind), template)
+    return templates[def_ind]
 
 
 class DefinitionsRequest(BaseModel):
@@ -52,41 +293,83 @@ class DefinitionsRequest(BaseModel):
     selection_start: int
     selection_end: int
     model_index: int
+    # 'unaccented' ignores diacritics (peche finds pêche and péché), 'prefix' finds words starting with the selection
+    match_mode: Literal['exact', 'unaccented', 'prefix'] = 'exact'
+    # senses sorted by the best or mean similarity of their examples, top_k alone ranks by the best one
+    rank: Optional[Literal['best', 'mean']] = None
+    top_k: Optional[int] = Field(default=None, ge=1)
+
+
+class AnnotateRequest(BaseModel):
+    text: str
+    model_index: int
+    match_mode: Literal['exact', 'unaccented', 'prefix'] = 'exact'
+    # number of senses returned for each word, the best one first
+    top_k: int = Field(default=3, ge=1)
+
+
+class NearestRequest(BaseModel):
+    text: str
+    selection_start: int
+    selection_end: int
+    model_index: int
+    top_k: int = Field(default=10, ge=1, le=100)
+    # lists of the index to search, LEROBERT_ANN_NPROBE by default
+    nprobe: Optional[int] = Field(default=None, ge=1)
 
 
-def generate_definitions_response(payload, tagger, tokenizer, model):
-    # without the text before and after the selected one, lemmas can be wrong
-    tags = lrp.tag_text(payload.text[payload.selection_start:payload.selection_end], tagger)
+class CompareRequest(BaseModel):
+    text: str
+    selection_start: int
+    selection_end: int
+    # models scored side by side, all the models with an embedding store by default
+    model_indices: Optional[List[int]] = None
+    match_mode: Literal['exact', 'unaccented', 'prefix'] = 'exact'
+
+
+def find_candidate_definitions(tags, match_mode='exact'):
+    # (word_path, def_ind, example_ind_start, num_examples) of the words and lemmas of tags, each one once
     words = set()
     for tag in tags:
         words.add(tag['word'].lower())
         words.update(set(tag['lemma'].lower().split('|')))
-    
-    selected_text_embeddings = lrp.compute_embeddings_selected_text(payload, tokenizer, model, max_length=510)
-
-    loaded_def_tags = []
+    definitions = []
     loaded_def_inds = set()
+    lexicon = get_lexicon()
     for word in words:
-        if word not in word_map:
-            continue
-        for word_path in word_map[word]:
-            def_tags = lrp.find_definitions(lrp.read_html_file(word_path, html_path='./assets/html/processed/'))
-            def_embedding_path = f'./assets/embeddings/{model_names[payload.model_index]}/{word_path}.pt'
-            def_embeddings = torch.load(def_embedding_path) if os.path.isfile(def_embedding_path) else None
-            for def_ind, example_ind_start, num_examples in word_map[word][word_path]:
-                if (word_path, def_ind, example_ind_start, num_examples) in loaded_def_inds:
-                    continue
-                def_tag = def_tags[def_ind]
-                example_tags = def_tag.find_all(True, class_='d_xpl')
-                for example_ind in range(num_examples):
-                    example_tag = example_tags[example_ind]
-                    cos_sim = cos(selected_text_embeddings, def_embeddings[example_ind_start+example_ind]).item()
-                    colors = css_color_string(cos_sim)
-                    for word_tag in example_tag.find_all(True, class_='word'):
-                        word_tag['title'] = f'{cos_sim:.3f}'
-                        word_tag['style'] = f'background-color: {colors};'
-                loaded_def_tags.append(str(def_tag))
-                loaded_def_inds.add((word_path, def_ind, example_ind_start, num_examples))
+        for definition in lexicon.lookup(word, mode=match_mode, max_keys=MAX_MATCHED_KEYS):
+            if definition not in loaded_def_inds:
+                definitions.append(definition)
+                loaded_def_inds.add(definition)
+    return definitions
+
+
+def lookup_selection_definitions(payload, tagger):
+    # forms missing from the lemma table are tagged with the text around the selection, without it lemmas can be wrong
+    with lrm.span('tag'):
+        tags = get_selection_tagger().tag_selection(payload.text, payload.selection_start, payload.selection_end,
+                                                    tagger)
+    with lrm.span('lookup'):
+        return find_candidate_definitions(tags, payload.match_mode)
+
+
+def generate_definitions_response(payload, tagger, selected_text_embeddings, embedding_store):
+    definitions = lookup_selection_definitions(payload, tagger)
+    # all examples are scored at once
+    with lrm.span('score'):
+        scores = lrp.score_definitions(selected_text_embeddings, embedding_store, definitions)
+        def_inds = range(len(definitions))
+        if payload.rank or payload.top_k:
+            def_inds = lrp.rank_definitions(scores, rank=payload.rank or 'best')[:payload.top_k]
+    color_strings = get_color_strings('cool')
+    loaded_def_tags = []
+    for ind in def_inds:
+        word_path, def_ind, _, _ = definitions[ind]
+        template = get_definition_template(word_path, def_ind)
+        with lrm.span('render'):
+            attributes = [{'title': f'{score:.3f}', 'style': f'background-color: {color_strings[color_ind]};'}
+                          for score, color_ind in zip(scores[ind].tolist(), color_indices(scores[ind]))]
+            loaded_def_tags.append(lrp.render_definition_template(template, attributes))
     if loaded_def_tags:
         html_response = HTMLResponse(content='\n'.join(loaded_def_tags), status_code=200)
     else:
@@ -96,46 +379,375 @@ def generate_definitions_response(payload, tagger, tokenizer, model):
     return html_response
 
 
+def compare_definition_scores(definitions, model_indices, selected_text_embeddings):
+    # the scores of each model side by side, with the rank each model gives to a definition (best example first)
+    definition_scores = [[] for _ in definitions]
+    with lrm.span('score'):
+        for model_index, embeddings in zip(model_indices, selected_text_embeddings):
+            scores = lrp.score_definitions(embeddings, get_embedding_store(model_index), definitions)
+            ranks = {ind: rank for rank, ind in enumerate(lrp.rank_definitions(scores, rank='best'), 1)}
+            for ind, def_example_scores in enumerate(scores):
+                scored = def_example_scores[~np.isnan(def_example_scores)]
+                definition_scores[ind].append({
+                    'model_index': model_index,
+                    'examples': [None if np.isnan(score) else round(score, 4) for score in def_example_scores.tolist()],
+                    'best': round(float(scored.max()), 4) if len(scored) else None,
+                    'mean': round(float(scored.mean()), 4) if len(scored) else None,
+                    'rank': ranks[ind] if len(scored) else None})
+    return {'models': [{'index': model_index, 'name': model_names[model_index]} for model_index in model_indices],
+            'definitions': [{'word_path': word_path, 'def_ind': def_ind, 'scores': scores}
+                            for (word_path, def_ind, _, _), scores in zip(definitions, definition_scores)]}
+
+
+def get_example_texts(word_path):
+    get_html_files()
+    examples = example_cache.get(word_path)
+    if examples is None:
+        with lrm.span('parse'):
+            examples = lrp.read_example_texts(word_path, html_path='./assets/html/processed/')
+        example_cache.put(word_path, examples)
+    return examples
+
+
+def search_nearest_examples(payload, selected_text_embeddings, ann_index):
+    # examples of the whole dictionary, whatever the lemmas of the selection
+    with lrm.span('search'):
+        # vectors of the index are the rows of the store, projected on its components if it has a projection
+        query = get_embedding_store(payload.model_index).project(selected_text_embeddings)
+        neighbours = ann_index.search(query, k=payload.top_k, nprobe=payload.nprobe or ANN_NPROBE)
+    results = []
+    for word_path, def_ind, example_ind, score in neighbours:
+        examples = get_example_texts(word_path)
+        results.append({'word_path': word_path,
+                        'def_ind': def_ind,
+                        'example_ind': example_ind,
+                        'score': round(score, 4),
+                        'example': examples[example_ind][1] if example_ind < len(examples) else None})
+    return results
+
+
+def prepare_annotation(payload, tagger, tokenizer):
+    # the whole text is tagged once, content words found in the lexicon are assigned to windows of tokens
+    with lrm.span('tag'):
+        tags = lrp.tag_text(payload.text, tagger)
+        spans = lrp.locate_tags(payload.text, tags)
+    words = []
+    word_definitions = {}
+    with lrm.span('lookup'):
+        for tag, span in zip(tags, spans):
+            if (span is None) or (tag['pos'].split(':')[0] not in lrp.CONTENT_POS):
+                continue
+            key = (tag['word'].lower(), tag['lemma'].lower())
+            if key not in word_definitions:
+                word_definitions[key] = find_candidate_definitions([tag], payload.match_mode)
+            if word_definitions[key]:
+                words.append((tag, span, word_definitions[key]))
+    with lrm.span('tokenize'):
+        window_input_ids, masks = lrp.prepare_annotation_inputs(payload.text, [span for _, span, _ in words],
+                                                                tokenizer)
+    window_words = [[] for _ in window_input_ids]
+    for (tag, span, definitions), window_mask in zip(words, masks):
+        if window_mask is not None:
+            window_ind, mask = window_mask
+            window_words[window_ind].append((tag, span, definitions, mask))
+    return window_input_ids, window_words
+
+
+def annotate_window(hidden_states, words, embedding_store, top_k):
+    # NDJSON lines of the words of one window
+    lines = []
+    for tag, (start, end), definitions, mask in words:
+        embeddings = lrp.pool_hidden_states(hidden_states, mask)
+        scores = lrp.score_definitions(embeddings, embedding_store, definitions)
+        senses = []
+        for ind in lrp.rank_definitions(scores)[:top_k]:
+            if np.isnan(scores[ind]).all():
+                break
+            word_path, def_ind, _, _ = definitions[ind]
+            senses.append({'word_path': word_path,
+                           'def_ind': def_ind,
+                           'score': round(float(np.nanmax(scores[ind])), 4),
+                           'example_scores': [None if np.isnan(score) else round(score, 4)
+                                              for score in scores[ind].tolist()]})
+        best = senses[0] if senses else {'word_path': None, 'def_ind': None, 'score': None}
+        line = {'start': start, 'end': end, 'word': tag['word'], 'lemma': tag['lemma'], 'pos': tag['pos'],
+                'word_path': best['word_path'], 'def_ind': best['def_ind'], 'score': best['score'],
+                'senses': senses}
+        lines.append(json.dumps(line, ensure_ascii=False) + '\n')
+    return ''.join(lines)
+
+
 app = FastAPI()
+app.add_middleware(lrm.TimingMiddleware,
+                   profiler=lrm.RequestProfiler(PROFILE_EVERY, PROFILE_MODE, PROFILE_PATH) if PROFILE_EVERY else None)
 
 
 @app.get('/')
-async def read_root():
-    return FileResponse('./assets/index.html')
+async def read_root(request: Request):
+    return await static_file_response(request, './assets/index.html')
 
 
 @app.get('/{dirname}/{filename}')
-async def read_file(dirname, filename):
-    if dirname == 'html':
-        if filename[:-5] not in html_files:
-            raise HTTPException(status_code=404, detail=f'{filename[:-5]}.html not found')
-        return FileResponse(f'./assets/html/processed/{filename}')       
-    if dirname == 'image-thumbnails':
-        return FileResponse(f'./assets/images/thumbnails/{filename}')
-    # css, js, audio files
-    return FileResponse(f'./assets/{dirname}/{filename}')
-      
+async def read_file(dirname, filename, request: Request):
+    # only files of known directories are served, never hidden files or files of other directories
+    if (dirname not in STATIC_PATHS) or filename.startswith('.') or ('/' in filename) or ('\\' in filename):
+        raise HTTPException(status_code=404, detail=f'{dirname}/{filename} not found')
+    if (dirname == 'html') and not (filename.endswith('.html') and (filename[:-5] in get_html_files())):
+        raise HTTPException(status_code=404, detail=f'{filename} not found')
+    path, cache_control = STATIC_PATHS[dirname]
+    response = await static_file_response(request, os.path.join(path, filename), cache_control=cache_control)
+    if response is None:
+        raise HTTPException(status_code=404, detail=f'{dirname}/{filename} not found')
+    return response
 
-@app.get('/models')
-async def read_models():
+
+@functools.lru_cache(maxsize=None)
+def get_models_response():
     tags = []
     for ind, model_name in enumerate(model_names):
         tags.append(f'<option value="{ind}">{model_name}</option>')
-    return HTMLResponse(content=''.join(tags), status_code=200)
+    return PrecomputedResponse(''.join(tags))
 
 
-@app.get('/colorbar')
-async def read_colorbar():
+@app.get('/models')
+async def read_models(request: Request):
+    # the page asks for <option> tags, clients asking for JSON get the load status of the models
+    if 'application/json' in request.headers.get('accept', ''):
+        return JSONResponse(content=model_registry.status())
+    return get_models_response().response(request)
+
+
+@app.post('/models/{model_index}/warmup')
+async def warm_up_model(model_index: int):
+    check_model_index(model_index)
+    payload = DefinitionsRequest(text='Bonjour', selection_start=0, selection_end=7, model_index=model_index)
+    await compute_selected_text_embeddings(payload, model_index)
+    return JSONResponse(content=model_registry.status()[model_index])
+
+
+@app.get('/caches')
+async def read_caches():
+    content = {name: {'items': len(cache),
+                      'size': cache.size,
+                      'max_size': cache.max_size,
+                      'hits': cache.hits,
+                      'misses': cache.misses}
+               for name, cache in get_caches().items()}
+    # forms found in the lemma table, in the cache and tagged by TreeTagger, and calls to TreeTagger
+    selection_tagger = get_selection_tagger()
+    content['lemmas'].update(lookups=dict(selection_tagger.lookups), tagger_calls=selection_tagger.tagger_calls)
+    return JSONResponse(content=content)
+
+
+@app.get('/metrics')
+async def read_metrics():
+    # Prometheus text format
+    return Response(content=lrm.REGISTRY.render(), media_type=lrm.REGISTRY.content_type)
+
+
+@functools.lru_cache(maxsize=None)
+def get_colorbar_response():
     tags = []
     for val in [-10, *range(0, 11)]:
         tag = f'<span class="colorbar-element"; style="background-color: {css_color_string(val/10)};">{val/10:.1f}</span>'
         tags.append(tag)    
-    return HTMLResponse(content=''.join(tags), status_code=200)
+    return PrecomputedResponse(''.join(tags))
+
+
+@app.get('/colorbar')
+async def read_colorbar(request: Request):
+    return get_colorbar_response().response(request)
+
+
+def get_model(model_index):
+    # models are loaded on first use
+    with lrm.span('load_model'):
+        return model_registry.get(model_index)
+
+
+def check_model_index(model_index):
+    if not 0 <= model_index < len(model_names):
+        raise HTTPException(status_code=404, detail=f'model {model_index} not found')
+
+
+async def submit_input_ids(model_index, input_ids, wait=False, num_threads=None):
+    # the model is loaded again if it has been unloaded in the meantime,
+    # when the queue is full, the request fails with 429 or waits if wait is set
+    num_attempts = 0
+    trace_file = lrm.trace_file()
+    while True:
+        loaded_model = await run_in_threadpool(model_registry.get, model_index)
+        try:
+            return loaded_model.scheduler.submit(input_ids, trace_file=trace_file, num_threads=num_threads)
+        except QueueFullError as e:
+            if not wait:
+                raise HTTPException(status_code=429, detail=str(e))
+            await asyncio.sleep(max(MAX_WAIT_MS, 1)/1000)
+        except SchedulerClosedError:
+            num_attempts += 1
+            if num_attempts == 2:
+                raise HTTPException(status_code=503, detail=f'model {model_index} is being unloaded')
+
+
+def definitions_cache_key(payload, input_ids, window, selection):
+    # the response only depends on the tokens of the context window, the position of the selection in it,
+    # the selected characters (which are tagged) and the options of the request
+    (window_start, window_end), (token_start, token_end) = window, selection
+    key = json.dumps([payload.model_index, payload.match_mode, payload.rank, payload.top_k,
+                      token_start - window_start, token_end - window_start,
+                      payload.text[payload.selection_start:payload.selection_end],
+                      input_ids[window_start:window_end]])
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def prepare_selection(payload, loaded_model, text_hash):
+    # the key of the response in definitions_cache, token ids and the mask of the selection in a window of the text,
+    # or the hidden states of a cached window holding the selection
+    with lrm.span('tokenize'):
+        return select_tokens(payload, loaded_model, text_hash)
+
+
+def select_tokens(payload, loaded_model, text_hash):
+    tokens = hidden_state_cache.get_tokens(loaded_model.name, text_hash)
+    if tokens is None:
+        tokens = lrp.tokenize_text(payload.text, loaded_model.tokenizer)
+        hidden_state_cache.put_tokens(loaded_model.name, text_hash, tokens)
+    input_ids, spans, word_starts = tokens
+    token_start, token_end = lrp.find_selection_tokens(spans, payload.selection_start, payload.selection_end)
+    window, selection = lrp.select_context_window(word_starts, token_start, token_end, max_length=510)
+    cached = hidden_state_cache.find(loaded_model.name, text_hash, token_start, token_end)
+    if cached is not None:
+        # the selection is pooled from the hidden states of a cached window, the response is keyed on that window
+        window, hidden_states = cached
+        selection = (token_start, token_end)
+    key = definitions_cache_key(payload, input_ids, window, selection) \
+        if (definitions_cache is not None) and isinstance(payload, DefinitionsRequest) else None
+    if cached is not None:
+        return key, window, None, lrp.selection_mask(window, selection), hidden_states
+    window_input_ids = lrp.window_input_ids(input_ids, window, loaded_model.tokenizer)
+    return key, window, window_input_ids, lrp.selection_mask(window, selection), None
+
+
+async def encode_selection(model_index, loaded_model, text_hash, window, input_ids, mask, hidden_states,
+                           num_threads=None):
+    # forward passes are batched by the scheduler of the model
+    if hidden_states is None:
+        time_start = time.perf_counter()
+        future = await submit_input_ids(model_index, input_ids, num_threads=num_threads)
+        hidden_states = await asyncio.wrap_future(future)
+        # the time spent waiting for a batch and the forward pass of the batch
+        seconds = time.perf_counter() - time_start
+        lrm.record('queue', max(seconds - future.forward_seconds, 0.0))
+        lrm.record('forward', future.forward_seconds)
+        # the hidden states are a view of the whole batch
+        hidden_state_cache.put(loaded_model.name, text_hash, window, hidden_states.clone())
+    with lrm.span('pool'):
+        return lrp.pool_hidden_states(hidden_states, mask)
+
+
+async def compute_selected_text_embeddings(payload, model_index, num_threads=None):
+    # the event loop only awaits: loading models and tokenization run in the thread pool;
+    # the models compared by /definitions/compare label the stages of their own tasks
+    lrm.set_model(model_names[model_index])
+    loaded_model = await run_in_threadpool(get_model, model_index)
+    text_hash = hashlib.blake2b(payload.text.encode('utf-8'), digest_size=16).hexdigest()
+    _, *selection = await run_in_threadpool(prepare_selection, payload, loaded_model, text_hash)
+    return await encode_selection(model_index, loaded_model, text_hash, *selection, num_threads=num_threads)
 
 
 @app.post('/definitions')
 async def find_definitions(payload: DefinitionsRequest):
-    return generate_definitions_response(payload,
-                                         tagger,
-                                         tokenizers[payload.model_index],
-                                         models[payload.model_index])
+    check_model_index(payload.model_index)
+    lrm.set_model(model_names[payload.model_index])
+    loaded_model = await run_in_threadpool(get_model, payload.model_index)
+    text_hash = hashlib.blake2b(payload.text.encode('utf-8'), digest_size=16).hexdigest()
+    key, *selection = await run_in_threadpool(prepare_selection, payload, loaded_model, text_hash)
+    if key is not None:
+        content = definitions_cache.get(key)
+        if content is not None:
+            return HTMLResponse(content=content, status_code=200)
+    selected_text_embeddings = await encode_selection(payload.model_index, loaded_model, text_hash, *selection)
+    response = await run_in_threadpool(generate_definitions_response,
+                                       payload,
+                                       tagger,
+                                       selected_text_embeddings,
+                                       get_embedding_store(payload.model_index))
+    if key is not None:
+        definitions_cache.put(key, response.body)
+    return response
+
+
+@app.post('/definitions/compare')
+async def compare_definitions(payload: CompareRequest):
+    model_indices = payload.model_indices
+    if model_indices is None:
+        model_indices = [ind for ind, model_name in enumerate(model_names)
+                         if os.path.isfile(f'./assets/embedding_stores/{model_name}/index.json')]
+    model_indices = list(dict.fromkeys(model_indices))
+    if not model_indices:
+        raise HTTPException(status_code=404, detail='no model to compare')
+    for model_index in model_indices:
+        check_model_index(model_index)
+    # the selection is tagged and looked up once while the models encode it concurrently in their schedulers,
+    # each one on its share of the intra-op threads, so a comparison takes about as long as the slowest model
+    num_threads = max(1, torch.get_num_threads() // len(model_indices))
+    definitions, *selected_text_embeddings = await asyncio.gather(
+        run_in_threadpool(lookup_selection_definitions, payload, tagger),
+        *(compute_selected_text_embeddings(payload, model_index, num_threads=num_threads)
+          for model_index in model_indices))
+    content = await run_in_threadpool(compare_definition_scores, definitions, model_indices, selected_text_embeddings)
+    return JSONResponse(content=content)
+
+
+@app.post('/nearest')
+async def find_nearest_examples(payload: NearestRequest):
+    check_model_index(payload.model_index)
+    lrm.set_model(model_names[payload.model_index])
+    ann_index = await run_in_threadpool(get_ann_index, payload.model_index)
+    if ann_index is None:
+        raise HTTPException(status_code=404, detail=f'no nearest-neighbour index for model {payload.model_index}')
+    selected_text_embeddings = await compute_selected_text_embeddings(payload, payload.model_index)
+    results = await run_in_threadpool(search_nearest_examples, payload, selected_text_embeddings, ann_index)
+    return JSONResponse(content={'results': results})
+
+
+@app.post('/annotate')
+async def annotate_text(payload: AnnotateRequest):
+    check_model_index(payload.model_index)
+    lrm.set_model(model_names[payload.model_index])
+    loaded_model = await run_in_threadpool(get_model, payload.model_index)
+    window_input_ids, window_words = await run_in_threadpool(prepare_annotation,
+                                                             payload,
+                                                             tagger,
+                                                             loaded_model.tokenizer)
+    # windows without words found in the lexicon aren't encoded
+    window_inds = deque(ind for ind, words in enumerate(window_words) if words)
+    embedding_store = get_embedding_store(payload.model_index)
+    pending = deque()
+    # the first window is submitted before the response starts, so that a full queue is answered with 429
+    if window_inds:
+        ind = window_inds.popleft()
+        pending.append((ind, await submit_input_ids(payload.model_index, window_input_ids[ind])))
+
+    async def generate_lines():
+        try:
+            while pending:
+                # a few windows are in flight, so that the scheduler can batch them
+                while window_inds and (len(pending) < MAX_BATCH_SIZE):
+                    ind = window_inds.popleft()
+                    pending.append((ind, await submit_input_ids(payload.model_index, window_input_ids[ind], wait=True)))
+                ind, future = pending.popleft()
+                hidden_states = await asyncio.wrap_future(future)
+                yield await run_in_threadpool(annotate_window,
+                                              hidden_states,
+                                              window_words[ind],
+                                              embedding_store,
+                                              payload.top_k)
+        except HTTPException as e:
+            # the status code has already been sent
+            yield json.dumps({'error': e.detail}) + '\n'
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    return StreamingResponse(generate_lines(), media_type='application/x-ndjson')
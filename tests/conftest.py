@@ -0,0 +1,94 @@
+import os
+import sys
+import random
+from pathlib import Path
+
+import pytest
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_PATH))
+
+from benchmarks.corpus import generate_corpus, install_stub_tagger, make_word, save_tiny_model
+
+
+# main.py and the build create their taggers when they are used
+install_stub_tagger()
+
+NUM_PAGES = 24
+# the tiny model is saved in a local directory named like this model
+MODEL_INDEX = 2
+
+
+def make_assets(num_pages=NUM_PAGES, seed=0):
+    """Write synthetic original pages, the page of the server and a tiny random model to the current directory
+    and return the word_paths of the pages.
+    """
+    import lerobert.processing as lrp
+    from lerobert.build import MODEL_NAMES, ORIGINAL_HTML_PATH, INDEX_FILE
+    word_paths = generate_corpus(ORIGINAL_HTML_PATH, num_pages=num_pages, seed=seed)
+    os.makedirs('./assets/css/', exist_ok=True)
+    with open(INDEX_FILE, 'w', encoding='utf-8') as f:
+        f.write('<!DOCTYPE html><html><body></body></html>')
+    save_tiny_model(MODEL_NAMES[MODEL_INDEX],
+                    [lrp.read_definitions_section(word_path).get_text() for word_path in word_paths])
+    return word_paths
+
+
+@pytest.fixture(scope='session')
+def workdir(tmp_path_factory):
+    """Assets of a synthetic dictionary built by lerobert.build with the stub tagger and a tiny random model.
+    Tests using it run from this directory, like the server.
+    """
+    from lerobert.build import Build, MODEL_NAMES
+    path = tmp_path_factory.mktemp('lerobert')
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        make_assets()
+        assert not Build(model_names=[MODEL_NAMES[MODEL_INDEX]], processes=False).run()
+        yield path
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    """An empty directory to build a few pages in, the current one during the test.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(scope='session')
+def client(workdir):
+    from fastapi.testclient import TestClient
+    # files replaced by a build are checked on every request
+    os.environ['LEROBERT_RELOAD_INTERVAL'] = '0'
+    # main.py reads the assets of the current directory when it is imported
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture(scope='session')
+def payloads(workdir):
+    """/definitions payloads selecting a header word in examples of the processed pages.
+    """
+    from benchmarks.run import read_examples, make_payloads
+    from lerobert.build import PROCESSED_HTML_PATH
+    import lerobert.processing as lrp
+    word_paths = sorted(lrp.list_html_files(PROCESSED_HTML_PATH))
+    return make_payloads(read_examples(word_paths, PROCESSED_HTML_PATH), 8, MODEL_INDEX, context=(1, 2))
+
+
+@pytest.fixture(scope='session')
+def tiny_model(tmp_path_factory):
+    """Tokenizer and model of a tiny random XLM-RoBERTa trained on random words.
+    """
+    from lerobert.backends import load_pretrained
+    rng = random.Random(0)
+    vocabulary = [make_word(rng) for _ in range(300)]
+    model_path = str(tmp_path_factory.mktemp('tiny_model'))
+    save_tiny_model(model_path, [' '.join(rng.choices(vocabulary, k=20)) for _ in range(200)] + ['Jardin, maison.'])
+    tokenizer, model = load_pretrained(model_path)
+    return tokenizer, model, vocabulary
@@ -0,0 +1,124 @@
+import json
+import threading
+
+import pytest
+import numpy as np
+
+import lerobert.backends as lrb
+from lerobert.build import Build, Stage, MODEL_NAMES, MANIFEST_FILE, STORE_PATH, ANN_PATH
+from lerobert.processing import load_embedding_store
+from lerobert.formats import get_store_format
+from lerobert.ann import load_ann_index
+
+from conftest import MODEL_INDEX, make_assets
+
+
+MODEL_NAME = MODEL_NAMES[MODEL_INDEX]
+
+
+def read_manifest():
+    with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_parse_model_backends():
+    assert lrb.parse_model_backends('', MODEL_NAMES) == {model_name: 'fp32' for model_name in MODEL_NAMES}
+    model_backends = lrb.parse_model_backends('0=int8, 2=onnx', MODEL_NAMES)
+    assert [model_backends[model_name] for model_name in MODEL_NAMES] == ['int8', 'fp32', 'onnx']
+    with pytest.raises(ValueError):
+        lrb.parse_model_backends('1=fp16', MODEL_NAMES)
+
+
+def test_parallel_stages_update_manifest(build_dir):
+    word_paths = [f'page{ind}' for ind in range(2000)]
+    barrier = threading.Barrier(2)
+
+    def build_function(changed, removed):
+        # both stages save the manifest while the other one updates its records
+        barrier.wait()
+        return {word_path: {'output': word_path} for word_path in changed}
+
+    for num_pages in (2000, 1500, 2000, 1000):
+        build = Build(model_names=[], force=('a', 'b'), processes=False)
+        build.stages = {}
+        for name in ('a', 'b'):
+            build.add_stage(Stage(name, [], lambda: {word_path: 'hash' for word_path in word_paths[:num_pages]},
+                                  build_function))
+        assert not build.run()
+        manifest = read_manifest()
+        assert {name: sorted(records) for name, records in manifest.items()} == \
+            {name: sorted(word_paths[:num_pages]) for name in ('a', 'b')}
+
+
+def test_incremental_build(build_dir):
+    word_paths = make_assets(num_pages=6)
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    manifest = read_manifest()
+    # a build without changes rebuilds nothing
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    assert read_manifest() == manifest
+    # a changed page is rebuilt alone
+    page_file = build_dir / 'assets/html/original' / f'{word_paths[0]}.html'
+    page_file.write_text(page_file.read_text(encoding='utf-8').replace('Sens de', 'Autre sens de'), encoding='utf-8')
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    new_manifest = read_manifest()
+    for stage in ('process', 'map', 'templates', f'embed:{MODEL_NAME}'):
+        assert [word_path for word_path in word_paths
+                if new_manifest[stage][word_path] != manifest[stage][word_path]] == word_paths[:1]
+
+
+def test_embed_with_model_backend(build_dir, monkeypatch):
+    word_paths = make_assets(num_pages=6)
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    store = load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')
+    fp32_rows = {word_path: np.array(store.get(word_path)) for word_path in store.offsets}
+    backends = []
+    load_backend = lrb.load_backend
+    monkeypatch.setattr(lrb, 'load_backend', lambda model_name, backend='fp32': (backends.append(backend),
+                                                                                  load_backend(model_name, backend))[1])
+    # the pages are embedded again with the backend of the server
+    assert not Build(model_names=[MODEL_NAME], processes=False, model_backends={MODEL_NAME: 'int8'}).run()
+    assert backends == ['int8']
+    records = read_manifest()[f'embed:{MODEL_NAME}']
+    assert all(records[word_path]['input'].endswith(':int8') for word_path in word_paths)
+    store = load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')
+    for word_path, rows in fp32_rows.items():
+        int8_rows = np.array(store.get(word_path))
+        assert int8_rows.shape == rows.shape
+        assert not np.array_equal(int8_rows, rows)
+        cosines = (int8_rows*rows).sum(1)/np.linalg.norm(int8_rows, axis=1)/np.linalg.norm(rows, axis=1)
+        assert cosines.min() > 0.9
+    assert not Build(model_names=[MODEL_NAME], processes=False, model_backends={MODEL_NAME: 'int8'}).run()
+    assert backends == ['int8']
+
+
+def test_embed_store_formats(build_dir):
+    word_paths = make_assets(num_pages=6)
+    assert not Build(model_names=[MODEL_NAME], processes=False, store_formats={MODEL_NAME: 'int8:16'}).run()
+    store = load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')
+    assert get_store_format(store) == 'int8:16'
+    assert load_ann_index(f'{ANN_PATH}{MODEL_NAME}').dim == 16
+    # rows of changed pages are appended in the format of the store, whatever the options
+    page_file = build_dir / 'assets/html/original' / f'{word_paths[0]}.html'
+    page_file.write_text(page_file.read_text(encoding='utf-8').replace('Sens de', 'Autre sens de'), encoding='utf-8')
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    assert get_store_format(load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')) == 'int8:16'
+    # projected stores can't be converted
+    assert Build(model_names=[MODEL_NAME], processes=False, store_formats={MODEL_NAME: 'float16'}).run() == \
+        {f'embed:{MODEL_NAME}', f'ann:{MODEL_NAME}'}
+
+
+def test_embed_converts_store(build_dir):
+    make_assets(num_pages=6)
+    assert not Build(model_names=[MODEL_NAME], processes=False).run()
+    store = load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')
+    assert get_store_format(store) == 'float32'
+    float32_rows = {word_path: np.array(store.get(word_path)) for word_path in store.offsets}
+    assert not Build(model_names=[MODEL_NAME], processes=False, store_formats={MODEL_NAME: 'int8'}).run()
+    store = load_embedding_store(f'{STORE_PATH}{MODEL_NAME}')
+    assert get_store_format(store) == 'int8'
+    for word_path, rows in float32_rows.items():
+        assert np.abs(store.get(word_path) - rows).max() < 0.01
+    # the index is built again from the converted rows
+    index = load_ann_index(f'{ANN_PATH}{MODEL_NAME}')
+    assert sorted(index.live) == sorted(float32_rows)
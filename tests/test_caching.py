@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import torch
+
+import lerobert.processing as lrp
+from lerobert.caching import HiddenStateCache
+
+
+def encode_window(text, selection_start, selection_end, tokenizer, model, cache, text_hash='text'):
+    # how main.py encodes a selection: tokens of the text are cached, then the hidden states of its window
+    tokens = cache.get_tokens('model', text_hash)
+    if tokens is None:
+        tokens = lrp.tokenize_text(text, tokenizer)
+        cache.put_tokens('model', text_hash, tokens)
+    input_ids, spans, word_starts = tokens
+    token_start, token_end = lrp.find_selection_tokens(spans, selection_start, selection_end)
+    cached = cache.find('model', text_hash, token_start, token_end)
+    if cached is not None:
+        window, hidden_states = cached
+        return lrp.pool_hidden_states(hidden_states, lrp.selection_mask(window, (token_start, token_end))), True
+    window, selection = lrp.select_context_window(word_starts, token_start, token_end, max_length=510)
+    with torch.no_grad():
+        hidden_states = model(input_ids=torch.tensor([lrp.window_input_ids(input_ids, window, tokenizer)]))[0][0]
+    cache.put('model', text_hash, window, hidden_states)
+    return lrp.pool_hidden_states(hidden_states, lrp.selection_mask(window, selection)), False
+
+
+def test_hidden_state_cache_hit_matches_forward_pass(tiny_model):
+    tokenizer, model, vocabulary = tiny_model
+    text = ' '.join(vocabulary[:40])
+    cache = HiddenStateCache(max_size=2**24)
+    selections = [(text.index(word), text.index(word) + len(word)) for word in vocabulary[5:8]]
+    _, hit = encode_window(text, *selections[0], tokenizer, model, cache)
+    assert not hit
+    for selection_start, selection_end in selections[1:]:
+        embedding, hit = encode_window(text, selection_start, selection_end, tokenizer, model, cache)
+        assert hit
+        payload = SimpleNamespace(text=text, selection_start=selection_start, selection_end=selection_end)
+        assert torch.allclose(embedding, lrp.compute_embeddings_selected_text(payload, tokenizer, model), atol=1e-5)
+    assert (cache.hits, cache.misses) == (2, 1)
+    # other texts aren't found
+    assert not encode_window(text, *selections[1], tokenizer, model, cache, text_hash='other')[1]
+
+
+def test_hidden_state_cache_min_context_and_size(tiny_model):
+    tokenizer, model, vocabulary = tiny_model
+    # a text longer than a window
+    text = ' '.join(vocabulary*3)
+    _, spans, _ = lrp.tokenize_text(text, tokenizer)
+    assert len(spans) > 1000
+    cache = HiddenStateCache(max_size=2**24, min_context=64)
+    middle = len(text)//2
+    selection_start = text.index(' ', middle) + 1
+    selection_end = text.index(' ', selection_start)
+    encode_window(text, selection_start, selection_end, tokenizer, model, cache)
+    (window_start, window_end), = cache._cache.get(('model', 'text'))['windows']
+    # a selection with less than min_context tokens to the end of the cached window isn't pooled from it
+    near_end = spans[window_end - 10][0]
+    near_end = text.index(' ', near_end) + 1
+    assert not encode_window(text, near_end, text.index(' ', near_end), tokenizer, model, cache)[1]
+    assert len(cache._cache.get(('model', 'text'))['windows']) == 2
+    # hidden states larger than the cache aren't kept
+    small_cache = HiddenStateCache(max_size=4096)
+    encode_window(text, selection_start, selection_end, tokenizer, model, small_cache)
+    assert not encode_window(text, selection_start, selection_end, tokenizer, model, small_cache)[1]
+    assert small_cache.size <= 4096
@@ -0,0 +1,135 @@
+import os
+import random
+import hashlib
+import threading
+import collections
+import http.server
+
+import pytest
+
+from lerobert.crawler import crawl_html, crawl_media
+from benchmarks.corpus import make_page
+
+
+MEDIA = ('<audio><source src="/medias/SOUNDS/originals/mp3/{word}.mp3"></audio>'
+         '<img src="/medias/IMAGES/originals/thumbnails/{word}.jpg"/>')
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for dictionnaire.lerobert.com serving the fixture pages of the server:
+    /definition/ancien redirects to /definition/nouveau, /definition/instable answers 503 to its first
+    two requests and /definition/indisponible always does, pages are revalidated with their ETags.
+    """
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.hits[self.path] += 1
+        if self.path == '/definition/ancien':
+            return self.send(301, headers=[('Location', '/definition/nouveau')])
+        if (self.path == '/definition/indisponible') or \
+                ((self.path == '/definition/instable') and (server.hits[self.path] < 3)):
+            return self.send(503, headers=[('Retry-After', '0')])
+        if self.path.startswith('/medias/'):
+            return self.send(200, self.path.encode('utf-8'))
+        word_path = self.path.split('/')[-1]
+        if (not self.path.startswith('/definition/')) or (word_path not in server.pages):
+            return self.send(404)
+        body = server.pages[word_path].encode('utf-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers=[('ETag', etag)])
+        self.send(200, body, headers=[('ETag', etag), ('Content-Type', 'text/html; charset=utf-8')])
+
+
+@pytest.fixture
+def stand_in():
+    rng = random.Random(0)
+    vocabulary = ['jardin', 'maison', 'rivière', 'pêche']
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.hits = collections.Counter()
+    server.pages = {word_path: make_page(rng, word_path, [word_path], vocabulary)
+                    for word_path in ('jardin', 'maison', 'nouveau', 'instable')}
+    server.pages['maison'] = server.pages['maison'].replace('</h3>', '</h3>' + MEDIA.format(word='maison'))
+    # a page of the site without definitions
+    server.pages['vide'] = '<!DOCTYPE html><html><body><div class="ws-c"><main></main></div></body></html>'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(stand_in, tmp_path, word_paths, **kwargs):
+    return crawl_html(word_paths,
+                      html_path=str(tmp_path / 'original'),
+                      base_url=f'http://127.0.0.1:{stand_in.server_address[1]}',
+                      manifest_path=tmp_path / 'crawl_manifest.jsonl',
+                      rate=0,
+                      backoff=0.01,
+                      **kwargs)
+
+
+def test_crawl_html(stand_in, tmp_path):
+    word_paths = ['jardin', 'ancien', 'inconnu', 'instable', 'vide', 'indisponible']
+    records = {record['key'].split('/')[-1]: record for record in crawl(stand_in, tmp_path, word_paths, max_retries=3)}
+    assert records['jardin']['status'] == 'ok'
+    # redirected pages are saved under their final word_path
+    assert (records['ancien']['status'], records['ancien']['word_path']) == ('ok', 'nouveau')
+    assert records['inconnu']['status'] == 'not_found'
+    assert records['instable']['status'] == 'ok'
+    assert stand_in.hits['/definition/instable'] == 3
+    assert records['vide']['status'] == 'no_definitions'
+    assert (records['indisponible']['status'], records['indisponible']['status_code']) == ('error', 503)
+    assert stand_in.hits['/definition/indisponible'] == 4
+    # pages are written to .part files renamed once complete
+    assert sorted(os.listdir(tmp_path / 'original')) == ['instable.html', 'jardin.html', 'nouveau.html']
+    assert (tmp_path / 'original' / 'jardin.html').read_text(encoding='utf-8') == stand_in.pages['jardin']
+
+
+def test_crawl_html_resumes_and_revalidates(stand_in, tmp_path):
+    word_paths = ['jardin', 'maison', 'inconnu', 'indisponible']
+    crawl(stand_in, tmp_path, word_paths, max_retries=0)
+    hits = dict(stand_in.hits)
+    # pages recorded in the manifest aren't requested again, failed ones are
+    crawl(stand_in, tmp_path, word_paths, max_retries=0)
+    assert {path: count - hits.get(path, 0) for path, count in stand_in.hits.items() if count != hits.get(path, 0)} \
+        == {'/definition/indisponible': 1}
+    # revalidated pages are only rewritten if they have changed
+    mtime_ns = os.stat(tmp_path / 'original' / 'jardin.html').st_mtime_ns
+    stand_in.pages['maison'] = stand_in.pages['maison'].replace('Sens de', 'Autre sens de')
+    records = {record['key'].split('/')[-1]: record
+               for record in crawl(stand_in, tmp_path, word_paths, revalidate=True, max_retries=0)}
+    assert records['jardin']['status'] == 'ok'
+    assert os.stat(tmp_path / 'original' / 'jardin.html').st_mtime_ns == mtime_ns
+    assert (tmp_path / 'original' / 'maison.html').read_text(encoding='utf-8') == stand_in.pages['maison']
+
+
+def test_crawl_media(stand_in, tmp_path):
+    crawl(stand_in, tmp_path, ['maison', 'jardin'])
+    kwargs = {'html_path': str(tmp_path / 'original'),
+              'audio_path': str(tmp_path / 'audio'),
+              'image_path': str(tmp_path / 'thumbnails'),
+              'base_url': f'http://127.0.0.1:{stand_in.server_address[1]}',
+              'manifest_path': tmp_path / 'media_manifest.jsonl',
+              'rate': 0}
+    # a file left by an interrupted download, without a record in the manifest
+    (tmp_path / 'thumbnails').mkdir()
+    (tmp_path / 'thumbnails' / 'maison.jpg').write_bytes(b'/medias/IMA')
+    crawl_media(['maison', 'jardin'], **kwargs)
+    assert (tmp_path / 'audio' / 'maison.mp3').read_bytes() == b'/medias/SOUNDS/originals/mp3/maison.mp3'
+    assert (tmp_path / 'thumbnails' / 'maison.jpg').read_bytes() == b'/medias/IMAGES/originals/thumbnails/maison.jpg'
+    assert os.listdir(tmp_path / 'thumbnails') == ['maison.jpg']
+    assert os.listdir(tmp_path / 'audio') == ['maison.mp3']
+    # saved files aren't downloaded again
+    crawl_media(['maison'], **kwargs)
+    assert stand_in.hits['/medias/SOUNDS/originals/mp3/maison.mp3'] == 1
@@ -0,0 +1,113 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from lerobert.inference import InferenceScheduler, ModelRegistry, QueueFullError, SchedulerClosedError
+
+from conftest import MODEL_INDEX
+
+
+class EchoModel(torch.nn.Module):
+    """Returns the token ids of each position as its hidden states and records the size of its batches.
+    Forward passes wait for release to be set.
+    """
+    def __init__(self, num_weights=0):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(num_weights))
+        self.batch_sizes = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def forward(self, input_ids, attention_mask):
+        self.batch_sizes.append(len(input_ids))
+        self.started.set()
+        self.release.wait(10)
+        return ((input_ids*attention_mask).unsqueeze(-1).float().expand(-1, -1, 2),)
+
+
+def blocked_scheduler(model, **kwargs):
+    # a scheduler whose worker is running a forward pass, the next requests wait in its queue
+    model.release.clear()
+    scheduler = InferenceScheduler(model, pad_token_id=1, **kwargs)
+    first = scheduler.submit([0, 5, 2])
+    assert model.started.wait(10)
+    return scheduler, first
+
+
+def test_scheduler_batches_waiting_requests():
+    model = EchoModel()
+    scheduler, first = blocked_scheduler(model, max_batch_size=4, max_wait_ms=50)
+    sequences = [[0, *range(3, 3 + length), 2] for length in range(6)]
+    futures = [scheduler.submit(input_ids) for input_ids in sequences]
+    model.release.set()
+    assert first.result(10).tolist() == [[0, 0], [5, 5], [2, 2]]
+    # the padded batches are cut to the length of each sequence
+    for input_ids, future in zip(sequences, futures):
+        assert future.result(10)[:, 0].tolist() == input_ids
+    assert model.batch_sizes == [1, 4, 2]
+    assert [future.batch_size for future in futures] == [4, 4, 4, 4, 2, 2]
+    scheduler.close()
+
+
+def test_scheduler_queue_full():
+    model = EchoModel()
+    scheduler, first = blocked_scheduler(model, max_batch_size=2, max_queue_size=2)
+    futures = [scheduler.submit([0, 3, 2]) for _ in range(2)]
+    with pytest.raises(QueueFullError):
+        scheduler.submit([0, 3, 2])
+    model.release.set()
+    for future in [first, *futures]:
+        future.result(10)
+    scheduler.close()
+
+
+def test_definitions_queue_full(client, payloads, monkeypatch):
+    import main
+    from lerobert.caching import HiddenStateCache
+
+    def submit(*args, **kwargs):
+        raise QueueFullError('8 requests are being processed and 64 more are waiting')
+
+    # the selection isn't pooled from the hidden states of an earlier request
+    monkeypatch.setattr(main, 'hidden_state_cache', HiddenStateCache(max_size=2**20))
+    monkeypatch.setattr(main.model_registry.get(MODEL_INDEX).scheduler, 'submit', submit)
+    response = client.post('/definitions', json=payloads[0])
+    assert response.status_code == 429
+    assert 'waiting' in response.json()['detail']
+
+
+def test_registry_evicts_least_recently_used_models():
+    models = {}
+
+    def load_function(model_name):
+        # 4000 bytes of float32 weights per model
+        models[model_name] = EchoModel(num_weights=1000)
+        return SimpleNamespace(pad_token_id=1), models[model_name]
+
+    # main.py gives LEROBERT_MODEL_MEMORY_BUDGET_MB in bytes
+    registry = ModelRegistry(['a', 'b', 'c'], memory_budget=10000, load_function=load_function)
+    registry.get(0)
+    loaded_model = registry.get(1)
+    assert loaded_model.size == 4000
+    registry.get(0)
+    # requests queued for the evicted model are run before its scheduler stops
+    models['b'].release.clear()
+    first = loaded_model.scheduler.submit([0, 3, 2])
+    assert models['b'].started.wait(10)
+    queued = [loaded_model.scheduler.submit([0, 4, 2]) for _ in range(3)]
+    registry.get(2)
+    assert [item['loaded'] for item in registry.status()] == [True, False, True]
+    models['b'].release.set()
+    for future in [first, *queued]:
+        assert future.result(10).shape == (3, 2)
+    loaded_model.scheduler._thread.join(10)
+    with pytest.raises(SchedulerClosedError):
+        loaded_model.scheduler.submit([0, 3, 2])
+    # an evicted model is loaded again on its next use
+    assert registry.get(1) is not loaded_model
+    assert [item['loaded'] for item in registry.status()] == [False, True, True]
+    for ind in range(3):
+        registry.unload(ind)
@@ -0,0 +1,94 @@
+import json
+
+import lerobert.lemmas as lrlm
+from lerobert.build import Build, MODEL_NAMES, WORD_MAP_FILE, LEMMA_TABLE_FILE, PAGE_LEMMA_PATH
+from benchmarks.corpus import StubTagger
+
+from conftest import MODEL_INDEX, make_assets
+
+
+class RecordingTagger(StubTagger):
+    def __init__(self, **tagger_kwargs):
+        super().__init__(**tagger_kwargs)
+        self.texts = []
+
+    def tag_text(self, text, **kwargs):
+        if isinstance(text, str):
+            self.texts.append(text)
+        return super().tag_text(text, **kwargs)
+
+
+def make_table(tmp_path, page_counts, header_words=()):
+    lrlm.build_lemma_table(page_counts, header_words, tmp_path / 'lemma_table.json')
+    return lrlm.load_lemma_table(tmp_path / 'lemma_table.json')
+
+
+def test_lemma_table(tmp_path):
+    page_counts = [{'mots': {'mot': 3}, 'été': {'être': 3, 'été': 2}},
+                   {'mots': {'mot': 1, 'mots': 9}, 'porte': {'porte': 1, 'porter': 40}}]
+    table = make_table(tmp_path, page_counts, header_words=['Mot', 'Été', 'Jardin'])
+    # lemmas given to at least a tenth of the occurrences of a form, the most frequent first
+    assert table.lookup('mots') == 'mots|mot'
+    assert table.lookup('porte') == 'porter'
+    # header words are their own lemma unless they are found in examples
+    assert table.lookup('été') == 'être|été'
+    assert table.lookup('jardin') == 'jardin'
+    assert table.lookup('Mot') == 'mot'
+    assert table.lookup('maison') is None
+    tagger = RecordingTagger()
+    selection_tagger = lrlm.SelectionTagger(table)
+    text = "Des Mots l'été"
+    # forms of the table come first, then the forms tagged by TreeTagger
+    assert selection_tagger.tag_selection(text, 0, len(text), tagger)[:2] == \
+        [{'word': 'Mots', 'pos': None, 'lemma': 'mots|mot'}, {'word': 'été', 'pos': None, 'lemma': 'être|été'}]
+    assert selection_tagger.lookups == {'table': 2, 'cache': 0, 'tagger': 2}
+    assert selection_tagger.tagger_calls == 1
+
+
+def test_selection_tagger_cache(tmp_path):
+    tagger = RecordingTagger()
+    selection_tagger = lrlm.SelectionTagger(make_table(tmp_path, [{'jardin': {'jardin': 1}}]), cache_size=1)
+    text = 'Les maisons et le jardin'
+    start = text.index('maisons')
+    assert selection_tagger.tag_selection(text, start, start + 7, tagger) == \
+        [{'word': 'maisons', 'pos': 'NOM', 'lemma': 'maison'}]
+    # tagged forms are cached
+    assert selection_tagger.tag_selection('Maisons', 0, 7, tagger) == \
+        [{'word': 'Maisons', 'pos': None, 'lemma': 'maison'}]
+    assert selection_tagger.tagger_calls == 1
+    assert selection_tagger.lookups == {'table': 0, 'cache': 1, 'tagger': 1}
+    # the least recently used form is evicted
+    selection_tagger.tag_selection(text, text.index('et'), text.index('et') + 2, tagger)
+    selection_tagger.tag_selection(text, start, start + 7, tagger)
+    assert selection_tagger.tagger_calls == 3
+
+
+def test_context_is_cut_at_whitespace():
+    tagger = RecordingTagger()
+    selection_tagger = lrlm.SelectionTagger(context=12)
+    text = 'avant\tpremier\nmaisons\ndernier\tensuite'
+    start = text.index('maisons')
+    for separators in ((' ', ' '), ('\t', '\n'), ('\n', '\t'), (' ', '\r\n')):
+        separated_text = text.replace('\t', separators[0]).replace('\n', separators[1])
+        selection_tagger.cache.clear()
+        selection_tagger.tag_selection(separated_text, start, start + 7, tagger)
+        # words cut at the boundaries of the context are left out
+        assert tagger.texts[-1].split() == ['premier', 'maisons', 'dernier']
+
+
+def test_lemmas_stage(build_dir):
+    make_assets(num_pages=6)
+    assert not Build(model_names=[MODEL_NAMES[MODEL_INDEX]], processes=False).run()
+    with open(LEMMA_TABLE_FILE, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    with open(WORD_MAP_FILE, 'r', encoding='utf-8') as f:
+        header_words = list(json.load(f))
+    page_counts = [lrlm.load_page_lemmas(item.name[:-5], lemma_path=PAGE_LEMMA_PATH)
+                   for item in (build_dir / PAGE_LEMMA_PATH).iterdir()]
+    assert len(page_counts) == 6
+    # the counts of the forms of all pages are merged with the header words of the word map
+    expected = make_table(build_dir, page_counts, header_words=header_words)
+    assert table == expected.lemmas
+    assert all(word.lower() in table for word in header_words)
+    assert any((len(counts) > 1) for page in page_counts for counts in page.values()) or \
+        set(table) > {word.lower() for word in header_words}
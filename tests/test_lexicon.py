@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import lerobert.lexicon as lrl
+
+
+# {word: {word_path: [[def_ind, example_ind_start, num_examples], ...]}} like word_map.json
+WORD_MAP = {'abaisse': {'abaisse': [[0, 0, 2]]},
+            'cœur': {'coeur': [[0, 0, 3], [1, 3, 1]]},
+            'coeur': {'coeur': [[2, 4, 0]]},
+            'coup': {'coup': [[0, 0, 1]]},
+            'pèche': {'peche': [[1, 2, 2]]},
+            'pêche': {'peche': [[0, 0, 2]]},
+            'péché': {'peche': [[2, 4, 1]]},
+            'pécher': {'pecher': [[0, 0, 1]]},
+            'ægosome': {'aegosome': [[0, 0, 0]]},
+            'zythum': {'zythum': [[0, 0, 1]], 'zython': [[0, 0, 1]]}}
+
+
+def expected_lookup(words):
+    return sorted((word_path, *def_example_inds)
+                  for word in words
+                  for word_path, items in WORD_MAP[word].items()
+                  for def_example_inds in items)
+
+
+@pytest.fixture
+def lexicon(tmp_path):
+    with open(tmp_path / 'word_map.json', 'w', encoding='utf-8') as f:
+        json.dump(WORD_MAP, f)
+    # as the server does on its first start without a lexicon
+    lrl.convert_word_map_to_lexicon(tmp_path / 'word_map.json', tmp_path / 'lexicon')
+    return lrl.load_lexicon(tmp_path / 'lexicon')
+
+
+def test_exact(lexicon):
+    assert len(lexicon) == len(WORD_MAP)
+    for word in WORD_MAP:
+        assert word in lexicon
+        assert sorted(lexicon.lookup(word)) == expected_lookup([word])
+    assert 'peche' not in lexicon
+    assert lexicon.lookup('peche') == []
+    assert lexicon.lookup('') == []
+
+
+def test_unaccented(lexicon):
+    assert sorted(lexicon.lookup('peche', mode='unaccented')) == expected_lookup(['pèche', 'pêche', 'péché'])
+    assert sorted(lexicon.lookup('pêché', mode='unaccented')) == expected_lookup(['pèche', 'pêche', 'péché'])
+    # ligatures are expanded in keys and in the searched word
+    assert sorted(lexicon.lookup('coeur', mode='unaccented')) == expected_lookup(['cœur', 'coeur'])
+    assert sorted(lexicon.lookup('cœur', mode='unaccented')) == expected_lookup(['cœur', 'coeur'])
+    assert sorted(lexicon.lookup('aegosome', mode='unaccented')) == expected_lookup(['ægosome'])
+    assert lexicon.lookup('pech', mode='unaccented') == []
+
+
+def test_prefix(lexicon):
+    keys = [lexicon.keys[key_id].decode('utf-8') for key_id in lexicon.find_keys('pe', mode='prefix')]
+    assert keys == sorted(['pèche', 'pêche', 'péché', 'pécher'], key=lambda key: key.encode('utf-8'))
+    assert sorted(lexicon.lookup('co', mode='prefix')) == expected_lookup(['cœur', 'coeur', 'coup'])
+    assert sorted(lexicon.lookup('a', mode='prefix')) == expected_lookup(['abaisse', 'ægosome'])
+    # the last key, whole or by a prefix
+    assert sorted(lexicon.lookup('zyt', mode='prefix')) == expected_lookup(['zythum'])
+    assert sorted(lexicon.lookup('zythum', mode='prefix')) == expected_lookup(['zythum'])
+    assert lexicon.lookup('zythums', mode='prefix') == []
+    assert lexicon.lookup('zz', mode='prefix') == []
+    assert len(lexicon.find_keys('', mode='prefix')) == len(WORD_MAP)
+    assert len(lexicon.find_keys('pe', mode='prefix', max_keys=2)) == 2
+
+
+def test_unknown_mode(lexicon):
+    with pytest.raises(ValueError):
+        lexicon.find_keys('coeur', mode='fuzzy')
+
+
+def test_empty_lexicon(tmp_path):
+    lrl.build_lexicon([], tmp_path)
+    lexicon = lrl.load_lexicon(tmp_path)
+    assert len(lexicon) == 0
+    for mode in lrl.MATCH_MODES:
+        assert lexicon.lookup('coeur', mode=mode) == []
@@ -0,0 +1,396 @@
+import random
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+import torch
+
+import lerobert.processing as lrp
+from benchmarks.corpus import generate_corpus, StubTagger
+
+
+# unclosed tags, which lxml closes where html.parser nests them
+MALFORMED_DEFINITION = '<div class="d_ptma"><p>Remarque<p>voir aussi<br>'
+
+
+def make_pages(html_path, num_pages=12):
+    word_paths = generate_corpus(html_path, num_pages=num_pages, seed=1)
+    for word_path in word_paths[:3]:
+        filename_path = Path(html_path) / Path(f'{word_path}.html')
+        filename_path.write_text(filename_path.read_text(encoding='utf-8').replace('<div class="d_ptma">',
+                                                                                   MALFORMED_DEFINITION),
+                                 encoding='utf-8')
+    return word_paths
+
+
+def read_whole_page(filename, html_path='./assets/html/original/', section_path=None):
+    # how pages were read before only their sections were parsed
+    return lrp.read_html_file(filename, html_path=html_path)
+
+
+def test_process_html_matches_whole_page_parse(tmp_path, monkeypatch):
+    original_path = str(tmp_path / 'original')
+    word_paths = make_pages(original_path)
+    tagger = StubTagger()
+    with monkeypatch.context() as m:
+        m.setattr(lrp, 'read_definitions_section', read_whole_page)
+        for word_path in word_paths:
+            lrp.process_html(word_path, tagger, orig_html_path=original_path,
+                             proc_html_path=str(tmp_path / 'expected') + '/')
+    # pages are parsed the first time, their saved sections the second time
+    for processed_path in ('processed', 'processed_again'):
+        for word_path in word_paths:
+            lrp.process_html(word_path, tagger, orig_html_path=original_path,
+                             proc_html_path=str(tmp_path / processed_path) + '/',
+                             section_path=str(tmp_path / 'sections'))
+        for word_path in word_paths:
+            assert (tmp_path / processed_path / f'{word_path}.html').read_bytes() == \
+                (tmp_path / 'expected' / f'{word_path}.html').read_bytes()
+
+
+def test_read_definitions_section_ignores_unmarked_sections(tmp_path):
+    original_path = str(tmp_path / 'original')
+    section_path = tmp_path / 'sections'
+    word_path = make_pages(original_path, num_pages=1)[0]
+    section_path.mkdir()
+    # a section saved by an earlier build, newer than its page
+    (section_path / f'{word_path}.html').write_text('<section class="def"></section>', encoding='utf-8')
+    soup = lrp.read_definitions_section(word_path, html_path=original_path, section_path=str(section_path))
+    assert lrp.find_definitions(soup)
+    assert (section_path / f'{word_path}.html').read_text(encoding='utf-8').startswith(lrp.SECTION_MARK)
+
+
+def test_walk_strings_matches_locate_strings():
+    soup = lrp.BeautifulSoup('<div class="b"><h3>mot<span class="d_cat">, nom</span></h3>\n'
+                             '<span class="d_xpl">un <i>mot</i> <b>rare</b></span></div>', 'html.parser')
+    strings = list(lrp.walk_strings(soup.div))
+    assert [string for string, _, _ in strings] == ['mot', ', nom', 'un ', 'mot', ' ', 'rare']
+    for string, _, indices in strings:
+        assert lrp.get_content(soup.div, indices) == string
+
+
+def read_examples(html_path, word_paths):
+    # (example HTML, header words) of the definitions of pages
+    examples = []
+    for word_path in word_paths:
+        for def_tag in lrp.find_definitions(lrp.read_definitions_section(word_path, html_path=html_path)):
+            words = lrp.get_definition_header_data(def_tag)['words']
+            examples.extend((str(example_tag), words) for example_tag in def_tag.find_all(True, class_='d_xpl'))
+    return examples
+
+
+EDGE_EXAMPLES = [('<span class="d_xpl"></span>', ['mot']),
+                 ('<span class="d_xpl"> </span>', ['mot']),
+                 ('<span class="d_xpl">Un mot.</span>', ['mot']),
+                 ('<span class="d_xpl">Des <i>mots</i> !</span>', ['mot']),
+                 ('<span class="d_xpl">Un mot sans sa forme ?</span>', []),
+                 ('<span class="d_xpl">…</span>', ['mot'])]
+
+
+def test_wrap_words_batch_matches_wrap_words(tmp_path):
+    html_path = str(tmp_path / 'original')
+    examples = [*EDGE_EXAMPLES[:2], *read_examples(html_path, make_pages(html_path)), *EDGE_EXAMPLES[2:]]
+    tagger = StubTagger()
+    html_strings = [html_string for html_string, _ in examples]
+    words_list = [words for _, words in examples]
+    expected = [lrp.wrap_words(html_string, tagger, words, words) for html_string, words in examples]
+    assert sum('class="word"' in html_string for html_string in expected) > len(examples)//2
+    lemma_counts = {}
+    assert lrp.wrap_words_batch(html_strings, tagger, words_list, words_list, lemma_counts=lemma_counts) == expected
+    assert lemma_counts
+    # texts ending in punctuation are followed by the next ones
+    assert lrp.tag_texts(['Un mot.', '', 'Des mots !'], tagger) == \
+        [lrp.tag_text(text, tagger) for text in ['Un mot.', '', 'Des mots !']]
+
+
+def test_tag_texts_falls_back_to_one_call_per_text():
+    class OtherFramingTagger(StubTagger):
+        # a tagger copying the separators of the texts into its output
+        removesgml = False
+
+        def tag_text(self, text, prepronly=False, tagonly=False, **kwargs):
+            tags = super().tag_text(text, prepronly=prepronly, tagonly=tagonly, **kwargs)
+            return [tag for tag in tags if tag != lrp.TEXT_SEPARATOR]
+
+    tagger = OtherFramingTagger()
+    texts = ['Un mot.', 'Des mots !']
+    assert lrp.tag_texts(texts, tagger) == [lrp.tag_text(text, tagger) for text in texts]
+
+
+def test_tagger_pool(tmp_path, monkeypatch):
+    import threading
+    import concurrent.futures
+    import treetaggerwrapper as ttpw
+    active = []
+    lock = threading.Lock()
+
+    class CountingTagger(StubTagger):
+        def tag_text(self, text, **kwargs):
+            with lock:
+                assert self not in active, 'a tagger of the pool is used by two threads'
+                active.append(self)
+            try:
+                return super().tag_text(text, **kwargs)
+            finally:
+                with lock:
+                    active.remove(self)
+
+    monkeypatch.setattr(ttpw, 'TreeTagger', CountingTagger)
+    html_path = str(tmp_path / 'original')
+    examples = read_examples(html_path, make_pages(html_path))
+    pool = lrp.TaggerPool(num_taggers=2)
+    expected = [lrp.wrap_words(html_string, StubTagger(), words, words) for html_string, words in examples]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda example: lrp.wrap_words_batch([example[0]], pool, [example[1]],
+                                                                          [example[1]])[0],
+                                    examples*4))
+    assert results == expected*4
+
+
+def select_tokens_by_words(text, selection_start, selection_end, tokenizer, max_length=510):
+    # how the context window was chosen before the text was tokenized once: the selection and the words
+    # split on spaces around it were tokenized one by one
+    def word_tokens(word):
+        return tokenizer(word.lower())['input_ids'][1:-1]
+
+    tokens_selected = word_tokens(text[selection_start:selection_end])
+    lim_side = int((max_length - len(tokens_selected)) / 2)
+    before = []
+    for word in text[:selection_start].split(' ')[::-1]:
+        if len(before) + len(word_tokens(word)) > lim_side:
+            break
+        before[:0] = word_tokens(word)
+    after = []
+    for word in text[selection_end:].split(' '):
+        if len(after) + len(word_tokens(word)) > lim_side:
+            break
+        after.extend(word_tokens(word))
+    special_tokens = tokenizer('')['input_ids']
+    return ([*special_tokens[:1], *before, *tokens_selected, *after, *special_tokens[1:]],
+            [*[False]*(len(before)+1), *[True]*len(tokens_selected), *[False]*(len(after)+1)])
+
+
+def prepare_inputs(text, selection_start, selection_end, tokenizer, max_length=510):
+    payload = SimpleNamespace(text=text, selection_start=selection_start, selection_end=selection_end)
+    return lrp.prepare_selected_text_inputs(payload, tokenizer, max_length=max_length)
+
+
+def test_selected_tokens_match_word_by_word_tokenization(tiny_model):
+    tokenizer, _, vocabulary = tiny_model
+    rng = random.Random(1)
+    for _ in range(200):
+        words = [rng.choice(vocabulary).capitalize() if rng.random() < 0.1 else rng.choice(vocabulary)
+                 for _ in range(rng.randint(1, 80))]
+        ind_start = rng.randrange(len(words))
+        ind_end = min(len(words), ind_start + rng.randint(1, 3))
+        selection_start = len(' '.join(words[:ind_start])) + (ind_start > 0)
+        selection_end = len(' '.join(words[:ind_end]))
+        text = ' '.join(words)
+        max_length = rng.choice([8, 16, 32, 64, 510])
+        if len(tokenizer(text[selection_start:selection_end].lower())['input_ids']) - 2 > max_length:
+            # selections longer than the window are cut now
+            continue
+        assert prepare_inputs(text, selection_start, selection_end, tokenizer, max_length) == \
+            select_tokens_by_words(text, selection_start, selection_end, tokenizer, max_length)
+
+
+def selected_text(text, selection_start, selection_end, tokenizer, max_length=510):
+    input_ids, mask = prepare_inputs(text, selection_start, selection_end, tokenizer, max_length)
+    return tokenizer.decode([token_id for token_id, selected in zip(input_ids, mask) if selected]).strip()
+
+
+def test_whitespace_separators(tiny_model):
+    tokenizer, _, vocabulary = tiny_model
+    words = vocabulary[:6]
+    text = f'{words[0]}\t{words[1]}\n{words[2]} \n {words[3]}\t\t{words[4]} {words[5]}'
+    _, spans, word_starts = lrp.tokenize_text(text, tokenizer)
+    for word in words:
+        start = text.index(word)
+        token_start, token_end = lrp.find_selection_tokens(spans, start, start + len(word))
+        assert text[spans[token_start][0]:spans[token_end-1][1]] == word
+        # newlines and tabs separate words like spaces
+        assert word_starts[token_start]
+        assert all(not word_starts[ind] for ind in range(token_start + 1, token_end))
+
+
+def test_selection_inside_word_and_at_boundaries(tiny_model):
+    tokenizer, _, vocabulary = tiny_model
+    words = vocabulary[10:40]
+    text = ' '.join(words)
+    _, spans, word_starts = lrp.tokenize_text(text, tokenizer)
+    # the tokens covering the selected characters of a word
+    start = text.index(words[5]) + 1
+    token_start, token_end = lrp.find_selection_tokens(spans, start, start + 2)
+    assert spans[token_start][0] <= start + 1 and spans[token_end-1][1] >= start + 2
+    assert words[5][1:3] in selected_text(text, start, start + 2, tokenizer)
+    # selections at the start and the end of the text
+    assert lrp.find_selection_tokens(spans, 0, len(words[0]))[0] == 0
+    assert lrp.find_selection_tokens(spans, len(text) - len(words[-1]), len(text))[1] == len(spans)
+    assert selected_text(text, 0, len(words[0]), tokenizer, max_length=8) == words[0]
+    assert selected_text(text, len(text) - len(words[-1]), len(text), tokenizer, max_length=8) == words[-1]
+    # nothing but whitespace
+    assert lrp.find_selection_tokens(spans, len(words[0]), len(words[0]) + 1) == (0, 0)
+    # windows don't cut words in half
+    for max_length in (8, 9, 16, 33):
+        for token_start in range(len(spans)):
+            (window_start, window_end), _ = lrp.select_context_window(word_starts, token_start, token_start + 1,
+                                                                      max_length=max_length)
+            assert window_end - window_start <= max_length
+            assert word_starts[window_start] or window_start == token_start
+            assert (window_end == len(spans)) or word_starts[window_end] or window_end == token_start + 1
+
+
+def test_batched_embeddings_match_per_example(tiny_model, tmp_path):
+    tokenizer, model, _ = tiny_model
+    original_path = str(tmp_path / 'original')
+    processed_path = str(tmp_path / 'processed')
+    word_paths = make_pages(original_path)
+    tagger = StubTagger()
+    for word_path in word_paths:
+        lrp.process_html(word_path, tagger, orig_html_path=original_path, proc_html_path=processed_path + '/')
+    expected = {}
+    for word_path in word_paths:
+        soup = lrp.read_html_file(word_path, html_path=processed_path)
+        example_tags = [example_tag for def_tag in lrp.find_definitions(soup)
+                        for example_tag in def_tag.find_all(True, class_='d_xpl')]
+        if example_tags:
+            expected[word_path] = torch.stack([lrp.compute_embeddings_html_tag(example_tag, tokenizer, model)
+                                               for example_tag in example_tags])
+    # small batches and buffers mix examples of different lengths and files
+    results = dict(lrp.compute_embeddings_batched(word_paths, tokenizer, model, html_path=processed_path,
+                                                  batch_size=4, buffer_size=8))
+    assert results.keys() == expected.keys()
+    for word_path, embeddings in results.items():
+        assert torch.allclose(embeddings, expected[word_path], atol=1e-5, equal_nan=True)
+    store_path = str(tmp_path / 'store')
+    lrp.compute_embeddings_corpus(word_paths, tokenizer, model, store_path, html_path=processed_path, batch_size=4)
+    store = lrp.load_embedding_store(store_path)
+    for word_path, embeddings in expected.items():
+        # rows of stores are normalized
+        embeddings = torch.nn.functional.normalize(embeddings, dim=1)
+        assert np.allclose(store.get(word_path), embeddings.numpy(), atol=1e-5, equal_nan=True)
+
+
+def test_batched_embeddings_word_masks(tiny_model):
+    tokenizer, model, vocabulary = tiny_model
+    # a word made of several tokens
+    long_word = ''.join(vocabulary[:4])
+    html_string = (f'<span class="d_xpl">{vocabulary[5]} <span class="word">{long_word}</span>, '
+                   f'<i>{vocabulary[6]}</i>.</span>')
+    example_tag = lrp.BeautifulSoup(html_string, 'html.parser').span
+    example = ([string.lower() for string in example_tag.find_all(string=True)],
+               ['word' in string.parent.get('class', []) for string in example_tag.find_all(string=True)])
+    input_ids, word_masks = lrp.tokenize_examples([example], tokenizer)
+    assert sum(word_masks[0]) > 2
+    embeddings = lrp.compute_embeddings_batch(input_ids, word_masks, model, tokenizer.pad_token_id)
+    assert torch.allclose(embeddings[0], lrp.compute_embeddings_html_tag(example_tag, tokenizer, model), atol=1e-5)
+    # examples longer than the model are cut, the tokens of the word stay aligned with their mask
+    long_example = ([vocabulary[5], long_word, *[' ' + word for word in vocabulary[6:]*4]],
+                    [False, True, *[False]*len(vocabulary[6:]*4)])
+    input_ids, word_masks = lrp.tokenize_examples([example, long_example], tokenizer)
+    assert len(input_ids[1]) == 512 and input_ids[1][-1] == tokenizer.eos_token_id
+    embeddings = lrp.compute_embeddings_batch(input_ids, word_masks, model, tokenizer.pad_token_id)
+    with torch.no_grad():
+        hidden_states = model(input_ids=torch.tensor(input_ids[1:]))[0][0]
+    assert torch.allclose(embeddings[1], hidden_states[torch.tensor(word_masks[1])].mean(0), atol=1e-5)
+    assert torch.allclose(embeddings[0], lrp.compute_embeddings_html_tag(example_tag, tokenizer, model), atol=1e-5)
+
+
+def slow_square(item, delay=0.0, offset=0):
+    import time
+    if item == 3:
+        raise ValueError('no square for 3')
+    time.sleep(delay*(5 - item))
+    return item*item + offset
+
+
+def test_imap_async_ordered_and_unordered():
+    results = list(lrp.imap_async(slow_square, range(5), delay=0.02, max_workers=5))
+    assert [result for result in results if not isinstance(result, lrp.TaskError)] == [0, 1, 4, 16]
+    # the failed item is yielded in its place
+    assert (results[3].item, type(results[3].exception)) == (3, ValueError)
+    assert 'no square for 3' in results[3].traceback
+    results = list(lrp.imap_async(slow_square, range(5), delay=0.05, max_workers=5, ordered=False))
+    # the failed item first, then the fastest ones
+    assert isinstance(results[0], lrp.TaskError)
+    assert results[1:] == [16, 4, 1, 0]
+
+
+def test_imap_async_bounds_items_in_flight():
+    consumed = []
+
+    def sequence():
+        for item in range(20):
+            consumed.append(item)
+            yield item
+
+    results = lrp.imap_async(slow_square, sequence(), max_workers=2, max_in_flight=3, offset=1)
+    assert next(results) == 1
+    assert len(consumed) <= 4
+    assert [result for result in results if not isinstance(result, lrp.TaskError)] == \
+        [item*item + 1 for item in range(1, 20) if item != 3]
+
+
+def test_imap_async_processes_with_initializer():
+    results = list(lrp.imap_async(slow_square, [4, 2, 3], processes=True, max_workers=2,
+                                  initializer=dict, initargs=({'offset': 10},)))
+    # the kwargs returned by the initializer of each worker are given to the function
+    assert results[:2] == [26, 14]
+    assert isinstance(results[2], lrp.TaskError)
+
+
+def locate_strings_by_siblings(tag):
+    # how strings were located before walk_strings(): by counting the previous siblings of each parent
+    strings = []
+    for string in tag.find_all(string=True):
+        if string == '\n':
+            continue
+        tag_iter = string
+        parents = []
+        indices = [len(list(tag_iter.previous_siblings))]
+        while True:
+            tag_iter = tag_iter.parent
+            classes = ' '.join(tag_iter['class']) if tag_iter.get('class') is not None else None
+            if tag_iter is tag:
+                break
+            parents.append((tag_iter.name, classes))
+            indices.append(len(list(tag_iter.previous_siblings)))
+        strings.append({'string': string, 'parents': tuple(parents[::-1]), 'indices': tuple(indices[::-1])})
+    return strings
+
+
+def test_locate_strings_matches_previous_siblings(tmp_path):
+    original_path = str(tmp_path / 'original')
+    word_paths = make_pages(original_path)
+    for word_path in word_paths:
+        definitions = lrp.find_definitions(lrp.read_definitions_section(word_path, html_path=original_path))
+        expected_parents = {}
+        for def_ind, def_tag in enumerate(definitions):
+            strings = locate_strings_by_siblings(def_tag)
+            assert lrp.locate_strings(def_tag) == strings
+            for string in strings:
+                expected_parents.setdefault(string['parents'], {}).setdefault(def_ind, []).append(string['indices'])
+        assert lrp.index_strings_by_parents(word_path, html_path=original_path) == (word_path, expected_parents)
+
+
+def test_structure_counters_merge(tmp_path):
+    original_path = str(tmp_path / 'original')
+    word_paths = make_pages(original_path)
+    whole = lrp.count_structures([*word_paths, 'missing'], html_path=original_path, max_samples=3)
+    assert whole.num_pages == len(word_paths)
+    assert [error.item for error in whole.errors] == ['missing']
+    # counters of chunks, counted in threads and merged as they complete
+    merged = lrp.analyze_structure([*word_paths, 'missing'], html_path=original_path, max_samples=3, chunk_size=5,
+                                   processes=False)
+    assert (merged.num_pages, merged.strings, merged.pages) == (whole.num_pages, whole.strings, whole.pages)
+    assert [error.item for error in merged.errors] == ['missing']
+    for parents, samples in merged.samples.items():
+        assert 1 <= len(samples) <= 3
+        # one sample per page, located by its content indices
+        assert len(set(filename for filename, _, _ in samples)) == len(samples)
+        for filename, def_ind, indices in samples:
+            definitions = lrp.find_definitions(lrp.read_definitions_section(filename, html_path=original_path))
+            assert isinstance(lrp.get_content(definitions[def_ind], indices), lrp.NavigableString)
+    assert [item['parents'] for item in merged.report()] == [item['parents'] for item in whole.report()]
+    assert sum(whole.pages.values()) >= len(word_paths)
@@ -0,0 +1,177 @@
+import json
+import random
+
+from conftest import MODEL_INDEX
+
+
+def test_warm_up_model(client):
+    response = client.post(f'/models/{MODEL_INDEX}/warmup')
+    assert response.status_code == 200
+    assert response.json()['loaded']
+
+
+def test_warm_up_unknown_model(client):
+    assert client.post('/models/10/warmup').status_code == 404
+
+
+def test_models(client):
+    assert client.get('/models').text.count('<option') == 3
+    status = client.get('/models', headers={'accept': 'application/json'}).json()
+    assert [item['index'] for item in status] == [0, 1, 2]
+
+
+def test_definitions(client, payloads):
+    for payload in payloads:
+        response = client.post('/definitions', json=payload)
+        assert response.status_code == 200
+        assert 'server-timing' in response.headers
+        # every example of the definitions found is colored by its score
+        assert response.text.count('class="word"') == response.text.count('title="')
+        assert 'class="d_xpl"' in response.text
+
+
+def test_definitions_top_k(client, payloads):
+    response = client.post('/definitions', json={**payloads[0], 'rank': 'mean', 'top_k': 1})
+    assert response.status_code == 200
+    assert response.text.count('<div class="b">') == 1
+
+
+def test_definitions_unknown_model(client, payloads):
+    assert client.post('/definitions', json={**payloads[0], 'model_index': 10}).status_code == 404
+
+
+def test_compare_definitions(client, payloads):
+    payload = {key: value for key, value in payloads[0].items() if key != 'model_index'}
+    response = client.post('/definitions/compare', json=payload)
+    assert response.status_code == 200
+    content = response.json()
+    # only the model with an embedding store is compared by default
+    assert [model['index'] for model in content['models']] == [MODEL_INDEX]
+    assert content['definitions']
+    for definition in content['definitions']:
+        scores, = definition['scores']
+        examples = [score for score in scores['examples'] if score is not None]
+        assert scores['best'] == (max(examples) if examples else None)
+
+
+def test_nearest(client, payloads):
+    response = client.post('/nearest', json={**payloads[0], 'top_k': 5})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert len(results) == 5
+    assert [result['score'] for result in results] == sorted((result['score'] for result in results), reverse=True)
+    assert all(result['example'] for result in results)
+
+
+def test_annotate(client, payloads):
+    response = client.post('/annotate', json={'text': payloads[0]['text'], 'model_index': MODEL_INDEX, 'top_k': 2})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines
+    for line in lines:
+        assert payloads[0]['text'][line['start']:line['end']] == line['word']
+        assert len(line['senses']) <= 2
+
+
+def test_static_files(client, workdir):
+    word_path = sorted(item.name[:-5] for item in (workdir / 'assets/html/processed').iterdir()
+                       if item.name.endswith('.html'))[0]
+    response = client.get(f'/html/{word_path}.html')
+    assert response.status_code == 200
+    response = client.get(f'/html/{word_path}.html', headers={'if-none-match': response.headers['etag']})
+    assert response.status_code == 304
+    assert client.get('/html/missing.html').status_code == 404
+    assert client.get('/lexicon/index.json').status_code == 404
+
+
+
+def test_static_etags_are_bounded(client, workdir, monkeypatch):
+    import lerobert.static as lrs
+    from lerobert.caching import LRUCache
+
+    monkeypatch.setattr(lrs, '_etags', LRUCache(max_size=2, size_function=lambda etag: 1))
+    word_paths = sorted(item.name[:-5] for item in (workdir / 'assets/html/processed').iterdir()
+                        if item.name.endswith('.html'))[:3]
+    etags = []
+    for word_path in word_paths:
+        response = client.get(f'/html/{word_path}.html', headers={'accept-encoding': 'identity'})
+        assert response.status_code == 200
+        etags.append(response.headers['etag'])
+        with open(workdir / f'assets/html/processed/{word_path}.html', 'rb') as f:
+            assert etags[-1] == f'"{lrs.content_etag(f.read())}"'
+    # only the ETags of the most recently served files are kept
+    assert len(lrs._etags) == 2
+    response = client.get(f'/html/{word_paths[0]}.html', headers={'if-none-match': etags[0],
+                                                                  'accept-encoding': 'identity'})
+    assert response.status_code == 304
+    assert lrs._etags.misses == 4
+
+
+def test_caches_and_metrics(client, payloads):
+    client.post('/definitions', json=payloads[0])
+    caches = client.get('/caches').json()
+    assert {'templates', 'hidden_states', 'examples', 'lemmas'} <= set(caches)
+    assert caches['lemmas']['tagger_calls'] >= 0
+    metrics = client.get('/metrics').text
+    assert 'lerobert_request_seconds_bucket' in metrics
+    assert 'lerobert_cache_hits_total{cache="templates"}' in metrics
+
+
+def test_reload_after_build(client, workdir):
+    from lerobert.build import Build, MODEL_NAMES, ORIGINAL_HTML_PATH
+    from benchmarks.corpus import make_page
+    # the lexicon, store and pages are in use when the build replaces them
+    assert client.get('/html/zorglub.html').status_code == 404
+    text = 'Un zorglub dans le jardin.'
+    client.post('/definitions', json={'text': text, 'selection_start': 3, 'selection_end': 10,
+                                      'model_index': MODEL_INDEX})
+    with open(f'{ORIGINAL_HTML_PATH}/zorglub.html', 'w', encoding='utf-8') as f:
+        f.write(make_page(random.Random(0), 'zorglub', ['zorglub'], ['jardin', 'maison'], num_examples=(2, 3)))
+    assert not Build(model_names=[MODEL_NAMES[MODEL_INDEX]], processes=False).run()
+    assert client.get('/html/zorglub.html').status_code == 200
+    response = client.post('/definitions', json={'text': text, 'selection_start': 3, 'selection_end': 10,
+                                                 'model_index': MODEL_INDEX})
+    assert response.status_code == 200
+    assert 'Sens de zorglub' in response.text
+    assert response.text.count('class="word"') == response.text.count('title="')
+
+
+def test_definitions_cache_keys_the_window_used(client, payloads, monkeypatch):
+    import main
+    from lerobert.caching import LRUCache, HiddenStateCache
+    # a text longer than a window with the same selected text twice in the middle, the second selection in the window
+    # of the first one
+    payload = payloads[0]
+    rng = random.Random(0)
+    others = [other['text'] for other in payloads[1:]]*4
+    before, after = rng.sample(others, len(others)), rng.sample(others, len(others))
+    parts = [*before, payload['text'], payloads[1]['text'], payload['text'], *after]
+    text = ' '.join(parts)
+    payload_a, payload_b = [{**payload, 'text': text,
+                             'selection_start': offset + payload['selection_start'],
+                             'selection_end': offset + payload['selection_end']}
+                            for offset in (len(' '.join(parts[:len(before)])) + 1,
+                                           len(' '.join(parts[:len(before) + 2])) + 1)]
+    monkeypatch.setattr(main, 'definitions_cache', LRUCache(max_size=2**20))
+    monkeypatch.setattr(main, 'hidden_state_cache', HiddenStateCache(max_size=2**26))
+    client.post('/definitions', json=payload_a)
+    # pooled from the window of the first selection
+    client.post('/definitions', json=payload_b)
+    assert main.hidden_state_cache.hits == 1
+    monkeypatch.setattr(main, 'hidden_state_cache', HiddenStateCache(max_size=2**26))
+    content = client.post('/definitions', json=payload_b).text
+    monkeypatch.setattr(main, 'definitions_cache', None)
+    monkeypatch.setattr(main, 'hidden_state_cache', HiddenStateCache(max_size=2**26))
+    assert content == client.post('/definitions', json=payload_b).text
+
+
+def test_stages_labelled_with_model(client, payloads):
+    model_name = f'model="{client.get("/models", headers={"accept": "application/json"}).json()[MODEL_INDEX]["name"]}"'
+    client.post('/definitions', json=payloads[0])
+    payload = {key: value for key, value in payloads[0].items() if key != 'model_index'}
+    client.post('/definitions/compare', json=payload)
+    metrics = client.get('/metrics').text
+    # models are looked up before they are loaded, by each task of a comparison
+    assert f'lerobert_stage_seconds_count{{{model_name},stage="load_model"}}' in metrics
+    assert 'lerobert_stage_seconds_count{model="",stage="load_model"}' not in metrics
+    assert 'lerobert_stage_seconds_count{model="",stage="forward"}' not in metrics
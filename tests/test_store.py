@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+import lerobert.processing as lrp
+from lerobert.ann import create_ann_index, update_ann_index, load_ann_index, sample_store_rows
+from lerobert.formats import get_store_format
+
+
+def make_items(num_pages=20, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(f'page{ind}', rng.standard_normal((rng.integers(1, 6), dim)).astype(np.float32))
+            for ind in range(num_pages)]
+
+
+def cosines(rows, embeddings):
+    return (lrp.normalize_embeddings(rows)*lrp.normalize_embeddings(embeddings)).sum(1)
+
+
+@pytest.mark.parametrize('dtype, min_cosine', [('float32', 0.99999), ('float16', 0.999), ('int8', 0.99)])
+def test_store_round_trip(tmp_path, dtype, min_cosine):
+    items = make_items()
+    lrp.write_embedding_store(iter(items), tmp_path, dtype=dtype)
+    store = lrp.load_embedding_store(tmp_path)
+    assert get_store_format(store) == dtype
+    assert store.dtype == np.dtype(dtype)
+    assert sorted(store.offsets) == sorted(word_path for word_path, _ in items)
+    for word_path, embeddings in items:
+        rows = np.asarray(store.get(word_path), dtype=np.float32)
+        assert rows.shape == embeddings.shape
+        assert cosines(rows, embeddings).min() > min_cosine
+    assert store.get('missing') is None
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'int8'])
+def test_update_and_compact_store(tmp_path, dtype):
+    items = make_items()
+    lrp.write_embedding_store(iter(items[:10]), tmp_path, dtype=dtype)
+    # page0 is replaced, page1 removed and the other pages appended in the format of the store
+    replaced = ('page0', items[10][1])
+    lrp.update_embedding_store([replaced, *items[11:]], tmp_path, remove=['page1'], dtype='float16')
+    store = lrp.load_embedding_store(tmp_path)
+    assert store.dtype == np.dtype(dtype)
+    expected = dict([*items[2:10], *items[11:], replaced])
+    assert sorted(store.offsets) == sorted(expected)
+    rows_before = {word_path: np.array(store.get(word_path)) for word_path in expected}
+    lrp.compact_embedding_store(tmp_path)
+    store = lrp.load_embedding_store(tmp_path)
+    assert len(store.matrix) == sum(len(embeddings) for embeddings in expected.values())
+    for word_path, embeddings in expected.items():
+        # rows are copied as they are
+        assert np.array_equal(np.array(store.get(word_path)), rows_before[word_path])
+        assert cosines(np.asarray(store.get(word_path), dtype=np.float32), embeddings).min() > 0.99
+
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int8'])
+def test_empty_store(tmp_path, dtype):
+    lrp.write_embedding_store(iter([]), tmp_path, dtype=dtype, normalize=False)
+    store = lrp.load_embedding_store(tmp_path)
+    assert store.matrix.shape[0] == 0
+    # only int8 rows have scales
+    assert (store.scales is not None) == (dtype == 'int8')
+    assert store.nbytes == 0
+    lrp.compact_embedding_store(tmp_path)
+    items = make_items(num_pages=3)
+    lrp.update_embedding_store(items, tmp_path, dtype=dtype)
+    store = lrp.load_embedding_store(tmp_path)
+    assert store.dtype == np.dtype(dtype)
+    assert (store.scales is not None) == (dtype == 'int8')
+    for word_path, embeddings in items:
+        assert cosines(np.asarray(store.get(word_path), dtype=np.float32), embeddings).min() > 0.99
+
+
+def test_convert_store_with_projection(tmp_path):
+    items = make_items(num_pages=40)
+    lrp.write_embedding_store(iter(items), tmp_path / 'float32')
+    lrp.convert_embedding_store(tmp_path / 'float32', tmp_path / 'int8', dtype='int8', num_components=32)
+    baseline = lrp.load_embedding_store(tmp_path / 'float32')
+    store = lrp.load_embedding_store(tmp_path / 'int8')
+    assert get_store_format(store) == 'int8:32'
+    # with all the components, scores are close to the ones of the float32 store: rows are quantized
+    # and centered on their mean
+    query = items[0][1][0]
+    for word_path, _ in items:
+        baseline_scores = np.asarray(baseline.get(word_path)) @ lrp.normalize_embeddings(query)
+        scores = lrp.normalize_embeddings(store.get(word_path)) @ lrp.normalize_embeddings(store.project(query))
+        assert np.abs(scores - baseline_scores).max() < 0.1
+    assert lrp.normalize_embeddings(store.get('page0'))[0] @ lrp.normalize_embeddings(store.project(query)) > 0.99
+    # rows appended later are projected like the others
+    lrp.update_embedding_store([('new', items[0][1])], tmp_path / 'int8')
+    store = lrp.load_embedding_store(tmp_path / 'int8')
+    assert np.abs(np.asarray(store.get('new')) - np.asarray(store.get('page0'))).max() < 1e-6
+    with pytest.raises(ValueError):
+        lrp.convert_embedding_store(tmp_path / 'int8', tmp_path / 'int8:16', num_components=16)
+
+
+def test_score_definitions(tmp_path):
+    items = make_items()
+    lrp.write_embedding_store(iter(items), tmp_path, dtype='int8')
+    store = lrp.load_embedding_store(tmp_path)
+    word_path, embeddings = items[3]
+    definitions = [(word_path, 0, 0, len(embeddings)), ('missing', 0, 0, 2)]
+    scores = lrp.score_definitions(embeddings[0], store, definitions)
+    assert abs(scores[0][0] - 1.0) < 1e-3
+    assert np.isnan(scores[1]).all()
+
+
+def test_ann_index(tmp_path):
+    items = make_items(num_pages=60)
+    lrp.write_embedding_store(iter(items), tmp_path / 'store')
+    store = lrp.load_embedding_store(tmp_path / 'store')
+    create_ann_index(tmp_path / 'index', sample_store_rows(store), num_lists=4)
+    update_ann_index(((word_path, store.get(word_path), [0]*len(store.get(word_path))) for word_path in store.offsets),
+                     tmp_path / 'index')
+    index = load_ann_index(tmp_path / 'index')
+    word_path, embeddings = items[7]
+    # all lists are searched, so the nearest example is the query itself
+    (found_word_path, _, example_ind, score), *_ = index.search(embeddings[1], k=3, nprobe=4)
+    assert (found_word_path, example_ind) == (word_path, 1)
+    assert score == pytest.approx(1.0, abs=1e-5)
+    update_ann_index([], tmp_path / 'index', remove=[word_path])
+    assert all(result[0] != word_path for result in load_ann_index(tmp_path / 'index').search(embeddings[1], nprobe=4))